@@ -4,7 +4,11 @@ import sys
 import time
 
 from .app.cli.exceptions import NotRunning, Nonsense
-from .api.requests import RequestCommand
+from .api.requests import (
+    RequestCommand, RequestAnnotate, RequestBrowse, RequestContexts,
+    RequestCounts, RequestDeleteEmails, RequestEmail, RequestEmails,
+    RequestMailbox, RequestSearch, RequestTag)
+from .email.metadata import Metadata
 from .util.dumbcode import from_json, to_json
 
 
@@ -44,6 +48,21 @@ class Moggie:
     Moggie's API methods can be invoked either synchronously, or async.
     The async methods have a `async_` prefix to the method names.
 
+    Structured API example:
+
+        response = moggie.api_search(terms='bjarni', limit=5)
+        for md in response['emails']:  # A list of Metadata objects
+            print(md.idx, md.parsed()['subject'])
+
+        counts = await moggie.async_api_counts(terms_list=['in:inbox'])
+
+    The `api_*` methods (see `API_REQUESTS`) skip the command-line layer
+    entirely: keyword arguments are used to build a request object (e.g.
+    `RequestSearch`), which is passed straight to the app and the response
+    is returned as a dictionary of Python objects (Metadata, IntSet, ...).
+    Arbitrary request objects can be sent using `request()` or
+    `async_request()`.
+
     API methods will either return their output buffer on success
     (raising exceptions for certain errors), or invoke the named
     callback functions (`on_success=...` or `on_error=...`) when
@@ -71,6 +90,22 @@ class Moggie:
     DEFAULT_LOG_LEVEL = 2
     PREFER_ASYNC = False
 
+    API_REQUESTS = {
+        'annotate': RequestAnnotate,
+        'browse': RequestBrowse,
+        'contexts': RequestContexts,
+        'counts': RequestCounts,
+        'delete_emails': RequestDeleteEmails,
+        'email': RequestEmail,
+        'emails': RequestEmails,
+        'mailbox': RequestMailbox,
+        'search': RequestSearch,
+        'tag': RequestTag}
+
+    # Only these responses carry Metadata rows in 'emails', others (such
+    # as the raw e-mails returned for 'emails') are left untouched.
+    API_METADATA_RESPONSES = ('browse', 'mailbox', 'search')
+
     @classmethod
     def Setup(cls):
         import moggie.sys_path_helper
@@ -136,6 +171,43 @@ class Moggie:
                 return await self.async_run(cmd, *a, **kwa)
             return _async_runner
 
+        import inspect
+        def _mk_request(req_cls):
+            params = inspect.signature(req_cls.__init__).parameters
+            def _request(self, kwa):
+                kwa.pop('moggie_wrap', None)  # Set by MoggieContext
+                # Anything the constructor does not know about (skip, limit,
+                # threads, ...) gets set directly on the request object.
+                extra = dict((k, kwa.pop(k)) for k in list(kwa.keys())
+                    if k not in params)
+                if 'context' in params and not kwa.get('context'):
+                    kwa['context'] = self._default_context()
+                req = req_cls(**kwa)
+                dict.update(req, extra)
+                return req
+            return _request
+
+        def _mk_api_method(req_cls):
+            _request = _mk_request(req_cls)
+            def _sync_api(self, **kwa):
+                return self.request(_request(self, kwa))
+            return _sync_api
+
+        def _mk_async_api_method(req_cls):
+            _request = _mk_request(req_cls)
+            async def _async_api(self, **kwa):
+                return await self.async_request(_request(self, kwa))
+            return _async_api
+
+        for name, req_cls in cls.API_REQUESTS.items():
+            sync_method = _mk_api_method(req_cls)
+            async_method = _mk_async_api_method(req_cls)
+
+            setattr(cls, 'async_api_' + name, async_method)
+            setattr(cls, 'sync_api_' + name, sync_method)
+            setattr(cls, 'api_' + name,
+                async_method if cls.PREFER_ASYNC else sync_method)
+
         for command in cls._COMMANDS:
             name = command.replace('-', '_')
             if name in ('import',):
@@ -546,6 +618,56 @@ class Moggie:
 
         return finish(self, result)
 
+    def _default_context(self):
+        if self._access is True or not self._access:
+            return self._config.get(self._config.GENERAL,
+                'default_cli_context', fallback='Context 0')
+        return self._access.get_default_context()
+
+    def _cook_response(self, response):
+        if not (isinstance(response, dict) and
+                response.get('req_type') in self.API_METADATA_RESPONSES):
+            return response
+        emails = response.get('emails')
+        if isinstance(emails, list):
+            def _cook(e):
+                if isinstance(e, list):
+                    return Metadata(*e)
+                if isinstance(e, dict) and 'messages' in e:
+                    e['messages'] = [Metadata(*m) for m in e['messages']]
+                return e
+            response['emails'] = [_cook(e) for e in emails]
+        return response
+
+    def request(self, request_obj):
+        """
+        Send an API request object (RequestSearch, RequestTag, ...) to
+        the app synchronously, returning the response. Errors are raised
+        as exceptions (see `moggie.api.exceptions`).
+
+        This cannot be used from within a running event loop, use
+        `async_request()` instead.
+        """
+        try:
+            self.loop = asyncio.get_event_loop()
+        except RuntimeError:
+            self.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self.loop)
+        if self.loop.is_running():
+            raise RuntimeError('Event loop is running, use async_request()')
+        return self.loop.run_until_complete(self.async_request(request_obj))
+
+    async def async_request(self, request_obj):
+        """
+        Send an API request object (RequestSearch, RequestTag, ...) to
+        the app, returning the response with e-mails as Metadata objects.
+        """
+        if not self._app_worker:
+            self.connect()
+        return self._cook_response(
+            await self._app_worker.async_api_request(self._access, request_obj))
+
+
 class MoggieCLI(Moggie):
     """
     A Moggie object configured for use as a command-line tool by default,
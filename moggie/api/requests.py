@@ -223,6 +223,36 @@ class RequestEmail(RequestBase):
         }, req_id=req_id)
 
 
+class RequestEmailPart(RequestBase):
+    def __init__(self, context='', metadata=[], part=0,
+            offset=0, length=None,
+            username=None, password=None,
+            req_id=None):
+        self.update({
+            'req_type': 'email_part',
+            'context': context,
+            'metadata': metadata[:Metadata.OFS_HEADERS],
+            'part': part,
+            'offset': offset,
+            'length': length,
+            'username': username,
+            'password': password
+        }, req_id=req_id)
+
+
+class RequestEmails(RequestBase):
+    def __init__(self, context='', metadata_list=[],
+            username=None, password=None,
+            req_id=None):
+        self.update({
+            'req_type': 'emails',
+            'context': context,
+            'metadata_list': [m[:Metadata.OFS_HEADERS] for m in metadata_list],
+            'username': username,
+            'password': password
+        }, req_id=req_id)
+
+
 class RequestDeleteEmails(RequestBase):
     def __init__(self, context='',
             from_mailboxes=None, metadata_list=[],
@@ -349,6 +379,8 @@ def to_api_request(_input):
          'autotag_classify': RequestAutotagClassify,
          'ping': RequestPing,
          'email': RequestEmail,
+         'emails': RequestEmails,
+         'email_part': RequestEmailPart,
          'delete': RequestDeleteEmails,
          'counts': RequestCounts,
          'search': RequestSearch,
@@ -122,6 +122,27 @@ class ResponseEmail(dict):
             'email': parsed_email})
 
 
+class ResponseEmailPart(dict):
+    def __init__(self, request, size, data):
+        self.update({
+            'req_type': request['req_type'],
+            'req_id': request['req_id'],
+            'metadata': request['metadata'],
+            'part': request['part'],
+            'offset': request['offset'],
+            'size': size,
+            'data': data})
+
+
+class ResponseEmails(dict):
+    def __init__(self, request, emails):
+        self.update({
+            'req_type': request['req_type'],
+            'req_id': request['req_id'],
+            'context': request['context'],
+            'emails': emails})
+
+
 class ResponseConfigGet(dict):
     def __init__(self, request, config_data, error=None):
         self.update({
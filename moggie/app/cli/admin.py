@@ -1127,8 +1127,10 @@ class CommandNew(CommandImport):
         results = {}
         if not self.options['--context=']:
             self.options['--context='] = list(self.get_all_contexts().keys())
-        for ctx in self.options['--context=']:
-            result = await self.run_import_only(context_id=ctx)
+        # Check all the contexts at once, the app schedules the work
+        for result in await asyncio.gather(*[
+                self.run_import_only(context_id=ctx)
+                for ctx in self.options['--context=']]):
             if result.get('context'):
                 results[result['context']] = result['results']
         return self.show_results(results)
@@ -36,6 +36,7 @@ class CLICommand:
 
     @classmethod
     async def WebRunnable(cls, app, access, frame, conn, req_env, args):
+        from ... import get_shared_moggie
         def reply(msg, eof=False):
             if msg or eof:
                 if isinstance(msg, (bytes, bytearray)):
@@ -87,7 +88,6 @@ class CLICommand:
     def __init__(self, moggie, args,
             access=None, appworker=None, connect=True, req_env=None):
         from ...workers.app import AppWorker
-        from ...util.rpc import AsyncRPCBridge
 
         self.options = {}
         for opt_group in self.OPTIONS:
@@ -137,6 +137,7 @@ class CLICommand:
         self.app = None
         self.ev_loop = asyncio.get_event_loop()
         if connect and self.WEBSOCKET:
+            from ...util.rpc import AsyncRPCBridge
             self.app = AsyncRPCBridge(self.ev_loop, 'cli', self.worker, self)
             if not self.ev_loop.is_running():
                 self.ev_loop.run_until_complete(self._await_connection())
@@ -32,9 +32,11 @@ import time
 
 from .command import Nonsense, CLICommand, AccessConfig
 from .openpgp import CommandOpenPGP
+from ... import config
 from ...api.exceptions import *
 from ...api.requests import *
 from ...email.metadata import Metadata
+from ...email.util import IDX_MAX
 from ...email.addresses import AddressInfo
 from ...email.parsemime import MessagePart
 from ...security.html import HTMLCleaner
@@ -50,6 +52,95 @@ def _html_quote(t):
         .replace('>', '&gt;'))
 
 
+class ParseCache:
+    """
+    A bounded cache of parse results, keyed by (idx, settings, key-state).
+
+    This lives in the app, so re-opening a message (or opening one which
+    the reader prefetched) skips loading and parsing it again. Entries are
+    evicted least-recently-used first, when either the number of entries
+    or their approximate memory use exceeds our limits. Results are copied
+    on the way in and out, since callers like to mutate them.
+    """
+    MAX_BYTES = 64 * 1024 * 1024
+    MAX_ENTRIES = 2500
+    MAX_AGE = 3600
+
+    def __init__(self, max_bytes=None, max_entries=None, max_age=None):
+        self.max_bytes = max_bytes or self.MAX_BYTES
+        self.max_entries = max_entries or self.MAX_ENTRIES
+        self.max_age = max_age or self.MAX_AGE
+        self.entries = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    @classmethod
+    def ApproxSize(cls, obj):
+        size = 0
+        stack = [obj]
+        while stack:
+            obj = stack.pop()
+            if isinstance(obj, (str, bytes, bytearray)):
+                size += 50 + len(obj)
+            elif isinstance(obj, dict):
+                size += 100 + 16 * len(obj)
+                stack.extend(dict.keys(obj))
+                stack.extend(dict.values(obj))
+                if isinstance(obj, MessagePart):
+                    stack.extend(obj.msg_bin)
+            elif isinstance(obj, (list, tuple, set)):
+                size += 60 + 8 * len(obj)
+                stack.extend(obj)
+            else:
+                size += 32
+        return size
+
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[1]
+
+    def clear(self):
+        self.entries = {}
+        self.bytes = 0
+
+    def get(self, key):
+        entry = self.entries.pop(key, None) if key else None
+        if entry is not None:
+            if entry[0] >= time.time():
+                self.entries[key] = entry  # Move to the end: recently used
+                self.hits += 1
+                return copy.deepcopy(entry[2])
+            self.bytes -= entry[1]
+        self.misses += 1
+        return None
+
+    def put(self, key, result, max_age=None):
+        if not key:
+            return False
+        self.discard(key)
+
+        result = copy.deepcopy(result)
+        size = self.ApproxSize(result)
+        if size > self.max_bytes // 4:
+            return False
+
+        expires = time.time() + min(max_age or self.max_age, self.max_age)
+        self.entries[key] = (expires, size, result)
+        self.bytes += size
+        while ((self.bytes > self.max_bytes)
+                or (len(self.entries) > self.max_entries)):
+            self.discard(next(iter(self.entries)))
+        return True
+
+
+PARSE_CACHE = ParseCache()
+
+
 def _make_message_id(random_data=None):
     from binascii import hexlify
     return '<%s@mailpile>' % (
@@ -82,6 +173,11 @@ class CommandParse(CLICommand):
     WEBSOCKET = False
     WEB_EXPOSE = True
     CONNECT = False    # We manually connect if we need to!
+
+    # Keystores can change without the config changing, so cached results
+    # of OpenPGP processing are only trusted for a few minutes.
+    PARSE_CACHE_PGP_MAX_AGE = 300
+
     OPTIONS = [[
         (None, None, 'moggie'),
         ('--context=',      ['default'], 'Context to use for default settings'),
@@ -102,6 +198,7 @@ class CommandParse(CLICommand):
         ('--with-headers=',     ['Y'], 'X=(Y*|N), include parsed message headers'),
         ('--with-path-info=',   ['Y'], 'X=(Y*|N), include path through network'),
         ('--with-structure=',   ['Y'], 'X=(Y*|N), include message structure'),
+        ('--with-part-info=',   ['Y'], 'X=(Y*|N), include part sizes and hashes'),
         ('--with-text=',        ['Y'], 'X=(Y*|N), include message text parts'),
         ('--with-html=',        ['N'], 'X=(Y|N*), include raw message HTML'),
         ('--with-html-clean=',  ['N'], 'X=(Y|N*), include sanitized message HTML'),
@@ -440,6 +537,10 @@ class CommandParse(CLICommand):
                 await cls.parse_openpgp(cli_obj, settings, p)
             elif settings.with_structure:
                 p.with_structure()
+            if settings.with_structure and settings.with_part_info:
+                # Describe the parts, so callers can fetch attachment
+                # data separately (`moggie show --part=N`) if they want it.
+                p.with_descriptors()
 
             if settings.verify_dates:
                 # This happens *after* OpenPGP processing, so we can include
@@ -576,6 +677,13 @@ class CommandParse(CLICommand):
         self.settings = None
         self.searches = []
         self.messages = []
+
+        # Only cache parse results when running within the app; one-shot
+        # CLI invocations would never see a cache hit.
+        appworker = kwargs.get('appworker')
+        self.parse_cache = (PARSE_CACHE
+            if (appworker and getattr(appworker, 'app', None)) else None)
+
         super().__init__(*args, **kwargs)
 
     def configure(self, args):
@@ -1034,7 +1142,8 @@ system should have learned new things since then.
             elif search[:1] in ('{', '[') and search[-1:] in (']', '}'):
                 metadata = search
 
-            if metadata:
+            from_caller = bool(metadata)
+            if from_caller:
                 result = {'emails': [Metadata.FromParsed(metadata)]}
             else:
                 if mailbox:
@@ -1056,6 +1165,15 @@ system should have learned new things since then.
                             username=self.options['--username='][-1],
                             password=self.options['--password='][-1])
                     md = Metadata(*metadata)
+                    # Metadata from the caller cannot be trusted to match
+                    # the index, so only search results use the cache.
+                    cache_key = (
+                        None if from_caller else self.get_cache_key(md))
+                    cached = self.parse_cache and self.parse_cache.get(cache_key)
+                    if cached:
+                        cached.update({'mailbox': mailbox, 'search': search})
+                        yield {'cached': cached}
+                        continue
                     try:
                         msg = await self.worker.async_api_request(
                             self.access, req)
@@ -1067,7 +1185,8 @@ system should have learned new things since then.
                             'data': base64.b64decode(msg['email']['_RAW']),
                             'metadata': md,
                             'mailbox': mailbox,
-                            'search': search}
+                            'search': search,
+                            'cache_key': cache_key}
                     else:
                         yield {
                             'error': 'Not found',
@@ -1080,6 +1199,36 @@ system should have learned new things since then.
                     'mailbox': mailbox,
                     'search': search}
 
+    def get_cache_key(self, md):
+        """
+        Generate a parse-cache key for the given message metadata, or
+        None if the results should not be cached.
+
+        Only messages found in the search index are cached (callers must
+        not ask for keys for caller-supplied metadata). Results which
+        include index metadata or autotagging analysis are not, as those
+        change independently of the message itself. If we are processing
+        OpenPGP content, the key state (our key settings and the app
+        config version) is included in the key.
+        """
+        s = self.settings
+        if ((self.parse_cache is None)
+                or self.write_back
+                or s.with_metadata
+                or s.with_autotags
+                or s.ignore_index
+                or not (0 < md.idx < IDX_MAX)):
+            return None
+        key_state = ''
+        if s.with_openpgp:
+            key_state = '%s %s %s' % (
+                self.get_context(),
+                config.CACHE_VERSION,
+                ' '.join('%s%s' % (opt, self.options.get(opt)) for opt in (
+                    '--pgp-sop=', '--pgp-key-sources=', '--pgp-password=',
+                    '--decrypt-with=', '--verify-from=')))
+        return (md.idx, str(s), self.allow_network, key_state)
+
     def get_emitter(self):
         if self.options['--format='][-1] == 'sexp':
             return self.emit_sexp
@@ -1097,9 +1246,19 @@ system should have learned new things since then.
             if 'error' in message:
                 if self.settings.with_missing:
                     emitter(message)
+            elif 'cached' in message:
+                emitter(message['cached'])
             else:
-                emitter(await self.Parse(self, message, self.settings,
-                    allow_network=self.allow_network))
+                cache_key = message.pop('cache_key', None)
+                result = await self.Parse(self, message, self.settings,
+                    allow_network=self.allow_network)
+                if cache_key and result.get('parsed'):
+                    self.parse_cache.put(cache_key, dict(
+                        (k, v) for k, v in result.items()
+                        if k not in ('mailbox', 'search')),
+                        max_age=(self.PARSE_CACHE_PGP_MAX_AGE
+                            if self.settings.with_openpgp else None))
+                emitter(result)
 
         if self.searches:
             async for message in self.gather_emails():
@@ -2357,7 +2516,16 @@ class CommandEmail(CLICommand):
         logging.exception('wat')
         raise
 
-    async def do_send(self, render=None, recipients=None):
+    def get_smtp_pool(self):
+        """
+        Return the app's shared SMTP connection pool, if we are running
+        within the app, or None otherwise.
+        """
+        if self.worker and self.worker._sock:
+            return self.worker.app.get_smtp_pool()
+        return None
+
+    async def do_send(self, render=None, recipients=None, pool=None):
         recipients = recipients or self.gather_recipients()
         if render is None:
             render = await self.render()
@@ -2371,12 +2539,21 @@ class CommandEmail(CLICommand):
             transcript.append((happy, code, details, message))
             return True
 
-        from moggie.util.sendmail import sendmail
+        from moggie.util.sendmail import sendmail, SMTPPool
+        pool = pool or self.get_smtp_pool()
+        own_pool = (pool is None)
+        if own_pool:
+            pool = SMTPPool()
         frm = self.options['--from='][0].address
-        await sendmail(render, [
-                (via, frm, [r.address for r in recipients])
-            ],
-            progress_callback=_progress)
+        try:
+            await sendmail(render, [
+                    (via, frm, [r.address for r in recipients])
+                ],
+                progress_callback=_progress,
+                pool=pool)
+        finally:
+            if own_pool:
+                await pool.close()
 
         self.print_json(transcript)
 
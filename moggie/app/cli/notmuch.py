@@ -24,6 +24,7 @@
 #     of simple signature which lets us revoke the URLs along with the
 #     access object.
 #
+import asyncio
 import base64
 import copy
 import datetime
@@ -45,9 +46,6 @@ from ...api.exceptions import *
 from ...api.requests import *
 from ...security.mime import part_filename, magic_part_id
 from ...security.html import clean_email_html
-from ...storage.exporters.mbox import MboxExporter
-from ...storage.exporters.maildir import MaildirExporter, EmlExporter
-from ...storage.exporters.msgdirs import MsgdirsExporter
 from ...util.mailpile import tag_unquote
 from ...util.dumbcode import dumb_decode, to_json, from_json
 
@@ -151,6 +149,10 @@ FIXME: Document html and html formats!
     WEBSOCKET = False
     WEB_EXPOSE = True
     HTML_DEFAULT_LIMIT = 25
+    BULK_EXPORT_FORMATS = ('mbox', 'maildir', 'mailzip', 'zip')
+    EXPORT_BATCH = 250
+    EXPORT_PREFETCH = 2
+    PART_CHUNK_BYTES = 1024 * 1024
     HTML_COLUMNS = ['count', 'thread', 'address', 'name', 'authors',
                     'tags', 'subject', 'date_relative']
     OPTIONS = [[
@@ -582,12 +584,32 @@ Tags: %(t)s
             for md in thread['messages']:
               try:
                 md = Metadata(*md)
+                if part:
+                    # Fetch just the one part, in chunks, so large
+                    # attachments never get encoded or buffered whole.
+                    # Storage keeps the parsed message between chunks.
+                    offset = size = 0
+                    while (offset == 0) or (offset < size):
+                        chunk = await self.worker.async_api_request(
+                            self.access, RequestEmailPart(
+                                context=self.context,
+                                metadata=md,
+                                part=part-1,
+                                offset=offset,
+                                length=self.PART_CHUNK_BYTES,
+                                username=self.options['--username='][-1],
+                                password=self.options['--password='][-1]))
+                        size = chunk['size']
+                        if not chunk['data']:
+                            break
+                        offset += len(chunk['data'])
+                        yield (chunk['data'], {'_metadata': md})
+                    continue
+
                 if want_body:
                     query = RequestEmail(
                         metadata=md,
-                        data=(True if part else False),
-                        parts=([part-1] if part else None),
-                        full_raw=(not part),
+                        full_raw=True,
                         username=self.options['--username='][-1],
                         password=self.options['--password='][-1])
                     query['context'] = self.context
@@ -599,13 +621,6 @@ Tags: %(t)s
                 if not msg or not msg.get('email'):
                     pass
 
-                elif part:
-                    _part = msg['email']['_PARTS'][part-1]
-                    yield (_part.get('_TEXT'),
-                        {'_metadata': md,
-                         '_mimetype': _part['content-type'][0],
-                         '_data': _part.get('_DATA')})
-
                 elif raw:
                     yield ('',
                         {'_metadata': md, '_data': msg['email']['_RAW']})
@@ -735,6 +750,44 @@ Tags: %(t)s
                 logging.exception('Failed to format message')
                 pass
 
+    async def as_raw_emails(self, results):
+        """
+        Yield the raw bytes of every message in a list of results, fetching
+        them from the app in bulk. After the first batch (which may need to
+        prompt for a password), a few batches are kept in flight so fetching
+        overlaps with the work of the exporter.
+        """
+        mds = []
+        for r in results:
+            mds.extend(Metadata(*md) for md in self._as_thread(r)['messages'])
+
+        B = self.EXPORT_BATCH
+        batches = [mds[i:i+B] for i in range(0, len(mds), B)]
+        def fetch(batch):
+            query = RequestEmails(
+                context=self.context,
+                metadata_list=batch,
+                username=self.options['--username='][-1],
+                password=self.options['--password='][-1])
+            return asyncio.ensure_future(
+                self.repeatable_async_api_request(self.access, query))
+
+        pending = [fetch(b) for b in batches[:1]]
+        for i, batch in enumerate(batches):
+            msg = await pending.pop(0)
+            ahead = i + 1 + len(pending)
+            while ahead < len(batches) and len(pending) < self.EXPORT_PREFETCH:
+                pending.append(fetch(batches[ahead]))
+                ahead += 1
+
+            emails = dict((msg or {}).get('emails') or [])
+            for md in batch:
+                raw = emails.get(md.idx)
+                if raw:
+                    yield ('', {'_metadata': md, '_raw': raw})
+                else:
+                    logging.debug('Failed to fetch raw message: %s' % md)
+
     async def emit_result_raw(self, result, first=False, last=False):
         if result is not None:
             raw = result[1] and result[1].get('_data')
@@ -870,7 +923,9 @@ Tags: %(t)s
                         data['_metadata'], data['_parsed'], func(data))
                 else:
                     metadata = data['_metadata']
-                    raw_email = base64.b64decode(data['_data'])
+                    raw_email = data.get('_raw')
+                    if raw_email is None:
+                        raw_email = base64.b64decode(data['_data'])
                     exported = exporter.export(metadata, raw_email)
             except:
                 logging.exception('Export failed')
@@ -879,27 +934,34 @@ Tags: %(t)s
         return exported
 
     async def emit_result_mbox(self, result, first=False, last=False):
+        from ...storage.exporters.mbox import MboxExporter
         exporter = self._get_exporter(MboxExporter)
         return self._export(exporter, result, first, last)
 
     async def emit_result_zip(self, result, first=False, last=False):
+        from ...storage.exporters.maildir import EmlExporter
         exporter = self._get_exporter(EmlExporter)
         return self._export(exporter, result, first, last)
 
     async def emit_result_maildir(self, result, first=False, last=False):
+        from ...storage.exporters.maildir import MaildirExporter
         exporter = self._get_exporter(MaildirExporter)
         return self._export(exporter, result, first, last)
 
     async def emit_result_mailzip(self, result, first=False, last=False):
+        from ...storage.exporters.maildir import MaildirExporter
         exporter = self._get_exporter(MaildirExporter,
             output=MaildirExporter.AS_ZIP)
         return self._export(exporter, result, first, last)
 
     async def emit_result_msgdirs(self, result, first=False, last=False):
+        from ...storage.exporters.msgdirs import MsgdirsExporter
         exporter = self._get_exporter(MsgdirsExporter)
         return self._export(exporter, result, first, last)
 
     async def emit_result_msgdzip(self, result, first=False, last=False):
+        from ...storage.exporters.maildir import MaildirExporter
+        from ...storage.exporters.msgdirs import MsgdirsExporter
         exporter = self._get_exporter(MsgdirsExporter,
             output=MaildirExporter.AS_ZIP)
         return self._export(exporter, result, first, last)
@@ -1015,6 +1077,9 @@ Tags: %(t)s
         elif output in ('tags', 'tag_info'):
             query['uncooked'] = True
             query['mask_tags'] = []
+            if output == 'tags':
+                # Tag names are all we need, so skip the intersections
+                query['tag_counts'] = True
             if ((query['skip'] or self.options.get('--limit=', [None])[-1])
                     and (fmt not in ('html', 'jhtml'))):
                 raise Nonsense('Offset and limit do not apply to tag searches')
@@ -1088,6 +1153,9 @@ Tags: %(t)s
     async def results(self, query, limit, formatter):
         batch = (self.batch // 10) if self.batch else None
         output = self.get_output()
+        bulk_export = ((formatter == self.as_emails)
+            and (self.options['--format='][-1] in self.BULK_EXPORT_FORMATS)
+            and not self.options.get('--part='))
         while limit is None or limit > 0:
             results = await self.perform_query(query, batch, limit)
             if self.batch:
@@ -1098,9 +1166,13 @@ Tags: %(t)s
                 limit -= count
 
 
-            for r in results:
-                async for fd in formatter(r):
+            if bulk_export:
+                async for fd in self.as_raw_emails(results):
                     yield fd
+            else:
+                for r in results:
+                    async for fd in formatter(r):
+                        yield fd
 
             query['skip'] += count
             if ((count < (query['limit'] or 0))
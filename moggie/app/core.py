@@ -20,6 +20,7 @@ from ..config.helpers import DictItemProxy, EncodingListItemProxy
 from ..email.util import IDX_MAX
 from ..util.asyncio import async_run_in_thread
 from ..util.dumbcode import *
+from ..util.intset import IntSet
 from ..workers.importer import ImportWorker
 from ..workers.metadata import MetadataWorker
 from ..workers.storage import StorageWorkers
@@ -65,6 +66,18 @@ main app worker. Hints:
        'ttf': 'font/ttf',
        'woff': 'font/woff'}
 
+    # Bulk e-mail fetches: messages per storage request, requests in flight
+    EMAILS_FETCH_BATCH = 250
+    EMAILS_FETCH_CONCURRENCY = 4
+
+    # Config changes are written to disk at most this often (seconds)
+    CONFIG_SAVE_DELAY = 2
+
+    # Mailbox imports: paths probed at once, parallel imports per backend
+    IMPORT_PROBE_CONCURRENCY = 8
+    IMPORT_CONCURRENCY_LOCAL = 1
+    IMPORT_CONCURRENCY_IMAP = 2
+
     DEFAULT_CRONTAB = """\
 # This is the schedule for moggie updates, checking mail, unsnoozing
 # snoozed messages, things like that.
@@ -94,7 +107,8 @@ main app worker. Hints:
             os.path.join(app_worker.worker_dir, '..'))
 
         self.worker = app_worker
-        self.config = AppConfig(self.work_dir)
+        self.config = AppConfig(self.work_dir,
+            save_delay=self.CONFIG_SAVE_DELAY)
         self.moggie = Moggie(app=self, app_worker=app_worker, access=True)
 
         self.rpc_functions = {
@@ -111,6 +125,7 @@ main app worker. Hints:
         self.openpgp_workers = {}
         self.stores = {}
         self.search = None
+        self.smtp_pool = None
         self.cron = None
         self.crontab_internal = "*/5 * * * *  app.load_crontab()"
         self.crontab_last_loaded = 0
@@ -331,6 +346,17 @@ main app worker. Hints:
     def shutdown_tasks(self):
         self.stop_workers()
         self.config.save()
+        self.config.flush()
+
+    def get_smtp_pool(self):
+        """
+        Return the SMTP connection pool shared by everything the app sends,
+        so batches of messages reuse logged-in connections to each relay.
+        """
+        if self.smtp_pool is None:
+            from ..util.sendmail import SMTPPool
+            self.smtp_pool = SMTPPool()
+        return self.smtp_pool
 
     def keep_result(self, rid, rv):
         self._results[rid] = (time.time(), rv)
@@ -722,7 +748,8 @@ main app worker. Hints:
                 more_terms=scope_s,
                 mask_deleted=api_request.get('mask_deleted', True),
                 mask_tags=api_request.get('mask_tags'),
-                with_tags=(not api_request.get('only_ids', False)))
+                with_tags=('counts' if api_request.get('tag_counts')
+                    else not api_request.get('only_ids', False)))
             if api_request.get('uncooked'):
                 return s_result
             s_metadata = (
@@ -739,10 +766,81 @@ main app worker. Hints:
             s_metadata['metadata'] = list(s_metadata['metadata'])
             return (s_result, s_metadata)
 
+        async def perform_streamed_search():
+            # Results are streamed from the search engine in chunks, and
+            # each chunk is sorted by the metadata worker as soon as it
+            # arrives. Only the top (skip + limit) of each chunk can end
+            # up on the requested page, so the final sort and the tag
+            # lookup only need to consider those candidates.
+            terms = api_request['terms']
+            if isinstance(terms, list):
+                terms = ' '.join(terms)
+            skip = api_request['skip']
+            limit = api_request['limit']
+            only_ids = api_request.get('only_ids', False)
+            sort = self.search.SORT_DATE_DEC  # FIXME: configurable?
+
+            summary = {}
+            sorting = []
+            async def sort_chunk(hits):
+                return await self.metadata.with_caller(conn_id).async_metadata(
+                    loop, hits,
+                    tags=summary['tags'],
+                    sort=sort,
+                    only_ids=True,
+                    skip=0,
+                    limit=skip + limit)
+            def chunk_cb(chunk):
+                if not summary:
+                    summary.update(chunk)
+                    summary['received'] = 0
+                else:
+                    summary['received'] += chunk['count']
+                    sorting.append(loop.create_task(sort_chunk(chunk['hits'])))
+
+            await self.search.with_caller(conn_id).async_search_stream(
+                loop,
+                terms,
+                chunk_cb,
+                tag_namespace=tag_ns,
+                more_terms=scope_s,
+                mask_deleted=api_request.get('mask_deleted', True),
+                mask_tags=api_request.get('mask_tags'))
+            sorted_chunks = await asyncio.gather(*sorting)
+            if summary.get('received') != summary.get('total'):
+                raise IOError('Incomplete search results')
+
+            candidates = IntSet()
+            for s_chunk in sorted_chunks:
+                candidates |= s_chunk['metadata']
+            tags = summary.pop('tags')
+            if candidates and not only_ids:
+                tags = await self.search.with_caller(conn_id).async_tags(
+                    loop, candidates, tag_namespace=tag_ns)
+
+            s_metadata = (
+                await self.metadata.with_caller(conn_id).async_metadata(
+                    loop,
+                    candidates,
+                    tags=tags,
+                    sort=sort,
+                    only_ids=only_ids,
+                    skip=skip,
+                    limit=limit,
+                    raw=True))
+            s_metadata['metadata'] = list(s_metadata['metadata'])
+            s_metadata['total'] = summary.pop('received')
+            return (summary, s_metadata)
+
         api_request['skip'] = api_request.get('skip') or 0
         api_request['limit'] = api_request.get('limit', None)
         if self.metadata and self.search:
-            results = await perform_search()
+            if (api_request['limit']
+                    and not api_request.get('uncooked')
+                    and not api_request.get('threads')):
+                results = await perform_streamed_search()
+            else:
+                results = await perform_search()
             if api_request.get('uncooked'):
                 return ResponseSearch(api_request, None, results)
             else:
@@ -759,15 +857,12 @@ main app worker. Hints:
 
         loop = asyncio.get_event_loop()
         async def perform_counts():
-            counts = {}
-            for terms in api_request['terms_list']:
-                result = await self.search.with_caller(conn_id).async_search(
-                    loop, terms,
-                    tag_namespace=tag_ns,
-                    more_terms=scope_s,
-                    mask_deleted=api_request.get('mask_deleted', True))
-                counts[terms] = dumb_decode(result['hits']).count()
-            return counts
+            result = await self.search.with_caller(conn_id).async_counts(
+                loop, api_request['terms_list'],
+                tag_namespace=tag_ns,
+                more_terms=scope_s,
+                mask_deleted=api_request.get('mask_deleted', True))
+            return result['counts']
 
         if self.search:
             return ResponseCounts(api_request, await perform_counts())
@@ -870,6 +965,72 @@ main app worker. Hints:
 
         return ResponseEmail(api_request, await get_email())
 
+    async def api_req_email_part(self, conn_id, access, api_request):
+        """
+        Fetch the decoded body of a single part of an e-mail, or a chunk
+        of it, so clients only pay for the attachments they actually use.
+        """
+        ctx = api_request.get('context') or self.config.CONTEXT_ZERO
+        # Will raise ValueError or NameError if access denied
+        roles, tag_ns, scope_s = access.grants(ctx, AccessConfig.GRANT_READ)
+
+        loop = asyncio.get_event_loop()
+        chunks = []
+        size = await self.storage.with_caller(conn_id).async_email_part(
+            loop,
+            api_request['metadata'],
+            api_request['part'],
+            chunks.append,
+            offset=api_request.get('offset') or 0,
+            length=api_request.get('length'),
+            username=api_request.get('username'),
+            password=api_request.get('password'))
+
+        return ResponseEmailPart(api_request, size, b''.join(chunks))
+
+    async def api_req_emails(self, conn_id, access, api_request):
+        """
+        Fetch the raw bytes of many e-mails at once, for bulk exports.
+        Requests are grouped by mailbox and spread over several storage
+        workers which run in parallel; the results are returned in the
+        same order as requested, as [idx, bytes] pairs (bytes are None for
+        any e-mails which could not be loaded).
+        """
+        ctx = api_request.get('context') or self.config.CONTEXT_ZERO
+        # Will raise ValueError or NameError if access denied
+        roles, tag_ns, scope_s = access.grants(ctx, AccessConfig.GRANT_READ)
+
+        metadata_list = [Metadata(*(m[:Metadata.OFS_HEADERS] + [b'']))
+            for m in api_request['metadata_list']]
+        by_mailbox = {}
+        for md in metadata_list:
+            ptr = md.pointers[0] if md.pointers else None
+            by_mailbox.setdefault(
+                ptr and ptr.get_container(), []).append(md)
+
+        groups = []
+        for mds in by_mailbox.values():
+            for i in range(0, len(mds), self.EMAILS_FETCH_BATCH):
+                groups.append(mds[i:i + self.EMAILS_FETCH_BATCH])
+
+        loop = asyncio.get_event_loop()
+        fetched = {}
+        def email_cb(idx, data):
+            fetched[idx] = data
+        async def get_emails(mds):
+            await self.storage.with_caller(conn_id).async_emails_raw(loop,
+                mds, email_cb,
+                username=api_request.get('username'),
+                password=api_request.get('password'))
+
+        for i in range(0, len(groups), self.EMAILS_FETCH_CONCURRENCY):
+            await asyncio.gather(*[
+                get_emails(mds)
+                for mds in groups[i:i + self.EMAILS_FETCH_CONCURRENCY]])
+
+        return ResponseEmails(api_request, [
+            [md.idx, fetched.get(md.idx)] for md in metadata_list])
+
     async def api_req_contexts(self, conn_id, access, api_request):
         # FIXME: Only return contexts this access level grants use of
         all_contexts = self.config.contexts
@@ -902,6 +1063,7 @@ main app worker. Hints:
                 self.config.change_master_key()
                 # FIXME: Check if user requested closing sessions
                 self.config.save()
+                self.config.flush()
                 return ResponseNotification({
                     # FIXME: Add trigger for a recovery dialog?
                     'message': 'Passphrase changed and keys rotated!'})
@@ -982,6 +1144,25 @@ main app worker. Hints:
 
         return ResponsePing(api_request)  # FIXME
 
+    def _import_backend(self, path):
+        """
+        Returns a (backend, concurrency) tuple, where backend identifies
+        the server or local device a mailbox lives on.
+        """
+        if path.startswith(b'imap:'):
+            import urllib.parse
+            server = urllib.parse.urlparse(path).netloc.rsplit(b'@', 1)[-1]
+            return str(server, 'utf-8'), self.IMPORT_CONCURRENCY_IMAP
+        while path:
+            try:
+                return os.stat(path).st_dev, self.IMPORT_CONCURRENCY_LOCAL
+            except OSError:
+                parent = os.path.dirname(path)
+                if parent == path:
+                    break
+                path = parent
+        return 'local', self.IMPORT_CONCURRENCY_LOCAL
+
     async def api_req_import(self, conn_id, access, api_request,
             config=None, ctx=None, paths=None):
         if not (self.metadata and self.search):
@@ -1020,55 +1201,74 @@ main app worker. Hints:
                 (_b(p), self._get_saved_credentials(api_request, p) or {})
                 for p in paths)
 
+        async def _probe(path):
+            async with probe_slots:
+                policy = context.get_path_policies(path, slim=False)[path]
+                rec = 1 if policy['watch_policy'] in ('watch', 'sync') else 0
+                return await self.storage.async_info(loop,
+                    path, details=True, recurse=rec, relpath=False,
+                    **credmap[path])
+
+        # Probe all the paths (and any subdirectories found) concurrently,
+        # a generation at a time.
         results = {}
         to_import = {}
-        recursed = set()
+        sizes = {}
+        probe_slots = asyncio.Semaphore(self.IMPORT_PROBE_CONCURRENCY)
+        paths = [_b(p) for p in paths]
+        seen = set(paths)
         while paths:
-            path = _b(paths.pop(0))
-            creds = credmap[path]
-            try:
-                policy = context.get_path_policies(path, slim=False)[path]
-
-                rec = 1 if policy['watch_policy'] in ('watch', 'sync') else 0
-                result = await self.storage.async_info(loop,
-                    path, details=True, recurse=rec, relpath=False, **creds)
-                if not result:
-                    logging.debug(
-                        '[api/import] Failed to get info for %s' % path)
-                    continue
-
-                contents = result.get('contents') or []
-                if 'contents' in result:
-                    del result['contents']
-
-                for r in [result] + contents:
-                    rpath = _b(r['path'])
-                    if (r is not result) and r.get('is_dir'):
-                        if (rpath not in paths) and (rpath != path):
-                            paths.append(rpath)
-                            credmap[rpath] = creds
-                    if r.get('magic'):
-                        ppol = context.get_path_policies(rpath).get(rpath, {})
-                        if only_inboxes and 'inbox' not in ppol['tags']:
-                            logging.debug(
-                                '[api/import] Not an Inbox: %s/%s' % (r, ppol))
-                            continue
-                        elif (not import_full
-                                and 'mtime' in r
-                                and ppol.get('updated')):
-                            if int(ppol['updated'], 16) >= r['mtime']:
-                                logging.debug(
-                                    '[api/import] Unchanged: %s' % (r['path'],))
-                                results[safe_str(rpath)] = {'unchanged': True}
+            infos = await asyncio.gather(
+                *[_probe(path) for path in paths],
+                return_exceptions=True)
+            probed, paths = paths, []
+            for path, result in zip(probed, infos):
+                creds = credmap[path]
+                try:
+                    if isinstance(result, Exception):
+                        raise result
+                    if not result:
+                        logging.debug(
+                            '[api/import] Failed to get info for %s' % path)
+                        continue
+
+                    contents = result.get('contents') or []
+                    if 'contents' in result:
+                        del result['contents']
+
+                    for r in [result] + contents:
+                        rpath = _b(r['path'])
+                        if (r is not result) and r.get('is_dir'):
+                            if rpath not in seen:
+                                seen.add(rpath)
+                                paths.append(rpath)
+                                credmap[rpath] = creds
+                        if r.get('magic'):
+                            ppol = context.get_path_policies(rpath)
+                            ppol = ppol.get(rpath, {})
+                            if only_inboxes and 'inbox' not in ppol['tags']:
+                                logging.debug('[api/import] Not an Inbox: %s/%s'
+                                    % (r, ppol))
                                 continue
-                        to_import[rpath] = ppol
-                        credmap[rpath] = creds
-            except NeedInfoException:
-                raise
-            except:
-                logging.exception('[api/import] Failed to check path %s' % path)
+                            elif (not import_full
+                                    and 'mtime' in r
+                                    and ppol.get('updated')):
+                                if int(ppol['updated'], 16) >= r['mtime']:
+                                    logging.debug('[api/import] Unchanged: %s'
+                                        % (r['path'],))
+                                    results[safe_str(rpath)] = {
+                                        'unchanged': True}
+                                    continue
+                            to_import[rpath] = ppol
+                            sizes[rpath] = r.get('size') or 0
+                            credmap[rpath] = creds
+                except NeedInfoException:
+                    raise
+                except:
+                    logging.exception(
+                        '[api/import] Failed to check path %s' % path)
 
-        def _import_path(context, req, path, policy, compact_now):
+        def _import_path(context, req, path, policy, queue):
             policy_tags = (policy.get('tags') or '').split(',')
             return self.importer.with_caller(conn_id).import_search(
                 RequestMailbox(
@@ -1078,16 +1278,28 @@ main app worker. Hints:
                     **credmap[path]),
                 policy_tags,
                 tag_namespace=context.tag_namespace,
-                compact=compact_now,
-                full=True)
-
-        plan = sorted(list(to_import.items()))
-        for i, (path, ppol) in enumerate(plan):
-            logging.debug('[api/import] Importing: %s with %s' % (path, ppol))
+                compact=compact,
+                full=True,
+                queue=queue)
+
+        # Import the stalest mailboxes first, and small before large. Each
+        # backend (disk or server) gets a limited number of import queues;
+        # the importer compacts once when all the queues are done.
+        def _staleness(item):
+            path, ppol = item
+            return (int(ppol.get('updated') or '0', 16), sizes[path], path)
+
+        backend_count = {}
+        for path, ppol in sorted(to_import.items(), key=_staleness):
+            backend, concurrency = self._import_backend(path)
+            count = backend_count[backend] = backend_count.get(backend, 0) + 1
+            queue = 'import %s/%d' % (backend, count % concurrency)
+
+            logging.debug('[api/import] Importing: %s with %s (queue=%s)'
+                % (path, ppol, queue))
             update_time = int(time.time())
             results[safe_str(path)] = await async_run_in_thread(
-                _import_path, context, api_request, path, ppol,
-                compact and (i+1 == len(plan)))
+                _import_path, context, api_request, path, ppol, queue)
             context.set_path_updated(path, '%x' % update_time)
 
         return ResponsePathImport(api_request, ctx, results)
@@ -1180,6 +1392,10 @@ main app worker. Hints:
             result = await self.api_req_tag(conn_id, access, api_req)
         elif type(api_req) == RequestEmail:
             result = await self.api_req_email(conn_id, access, api_req)
+        elif type(api_req) == RequestEmails:
+            result = await self.api_req_emails(conn_id, access, api_req)
+        elif type(api_req) == RequestEmailPart:
+            result = await self.api_req_email_part(conn_id, access, api_req)
         elif type(api_req) == RequestMailbox:
             result = await self.api_req_mailbox(conn_id, access, api_req)
         elif type(api_req) == RequestAnnotate:
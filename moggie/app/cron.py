@@ -12,6 +12,7 @@
 # logic to the crontab file so the user can see it and tweak it would be
 # a very nice thing.
 #
+import bisect
 import copy
 import datetime
 import logging
@@ -33,6 +34,33 @@ class Cron:
 
     FLAGS_RE = re.compile('^([^\\s:]*):\\s+')
 
+    # FIXME: i18n? Allow other languages in crontab? Or no?
+    DOW = {
+        'sun': 0, 'sunday': 0,
+        'mon': 1, 'monday': 1,
+        'tue': 2, 'tuesday': 2,
+        'wed': 3, 'wednesday': 3,
+        'thu': 4, 'thursday': 4,
+        'fri': 5, 'friday': 5,
+        'sat': 6, 'saturday': 6}
+    MONTHS = {
+        'jan': 1, 'january': 1,
+        'feb': 2, 'february': 2,
+        'mar': 3, 'march': 3,
+        'apr': 4, 'april': 4,
+        'may': 5,
+        'jun': 6, 'june': 6,
+        'jul': 7, 'july': 7,
+        'aug': 8, 'august': 8,
+        'sep': 9, 'september': 9, 'sept': 9,
+        'oct': 10, 'october': 10,
+        'nov': 11, 'november': 11,
+        'dec': 12, 'december': 12}
+
+    # Expanded time specifications, by (minutes, hours, ...) tuple
+    SPEC_CACHE = {}
+    SPEC_CACHE_MAX = 1000
+
     def __init__(self, moggie, encryption_keys, eval_env=None):
         ext = 'sqz' if encryption_keys else 'sq3'
         path = os.path.join(moggie.work_dir, 'crontab.%s' % ext)
@@ -43,29 +71,8 @@ class Cron:
         self._moggie = moggie
         self._external_moggie = Moggie(moggie.work_dir)
         self._eval_env_extra = eval_env
-
-        # FIXME: i18n? Allow other languages in crontab? Or no?
-        self.dow = {
-            'sun': 0, 'sunday': 0,
-            'mon': 1, 'monday': 1,
-            'tue': 2, 'tuesday': 2,
-            'wed': 3, 'wednesday': 3,
-            'thu': 4, 'thursday': 4,
-            'fri': 5, 'friday': 5,
-            'sat': 6, 'saturday': 6}
-        self.months = {
-            'jan': 1, 'january': 1,
-            'feb': 2, 'february': 2,
-            'mar': 3, 'march': 3,
-            'apr': 4, 'april': 4,
-            'may': 5,
-            'jun': 6, 'june': 6,
-            'jul': 7, 'july': 7,
-            'aug': 8, 'august': 8,
-            'sep': 9, 'september': 9, 'sept': 9,
-            'oct': 10, 'october': 10,
-            'nov': 11, 'november': 11,
-            'dec': 12, 'december': 12}
+        self.dow = self.DOW
+        self.months = self.MONTHS
 
     def configure_db(self):
         self.db.execute("""\
@@ -128,7 +135,30 @@ class Cron:
 
             return sorted(list(candidates))
 
-    def calculate_next(self,
+    @classmethod
+    def expand_spec(cls,
+            minutes=None, hours=None, month_days=None, months=None,
+            weekdays=None):
+        """
+        Expand a time specification into sorted lists of allowed minutes,
+        hours, days of the month, and sets of allowed months and weekdays.
+        Results are cached, as crontab rows get rescheduled over and over.
+        """
+        key = (minutes, hours, month_days, months, weekdays)
+        spec = cls.SPEC_CACHE.get(key)
+        if spec is None:
+            if len(cls.SPEC_CACHE) >= cls.SPEC_CACHE_MAX:
+                cls.SPEC_CACHE.clear()
+            spec = cls.SPEC_CACHE[key] = (
+                cls.cronspec(minutes, 60),
+                cls.cronspec(hours, 24),
+                cls.cronspec(month_days, 31, add=1),
+                set(cls.cronspec(months, 12, add=1, trans=cls.MONTHS)),
+                set(cls.cronspec(weekdays, 7, trans=cls.DOW)))
+        return spec
+
+    @classmethod
+    def calculate_next(cls,
             minutes=None, hours=None, month_days=None, months=None,
             weekdays=None,
             now=None):
@@ -153,6 +183,9 @@ class Cron:
         >>> nxt
         datetime.datetime(2023, 12, 15, 15, 0)
 
+        The result is the first matching minute after now, at most 366
+        days in the future. Instead of checking every minute, we skip
+        directly to the next allowed month, day, hour and minute.
         """
         from datetime import timedelta
 
@@ -161,30 +194,61 @@ class Cron:
         else:
             now = now or datetime.datetime.now()
 
-        eq = True
-        nxt = now.replace(second=0)
-        minute = timedelta(minutes=1)
-
-        loop_end = nxt + timedelta(days=366)
-
-        allowed_minutes = self.cronspec(minutes, 60)
-        allowed_hours = self.cronspec(hours, 24)
-        allowed_weekdays = self.cronspec(weekdays, 7, trans=self.dow)
-        allowed_month_days = self.cronspec(month_days, 31, add=1)
-        allowed_months = self.cronspec(months, 12, add=1, trans=self.months)
-
-        # This is a not very elegant or efficient; but it is easily
-        # understood to give correct results. For frequent events the loop
-        # won't get very far. Infrequent events take longer, but are also
-        # infrequent. So, yay?
-        while nxt < loop_end:
-            nxt += minute
-            if (nxt.minute in allowed_minutes
-                    and nxt.hour in allowed_hours
-                    and nxt.day in allowed_month_days
-                    and nxt.month in allowed_months
-                    and nxt.weekday() in allowed_weekdays):
-                return nxt
+        (allowed_minutes, allowed_hours, allowed_month_days,
+            allowed_months, allowed_weekdays) = cls.expand_spec(
+                minutes, hours, month_days, months, weekdays)
+
+        # Note: Like datetime arithmetic, this is all in wall-clock time.
+        first = now.replace(second=0) + timedelta(minutes=1)
+        last = first + timedelta(days=366, minutes=-1)
+
+        def _next_time(hour, minute):
+            # First allowed (hour, minute) at or after the given time
+            h = bisect.bisect_left(allowed_hours, hour)
+            if (h < len(allowed_hours)) and (allowed_hours[h] == hour):
+                m = bisect.bisect_left(allowed_minutes, minute)
+                if m < len(allowed_minutes):
+                    return hour, allowed_minutes[m]
+                h += 1
+            if (h < len(allowed_hours)) and allowed_minutes:
+                return allowed_hours[h], allowed_minutes[0]
+            return None
+
+        day = first.date()
+        hour, minute = first.hour, first.minute
+        while day <= last.date():
+            if day.month not in allowed_months:
+                day = (day.replace(day=1) + timedelta(days=32)).replace(day=1)
+                hour = minute = 0
+                continue
+
+            d = bisect.bisect_left(allowed_month_days, day.day)
+            if d >= len(allowed_month_days):
+                day = (day.replace(day=1) + timedelta(days=32)).replace(day=1)
+                hour = minute = 0
+                continue
+            if allowed_month_days[d] != day.day:
+                try:
+                    day = day.replace(day=allowed_month_days[d])
+                except ValueError:
+                    # Not that many days in this month
+                    day = (day.replace(day=1) + timedelta(days=32)
+                        ).replace(day=1)
+                hour = minute = 0
+                continue
+
+            if day.weekday() in allowed_weekdays:
+                hm = _next_time(hour, minute)
+                if hm is not None:
+                    nxt = first.replace(
+                        year=day.year, month=day.month, day=day.day,
+                        hour=hm[0], minute=hm[1])
+                    if nxt <= last:
+                        return nxt
+                    break
+
+            day += timedelta(days=1)
+            hour = minute = 0
 
         raise ValueError('No matching dates found, is spec valid?')
 
@@ -344,7 +408,9 @@ class Cron:
         if join:
             for at in threads:
                 at.join()
-        self.db.save()
+        if threads:
+            # Only rewrite the database if something was rescheduled
+            self.db.save()
 
     async def async_run_scheduled(self, context=None, join=True, now=None):
         threads = []
@@ -354,7 +420,8 @@ class Cron:
             for at in threads:
                 if at is not None:
                     at.join()
-        self.db.save()
+        if threads:
+            self.db.save()
 
     def schedule_action(self, action,
             minutes=None, hours=None, month_days=None, months=None,
@@ -1,3 +1,4 @@
+import base64
 import copy
 import logging
 import re
@@ -233,19 +234,28 @@ Technical details:
         self.send_email_request()
 
     def get_search_command(self):
-        if self.view == self.VIEW_SOURCE:
-            command = self.mog_ctx.show
+        return self.SearchCommand(self.mog_ctx, self.metadata,
+            view=self.view,
+            mailbox=self.mailbox,
+            username=self.username,
+            password=self.password)
+
+    @classmethod
+    def SearchCommand(cls, mog_ctx, metadata,
+            view=VIEW_EMAIL, mailbox=None, username=None, password=None):
+        if view == cls.VIEW_SOURCE:
+            command = mog_ctx.show
             args = ['--part=0']
 
-        elif self.view == self.VIEW_REPORT:
-            command = self.mog_ctx.parse
+        elif view == cls.VIEW_REPORT:
+            command = mog_ctx.parse
             args = [
                 '--with-everything=Y',
                 '--with-missing=Y',
                 '--format=text']
 
         else:
-            command = self.mog_ctx.parse
+            command = mog_ctx.parse
             args = [
                 # Reset to the bare minimum, we can as for more if the user
                 # wants it (and as the app evolves).
@@ -254,28 +264,28 @@ Technical details:
                 '--with-headers=Y',
                 '--with-structure=Y',
                 '--with-text=Y',
-                '--with-data=Y',    # FIXME: implement get_data!
+                '--with-part-info=Y',  # Attachments are fetched on demand
                 '--with-openpgp=Y',
                 '--ignore-index=N',
                 # We convert the HTML to text here, so we can wrap lines.
                 '--with-html-text=N',
                 '--with-html-clean=N',
                 '--with-html=Y']
-        if self.username:
-            args.append('--username=%s' % self.username)
-        if self.password:
-            args.append('--password=%s' % self.password)
+        if username:
+            args.append('--username=%s' % username)
+        if password:
+            args.append('--password=%s' % password)
 
         # This should be using the same logic as the emaillist tag search
         # term generation
-        if self.metadata.get('idx'):
-            args.append('id:%d' % self.metadata['idx'])
-            if self.mailbox and (self.metadata['idx'] >= IDX_MAX):
-                args.append('mailbox:%s' % self.mailbox)
+        if metadata.get('idx'):
+            args.append('id:%d' % metadata['idx'])
+            if mailbox and (metadata['idx'] >= IDX_MAX):
+                args.append('mailbox:%s' % mailbox)
         else:
             # FIXME: Sending the full metadata is silly. Also this is the
             #        parsed metadata, now the raw stuff.
-            args.append(to_json(self.metadata))
+            args.append(to_json(metadata))
 
         cache_id = sha1b64('%s' % args)
         return cache_id, command, args
@@ -446,7 +456,58 @@ Technical details:
             'Save or Open Attachment', self, att, filename)
 
     def get_data(self, att, callback=None):
-        logging.debug('FIXME: Should fetch attachment: %s' % att)
+        """
+        Fetch the data of a single attachment, adding it to the part as
+        _DATA and then invoking the callback.
+        """
+        parts = (self.email or {}).get('_PARTS', [])
+        p_idx = [i for i, p in enumerate(parts) if p is att]
+        if not p_idx:
+            logging.debug('Attachment not found: %s' % att)
+            return
+
+        def incoming_part(mog_ctx, message):
+            data = try_get(message, 'data', message)
+            if isinstance(data, list):
+                data = b''.join(data)
+            if isinstance(data, str):
+                data = bytes(data, 'utf-8')
+            att['_DATA'] = str(base64.b64encode(data), 'latin-1')
+            if callback:
+                callback()
+
+        def incoming_parsed(mog_ctx, message):
+            message = try_get(message, 'data', message)
+            if isinstance(message, list):
+                message = message[0]
+            parts = message['parsed']['_PARTS']
+            if '_DATA' in parts[p_idx[0]]:
+                att['_DATA'] = parts[p_idx[0]]['_DATA']
+            if callback:
+                callback()
+
+        def incoming_failed(mog_ctx, details):
+            logging.info('Load attachment failed: %s' % (
+                details.get('error') or details.get('exc_args'),))
+
+        # This part came from decrypting the message, so the storage layer
+        # cannot extract it for us; we re-parse with data instead.
+        decrypted = bool(att.get('_BUF'))
+
+        cache_id, command, args = self.SearchCommand(
+            self.mog_ctx, self.metadata,
+            view=(self.VIEW_EMAIL if decrypted else self.VIEW_SOURCE),
+            mailbox=self.mailbox,
+            username=self.username,
+            password=self.password)
+        if decrypted:
+            args[args.index('--with-part-info=Y')] = '--with-data=Y'
+            command(*args,
+                on_success=incoming_parsed, on_error=incoming_failed)
+        else:
+            args[0] = '--part=%d' % (p_idx[0] + 1)
+            command(*args,
+                on_success=incoming_part, on_error=incoming_failed)
 
     def on_forward(self):
         logging.debug('FIXME: User wants to forward')
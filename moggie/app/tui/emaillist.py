@@ -20,7 +20,7 @@ from ..suggestions import Suggestion
 
 from .choosetagdialog import ChooseTagDialog
 from .decorations import EMOJI
-from .emaildisplay import EmailDisplay
+from .emaildisplay import EmailDisplay, RESULT_CACHE
 from .messagedialog import MessageDialog
 from .searchdialog import SearchDialog
 from .suggestionbox import SuggestionBox
@@ -349,6 +349,9 @@ class EmailList(urwid.Pile):
         '#': ('+trash', 'Move to trash'),
         'Z': ('SNOOZE', 'Snooze messages')}
 
+    # How many messages before/after the one being read to prefetch
+    PREFETCH_NEIGHBOURS = 3
+
     def __init__(self, mog_ctx, tui, terms, view=None):
         self.name = 'emaillist-%.5f' % time.time()
         self.mog_ctx = mog_ctx
@@ -368,6 +371,7 @@ class EmailList(urwid.Pile):
             'K': [lambda *a: None, ('top_hk', 'K:'), 'Previous  ']}
 
         self.loading = 0
+        self.prefetching = 0
         self.want_more = True
         self.want_emails = 0
         self.total_available = None
@@ -387,6 +391,7 @@ class EmailList(urwid.Pile):
         self.update_content()
 
     def cleanup(self):
+        self.prefetching += 1
         self.mog_ctx.moggie.unsubscribe(self.name)
 
     def keypress(self, size, key):
@@ -513,6 +518,48 @@ class EmailList(urwid.Pile):
         tags = metadata.get('tags')
         if tags and 'in:read' not in tags:
             tags.append('in:read')
+        self.prefetch_neighbours(metadata)
+
+    def prefetch_neighbours(self, metadata):
+        """
+        Warm the parse caches (ours and the app's) with the messages
+        surrounding the one being read, so paging through the list is
+        quick. Requests are sent one at a time, nearest first. Opening
+        another message or closing the list cancels any still queued.
+        """
+        self.prefetching += 1
+        visible = self.walker.visible
+        uuids = [e['uuid'] for e in visible]
+        if metadata['uuid'] not in uuids:
+            return
+
+        pos = uuids.index(metadata['uuid'])
+        queue = []
+        for dist in range(1, self.PREFETCH_NEIGHBOURS + 1):
+            for i in (pos + dist, pos - dist):
+                if (0 <= i < len(visible)
+                        and visible[i].get('idx')
+                        and not visible[i].get('missing')):
+                    queue.append(visible[i])
+
+        self._prefetch_next(self.prefetching, queue)
+
+    def _prefetch_next(self, generation, queue):
+        while queue and (generation == self.prefetching):
+            cache_id, command, args = EmailDisplay.SearchCommand(
+                self.mog_ctx, queue.pop(0), mailbox=self.is_mailbox)
+            if cache_id in RESULT_CACHE:
+                continue
+
+            def prefetched(mog_ctx, message):
+                RESULT_CACHE[cache_id] = (time.time(), message)
+                self._prefetch_next(generation, queue)
+
+            def prefetch_failed(mog_ctx, details):
+                self._prefetch_next(generation, queue)
+
+            command(*args, on_success=prefetched, on_error=prefetch_failed)
+            return
 
     def load_more(self, first=False):
         now = time.time()
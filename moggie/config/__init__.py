@@ -1,3 +1,4 @@
+import atexit
 import binascii
 import base64
 import copy
@@ -39,6 +40,19 @@ LOGDIR     = '/tmp/moggie.%d' % os.getuid()
 
 CACHE_VERSION = int(time.time() * 10) % (30 * 24 * 36000)
 
+# Configs with saves waiting to be written to disk, flushed on exit
+PENDING_SAVES = {}
+
+
+def flush_pending_saves():
+    for config in list(PENDING_SAVES.values()):
+        try:
+            config.flush()
+        except (OSError, IOError):
+            logging.exception('Failed to save %s' % config.filepath)
+
+atexit.register(flush_pending_saves)
+
 
 def configure_logging(
         worker_name=APPNAME,
@@ -367,6 +381,7 @@ class ContextConfig(ConfigSectionProxy):
         self._secrets = DictItemProxy(self.config, self.config_key, 'secrets')
         self._tags_list = EncodingListItemProxy(self.config, self.config_key, 'tags')
         self._utags_list = EncodingListItemProxy(self.config, self.config_key, 'ui_tags')
+        self._path_policy_cache = None
 
     accounts = property(lambda self: self._accts_list)
     identities = property(lambda self: self._ids_list)
@@ -504,6 +519,7 @@ class ContextConfig(ConfigSectionProxy):
             return ee.endswith(b'::::::')
 
         with self.paths:
+            self._path_policy_cache = None
             for idx, path_policy in enumerate(self.paths):
                 if isinstance(path_policy, str):
                     path_policy = bytes(path_policy, 'utf-8')
@@ -547,6 +563,90 @@ class ContextConfig(ConfigSectionProxy):
     def set_path_updated(self, path, updated):
         self.set_path(path, updated=updated, _partial=True)
 
+    def _path_policy_index(self):
+        """
+        Returns a (policies, tree, memo) tuple, where the tree indexes
+        policies by path component. Rebuilt whenever the config changes.
+        """
+        cache = self._path_policy_cache
+        if cache is None or cache[0] != CACHE_VERSION:
+            policies = []
+            tree = [{}, []]
+            for idx, path_policy in enumerate(self.paths):
+                if isinstance(path_policy, str):
+                    path_policy = bytes(path_policy, 'utf-8')
+                policy = path_policy.rsplit(b':', 6)
+                policies.append(policy)
+                node = tree
+                for part in policy[0].split(b'/'):
+                    if part not in node[0]:
+                        node[0][part] = [{}, []]
+                    node = node[0][part]
+                node[1].append(idx)
+            cache = self._path_policy_cache = (
+                CACHE_VERSION, policies, tree, {})
+        return cache[1:]
+
+    @classmethod
+    def _merge_path_tags(cls, itags, ftags, inherit):
+        tags = ftags.split(b',')
+        if not inherit:
+            return b','.join(sorted(tags))
+        elif b'-' in tags or not itags:
+            return b','.join(sorted([t for t in tags if t != b'-']))
+        else:
+            tags += itags.split(b',')
+            return b','.join(sorted([t for t in set(tags) if t != b'-']))
+
+    @classmethod
+    def _merge_path_policy(cls, parents, policy, inherit):
+        combined = [None, None, None, None, None, None, None]
+        for parent in parents:
+            for i, p in enumerate(parent):
+                if i < 2 or i > 5:  # Ignore path, label, updated
+                    pass
+                elif p == b'-':
+                    combined[i] = None
+                elif p and (i == 3):
+                    combined[i] = cls._merge_path_tags(combined[i], p, True)
+                elif p:
+                    combined[i] = p
+        for i, p in enumerate(policy or []):
+            if inherit and (p == b'-'):
+                combined[i] = None
+            elif p and (i == 3):
+                combined[i] = cls._merge_path_tags(combined[i], p, inherit)
+            elif p:
+                combined[i] = p
+        return combined
+
+    def _path_policy(self, path, inherit):
+        policies, tree, memo = self._path_policy_index()
+        key = (path, inherit)
+        if key not in memo:
+            # Walk the tree, collecting policies from parent directories
+            # and the (first) policy for the path itself.
+            parts = path.split(b'/')
+            parents, exact, node = [], [], tree
+            for depth, part in enumerate(parts):
+                node = node[0].get(part)
+                if node is None:
+                    break
+                elif depth < len(parts) - 1:
+                    parents.extend(node[1])
+                else:
+                    exact = node[1]
+
+            # Parents configured after the path itself are not inherited,
+            # this only matters if the policy list was not sorted.
+            last = exact[0] if exact else len(policies)
+            parents = [policies[i] for i in sorted(parents) if i < last]
+            memo[key] = self._merge_path_policy(
+                parents if inherit else [],
+                policies[exact[0]] if exact else None,
+                inherit)
+        return memo[key]
+
     def get_path_policies(self, *paths, inherit=True, slim=True):
         """
         Generate policies for one or more paths.
@@ -560,65 +660,19 @@ class ContextConfig(ConfigSectionProxy):
         paths = [
             (bytes(path, 'utf-8') if isinstance(path, str) else path)
             for path in paths]
-        if not paths:
-            paths = [False]
-
-        def _tags(itags, ftags):
-            tags = ftags.split(b',')
-            if not inherit:
-                return b','.join(sorted(tags))
-            elif b'-' in tags or not itags:
-                return b','.join(sorted([t for t in tags if t != b'-']))
-            else:
-                tags += itags.split(b',')
-                return b','.join(sorted([t for t in set(tags) if t != b'-']))
 
         # Note: The number of elements and order must match what is used
         #       in add_path() above, except attrs omits the path itself.
         attrs = ['label', 'account', 'tags', 'watch_policy', 'copy_policy',
                  'updated']
-        blank_policy = [None, None, None, None, None, None, None]
-        inherited = dict((path, copy.copy(blank_policy)) for path in paths)
-        found = {}
-        for path_policy in self.paths:
-            if isinstance(path_policy, str):
-                path_policy = bytes(path_policy, 'utf-8')
-            policy = path_policy.rsplit(b':', 6)
-            ppath = policy[0]
-            done = []
-            for path in paths:
-                if (ppath == path) or (path is False):
-                    found[ppath] = policy
-                    if ppath not in inherited:
-                        inherited[ppath] = copy.copy(blank_policy)
-                    if path:
-                        done.append(path)
-                elif inherit and path.startswith(policy[0] + b'/'):
-                    for i, p in enumerate(policy):
-                        if i < 2 or i > 5:  # Ignore path, label, updated
-                            pass
-                        elif p == b'-':
-                            inherited[path][i] = None
-                        elif p and (i == 3):
-                            inherited[path][i] = _tags(inherited[path][i], p)
-                        elif p:
-                            inherited[path][i] = p
-            for path in done:
-                paths.remove(path)
-            if not paths:
-                break
-
-        if False in inherited:
-            del inherited[False]
-        combined = copy.deepcopy(inherited)
-        for path, policy in found.items():
-            for i, p in enumerate(policy):
-                if inherit and (p == b'-'):
-                    combined[path][i] = None
-                elif p and (i == 3):
-                    combined[path][i] = _tags(combined[path][i], p)
-                elif p:
-                    combined[path][i] = p
+        if paths:
+            combined = dict(
+                (path, self._path_policy(path, inherit)) for path in paths)
+        else:
+            policies = self._path_policy_index()[0]
+            combined = dict(
+                (policy[0], self._merge_path_policy([], policy, inherit))
+                for policy in policies)
 
         if slim:
             def _slim(pairs):
@@ -697,10 +751,18 @@ class AppConfig(ConfigParser):
         IDENTITY_PREFIX,
         CONTEXT_PREFIX]
 
-    def __init__(self, profile_dir):
+    def __init__(self, profile_dir, save_delay=0):
         self.lock = threading.RLock()
         self.suppress_saves = []
 
+        # If save_delay is set, writes get deferred and coalesced
+        self.save_delay = save_delay
+        self.save_timer = None
+        self.save_pending = False
+
+        # Decrypted values, by (section, option)
+        self._decoded = {}
+
         global LOGDIR
         LOGDIR = os.path.join(profile_dir, 'logs')
 
@@ -784,6 +846,7 @@ class AppConfig(ConfigParser):
     def get_ephemeral_snapshot(self):
         with self.lock:
             self.save()
+            self.flush()
             tmp_cfg = EphemeralAppConfig(self.profile_dir)
             tmp_cfg.aes_key = self.aes_key
         return tmp_cfg
@@ -907,7 +970,11 @@ class AppConfig(ConfigParser):
                    if now - os.path.getmtime(dest) > min_age:
                        os.remove(dest)
                 if not os.path.exists(dest):
-                    os.rename(src, dest)
+                    if i > 0:
+                        os.rename(src, dest)
+                    else:
+                        # Keep the live config in place, save() replaces it
+                        os.link(src, dest)
                 last_min_age = min_age
 
         self.last_rotate = now
@@ -922,24 +989,58 @@ class AppConfig(ConfigParser):
         CACHE_VERSION += 1
         self._caches = {}
 
-        sections = list(self.keys())
-        sections.sort(key=lambda k: (
-            self.ALLOWED_SECTIONS.index(k)
-            if k in self.ALLOWED_SECTIONS else 99+len(k)))
-
-        reordered = {}
-        for section in sections:
-            if len(self[section]) == 0:
-                self.remove_section(section)
-            else:
-                reordered[section] = self._sections[section]
-        self._sections = reordered
+        with self.lock:
+            sections = list(self.keys())
+            sections.sort(key=lambda k: (
+                self.ALLOWED_SECTIONS.index(k)
+                if k in self.ALLOWED_SECTIONS else 99+len(k)))
+
+            reordered = {}
+            for section in sections:
+                if len(self[section]) == 0:
+                    self.remove_section(section)
+                else:
+                    reordered[section] = self._sections[section]
+            self._sections = reordered
+
+            self.save_pending = True
+            PENDING_SAVES[id(self)] = self
+            if self.save_delay <= 0:
+                self.flush()
+            elif self.save_timer is None:
+                self.save_timer = threading.Timer(self.save_delay, self.flush)
+                self.save_timer.daemon = True
+                self.save_timer.start()
+
+    def flush(self):
+        """
+        Write any pending changes to disk. The new config is written to
+        a temporary file, which then replaces the old one, so readers
+        never see a partially written config.
+        """
+        with self.lock:
+            if self.save_timer is not None:
+                self.save_timer.cancel()
+                self.save_timer = None
+            if not self.save_pending:
+                PENDING_SAVES.pop(id(self), None)
+                return False
+            # Only forget the changes once they are safely on disk, so a
+            # failed write gets retried by the next save or at exit.
+            self._write_config()
+            self.save_pending = False
+            PENDING_SAVES.pop(id(self), None)
+            return True
 
+    def _write_config(self):
+        tmpfile = self.filepath + '.tmp'
+        fd = os.open(tmpfile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with open(fd, 'w') as out:
+            out.write(self.PREAMBLE)
+            self.write(out)
+        os.chmod(tmpfile, 0o600)
         self.rotate()
-        with open(self.filepath, 'w') as fd:
-            fd.write(self.PREAMBLE)
-            self.write(fd)
-        os.chmod(self.filepath, 0o600)
+        os.replace(tmpfile, self.filepath)
         #logging.debug('Saved config(%s):\n%s' % (
         #    self.filepath,
         #    ''.join(traceback.format_stack()[-5:-1])))
@@ -961,6 +1062,7 @@ class AppConfig(ConfigParser):
         #        incrementally ask the user to ratchet up their security
         #        posture, rotating keys as we do so. So this needs to
         #        change! Also, we have Passcrow now.
+        self.flush()
         pass_key = make_aes_key(
             stretch_with_scrypt(
                 bytes(passphrase, 'utf-8'), b'config',
@@ -997,6 +1099,8 @@ class AppConfig(ConfigParser):
         self.set_private(self.SECRETS, mk_key, generate_passcode())
         # Record this, in case we want to auto-rotate keys now and then?
         self[self.SECRETS]['last_key_rotation'] = '%d' % int(time.time())
+        # Losing a key would be bad, don't wait for the write-behind
+        self.flush()
 
     def change_master_key(self):
         for suffix in ('_%d' % i for i in range(1, 1000)):
@@ -1006,6 +1110,7 @@ class AppConfig(ConfigParser):
         return False
 
     def change_config_key(self, new_passphrase):
+        self.flush()
         with self:
             old_aes_key = self.aes_key
             self.aes_key = None
@@ -1069,10 +1174,23 @@ class AppConfig(ConfigParser):
         if isinstance(val, str) and val[:2] == '::':
             if permerror and not self.aes_key:
                 raise PermissionError('AES key is not set')
-            val = dumb_decode(val[2:], aes_key=self.aes_key)
+            key = (section, option)
+            cached = self._decoded.get(key)
+            if cached and cached[0] == val and cached[1] == self.aes_key:
+                val = cached[2]
+            else:
+                decoded = dumb_decode(val[2:], aes_key=self.aes_key)
+                self._decoded[key] = (val, self.aes_key, decoded)
+                val = decoded
+            if isinstance(val, (list, dict, set)):
+                val = copy.deepcopy(val)
         return val
 
     def set(self, section, option, value=None, save=True, delete=True):
+        with self.lock:
+            return self._set(section, option, value, save, delete)
+
+    def _set(self, section, option, value, save, delete):
         if not self.has_section(section):
             if self.allowed_section(section):
                 self.add_section(section)
@@ -1081,6 +1199,7 @@ class AppConfig(ConfigParser):
             return self.set_private(section, option,
                 value=value, save=save, delete=delete)
 
+        self._decoded.pop((section, option), None)
         if value is not None:
             encoded = dumb_encode_asc(value)
             if encoded[:1] != 'U':
@@ -1100,8 +1219,13 @@ class AppConfig(ConfigParser):
         return super()._write_section(fp, section_name, section_items, delimiter)
 
     def set_private(self, section, option, value=None, save=True, delete=True):
+        with self.lock:
+            return self._set_private(section, option, value, save, delete)
+
+    def _set_private(self, section, option, value, save, delete):
         if self.key_desc(section, option) not in self.keep_private:
             self.keep_private.add(self.key_desc(section, option))
+        self._decoded.pop((section, option), None)
         if value is not None:
             encoded = '::' + dumb_encode_asc(value, aes_key_iv=self._aes_key_iv())
             super().set(section, option, value=encoded)
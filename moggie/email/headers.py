@@ -133,6 +133,58 @@ HWP_TOKEN_RE = re.compile(r'^([a-zA-Z0-9_-]+)', flags=re.DOTALL)
 HWP_PARAM_RE = re.compile(r'(;\s*([a-zA-Z0-9_-]+)=(\"(?:\\.|[^"\\]+)+\"|[^;\(]+))', flags=re.DOTALL)
 HWP_COMMENT_RE = re.compile(r'^(;?\s*\(([^\(]*)\))', flags=re.DOTALL)
 
+# The overwhelmingly common date format: Tue, 02 Aug 2022 19:03:42 +0000
+RFC2822_DATE_RE = re.compile(
+    r'\s*(?:[A-Za-z]{3},\s*)?(\d{1,2})\s+([A-Za-z]{3})\s+(\d{4})\s+'
+    r'(\d\d):(\d\d)(?::(\d\d))?\s+([-+])(\d\d)(\d\d)(?:\s|$)',
+    flags=re.ASCII)
+
+RFC2822_MONTHS = dict((m, i+1) for i, m in enumerate((
+    'jan', 'feb', 'mar', 'apr', 'may', 'jun',
+    'jul', 'aug', 'sep', 'oct', 'nov', 'dec')))
+
+# Cache of time.mktime() results, by (year, month, day, hour)
+_MKTIME_HOUR_CACHE = {}
+_MKTIME_HOUR_CACHE_MAX = 10000
+
+
+def parse_date(value):
+    """
+    Parse an RFC 2822 date, returning a (timestamp, tz_offset) tuple.
+    Raises ValueError or TypeError if the date cannot be parsed.
+
+    The results are the same as from email.utils.parsedate_tz, followed by
+    time.mktime(), but the most common format is parsed using a regular
+    expression and the mktime() results are cached by the hour. This makes
+    a big difference when scanning large mailboxes.
+
+    >>> parse_date('Thu, 01 Jan 1970 01:00:10 +0100')[1]
+    3600
+    >>> parse_date('Thu, 01 Jan 1970 01:00:10 +0100') == parse_date(
+    ...     'Thursday, 1 January 1970 01:00:10 +0100')
+    True
+    """
+    m = RFC2822_DATE_RE.match(value)
+    if m is not None:
+        mon = RFC2822_MONTHS.get(m.group(2).lower())
+        mm, ss = int(m.group(5)), int(m.group(6) or 0)
+        if mon and (mm < 60) and (ss < 60):
+            key = (int(m.group(3)), mon, int(m.group(1)), int(m.group(4)))
+            ts = _MKTIME_HOUR_CACHE.get(key)
+            if ts is None:
+                if len(_MKTIME_HOUR_CACHE) >= _MKTIME_HOUR_CACHE_MAX:
+                    _MKTIME_HOUR_CACHE.clear()
+                ts = _MKTIME_HOUR_CACHE[key] = int(
+                    time.mktime(key + (0, 0, 0, 1, -1)))
+            tz = int(m.group(8)) * 3600 + int(m.group(9)) * 60
+            if m.group(7) == '-':
+                tz = -tz
+            return (ts + (mm * 60) + ss - tz, tz)
+
+    tt = parsedate_tz(value)
+    tz = tt[9]
+    return (int(time.mktime(tt[:9])) - tz, tz)
+
 
 def parse_parameters(hdr, value_re=HWP_VALUE_RE, unspace=False):
     """
@@ -198,9 +250,7 @@ def parse_received(header_value):
     try:
         fields, date = [f.strip() for f in header_value.rsplit(';', 1)]
         try:
-            tt = parsedate_tz(date)
-            tz = tt[9]
-            ts = int(time.mktime(tt[:9])) - tz
+            ts, tz = parse_date(date)
         except (ValueError, TypeError):
             ts = tz = None
     except ValueError:
@@ -302,9 +352,7 @@ def parse_header(raw_header, default_charset='utf-8'):
 
             if hdr == 'date':
                 try:
-                    tt = parsedate_tz(val)
-                    tz = tt[9]
-                    ts = int(time.mktime(tt[:9])) - tz
+                    ts, tz = parse_date(val)
                     if ts > 0:
                         headers['_DATE_TS'] = ts
                         headers['_DATE_TZ'] = tz
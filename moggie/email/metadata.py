@@ -1,11 +1,10 @@
-import email.utils
 import hashlib
 import re
 import time
 
 from ..storage.formats import tag_path, split_tagged_path
 from ..util.dumbcode import dumb_decode, dumb_encode_asc, dumb_encode_bin, from_json
-from .headers import parse_header
+from .headers import parse_header, parse_date
 
 
 class Metadata(list):
@@ -28,8 +27,15 @@ class Metadata(list):
 
     # These are the headers we want extracted and stored in metadata.
     # Note the Received headers are omitted, too big and too much noise.
-    HEADER_RE = re.compile(b'(?:^|\n)(' +
-            b'(?:Date|Message-ID|In-Reply-To|From|To|Cc|Subject):\n?' +
+    HEADER_NAMES = (
+        b'Date', b'Message-ID', b'In-Reply-To', b'From', b'To', b'Cc',
+        b'Subject')
+
+    # Note: Every header must be preceded by a newline, including the first
+    #       one. Anchoring on a plain newline lets the regexp engine skip
+    #       quickly from line to line, instead of trying every position.
+    HEADER_RE = re.compile(b'\n(' +
+            b'(?:' + b'|'.join(HEADER_NAMES) + b'):\n?' +
             b'(?:[^\n]+\n\\s+)*[^\n]+' +
         b')',
         flags=(re.IGNORECASE + re.DOTALL))
@@ -110,8 +116,7 @@ class Metadata(list):
             date = self.get_raw_header_str('Date')
             if date:
                 try:
-                    tt = email.utils.parsedate_tz(date)
-                    self[0] = int(time.mktime(tt[:9])) - tt[9]
+                    self[0] = parse_date(date)[0]
                 except (ValueError, TypeError):
                     pass
 
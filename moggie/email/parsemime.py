@@ -1,5 +1,6 @@
 import binascii
 import base64
+import hashlib
 import re
 
 from .headers import parse_header
@@ -18,10 +19,14 @@ class MessagePart(dict):
     provide data (raw or decoded).
     """
     ESCAPED_FROM = re.compile(r'(^|\n)\>(\>*From)')
+    BASE64_JUNK = bytes(c for c in range(0, 256) if c not in
+        b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/=')
+    CHUNK_BYTES = 1024 * 1024
 
     def __init__(self, msg_bin, fix_mbox_from=False, inherit=None):
         self.inherit = inherit or {}
         self.msg_bin = [msg_bin]
+        self.cleaned_base64 = {}
         self.fix_mbox_from = fix_mbox_from
         self.hend = len(msg_bin)
         self.eol = b'\n'
@@ -218,6 +223,32 @@ class MessagePart(dict):
 
         return raw_data
 
+    def _clean_base64(self, part):
+        """
+        Return the base64 data of a part, minus whitespace and any other
+        junk, truncated and padded the same way b64decode() would.
+        """
+        clean = self._raw(part).translate(None, self.BASE64_JUNK)
+        pad = clean.find(b'=')
+        if pad >= 0:
+            clean = clean[:pad] + b'=' * ((4 - pad % 4) % 4)
+        return clean
+
+    def _size(self, part, clean=None):
+        """
+        Return the size of the decoded part body, without decoding it
+        unless it is quoted-printable. Callers which already have the
+        cleaned base64 data can pass it in as clean.
+        """
+        encoding = part['content-transfer-encoding'].lower()
+        if encoding == 'base64':
+            if clean is None:
+                clean = self._clean_base64(part)
+            return (len(clean.rstrip(b'=')) * 3) // 4
+        if encoding == 'quoted-printable':
+            return len(self._bytes(part))
+        return part['_BYTES'][2] - part['_BYTES'][1]
+
     def _base64(self, part):
         encoding = part['content-transfer-encoding'].lower()
         if encoding == 'base64':
@@ -250,6 +281,72 @@ class MessagePart(dict):
         """
         return self._bytes(self.with_structure(recurse=recurse)['_PARTS'][idx])
 
+    def iter_part_body(self, idx,
+            offset=0, length=None, chunk_size=None, recurse=True):
+        """
+        Decode the body of a single part of the message (as bytes), from
+        offset onwards, yielding it in chunks of at most chunk_size bytes.
+        Only the requested range is decoded, so large attachments can
+        be fetched piecemeal.
+        """
+        part = self.with_structure(recurse=recurse)['_PARTS'][idx]
+        return self._iter_body(part, offset, length, chunk_size)
+
+    def part_size_and_body(self, idx,
+            offset=0, length=None, chunk_size=None, recurse=True):
+        """
+        Return a (size, chunks) tuple: the size of the entire decoded body
+        of a single part, and an iterator which yields the body (or the
+        requested range of it) as iter_part_body() does. Base64 data is
+        only cleaned once, and kept for later calls, so a large part can
+        be fetched range by range without redoing that work.
+        """
+        part = self.with_structure(recurse=recurse)['_PARTS'][idx]
+        clean = None
+        if part['content-transfer-encoding'].lower() == 'base64':
+            clean = self.cleaned_base64.get((idx, recurse))
+            if clean is None:
+                clean = self._clean_base64(part)
+                self.cleaned_base64[(idx, recurse)] = clean
+        return (self._size(part, clean=clean),
+            self._iter_body(part, offset, length, chunk_size, clean=clean))
+
+    def _iter_body(self, part, offset, length, chunk_size, clean=None):
+        chunk_size = chunk_size or self.CHUNK_BYTES
+        encoding = part['content-transfer-encoding'].lower()
+        end = None if (length is None) else (offset + length)
+
+        if encoding == 'base64':
+            if clean is None:
+                clean = self._clean_base64(part)
+            skip = offset % 3
+            pos = (offset // 3) * 4
+            step = max(4, (chunk_size // 3) * 4)
+            while (end is None) or (offset < end):
+                block = clean[pos:pos + step]
+                if not block:
+                    break
+                data = base64.b64decode(block)[skip:]
+                if end is not None:
+                    data = data[:end - offset]
+                if not data:
+                    break
+                yield data
+                offset += len(data)
+                pos += step
+                skip = 0
+            return
+
+        if encoding == 'quoted-printable':
+            body = self._bytes(part)
+        else:
+            body = memoryview(self.msg_bin[part['_BUF']])[
+                part['_BYTES'][1]:part['_BYTES'][2]]
+        end = len(body) if (end is None) else min(end, len(body))
+        while offset < end:
+            yield bytes(body[offset:min(end, offset + chunk_size)])
+            offset += chunk_size
+
     def part_text(self, idx, recurse=True, mime_types=[]):
         """
         Return decoded text of the message (as unicode).
@@ -293,6 +390,22 @@ class MessagePart(dict):
                     part['_DATA'] = str(self._base64(part), 'latin-1')
         return self
 
+    def with_descriptors(self, recurse=True):
+        """
+        Add _SIZE and _SHA256 elements to each part (except multipart/),
+        describing the decoded size of the part body and a hash of its
+        raw (encoded) contents. Together with _BYTES and the transfer
+        encoding, this lets callers decide whether (and how) to fetch a
+        part's data with iter_part_body(), without decoding it here.
+        """
+        self.with_structure(recurse=recurse)
+        for part in self['_PARTS']:
+            ct, ctp = part.get('content-type', ['', {}])
+            if '_SIZE' not in part and not ct.startswith('multipart/'):
+                part['_SIZE'] = self._size(part)
+                part['_SHA256'] = hashlib.sha256(self._raw(part)).hexdigest()
+        return self
+
     def with_full_raw(self):
         """
         Add a _RAW elements for the complete, unparsed message.
@@ -668,6 +781,17 @@ Trailing garbage!
     assert('_TEXT' not in p['_PARTS'][9])
     assert('_DATA' in p['_PARTS'][9])
     assert('Trailing garbage!' in p.part_text(9))
+
+    p.with_descriptors()
+    for i, part in enumerate(p['_PARTS']):
+        if part['_BUF'] == 0 and '_SIZE' in part:
+            body = p.part_body(i)
+            assert(part['_SIZE'] == len(body))
+            for off, ln, cs in ((0, None, 1), (1, 5, 2), (4, 100, 3)):
+                chunks = list(p.iter_part_body(i, off, ln, chunk_size=cs))
+                assert(b''.join(chunks) == body[off:(off+ln) if ln else None])
+                assert(max([len(c) for c in chunks] or [0]) <= max(cs, 3))
+    assert('_SIZE' not in p['_PARTS'][0])
     print('Tests OK')
 
     from email.parser import BytesParser, BytesFeedParser
@@ -1,11 +1,10 @@
 import logging
 import re
 import time
-import email.utils
 import hashlib
 import struct
 
-from .headers import parse_header
+from .headers import parse_header, parse_date
 from .metadata import Metadata
 
 
@@ -95,7 +94,8 @@ def unpack_maildir_idx(idx):
 
 
 def quick_msgparse(obj, beg):
-    sep = b'\r\n\r\n' if (b'\r\n' in obj[beg:beg+256]) else b'\n\n'
+    crlf = (obj.find(b'\r\n', beg, beg+256) >= 0)
+    sep = b'\r\n\r\n' if crlf else b'\n\n'
 
     hend = obj.find(sep, beg, beg+102400)
     if hend < 0:
@@ -104,12 +104,12 @@ def quick_msgparse(obj, beg):
 
     # Note: This is fast! We deliberately do not sort, as the order of
     #       headers is one of the things that makes messages unique.
-    hdrs = (b'\n'.join(
-                h.strip()
-                for h in re.findall(Metadata.HEADER_RE, obj[beg:hend]))
-        ).replace(b'\r', b'')
+    #       Metadata.HEADER_RE expects a newline before each header.
+    hdrs = b'\n'.join([
+            h.strip()
+            for h in Metadata.HEADER_RE.findall(b'\n' + obj[beg:hend])])
 
-    return hend, hdrs
+    return hend, hdrs.replace(b'\r', b'')
 
 
 def make_ts_and_Metadata(now, lts, raw_headers, *args):
@@ -129,9 +129,7 @@ def make_ts_and_Metadata(now, lts, raw_headers, *args):
     if raw_headers[:5] == 'From ':
         dt = raw_headers.split('\n', 1)[0].split('  ', 1)[-1].strip()
         try:
-            tt = email.utils.parsedate_tz(dt)
-            ts = int(time.mktime(tt[:9])) - tt[9]
-            md[md.OFS_TIMESTAMP] = ts
+            md[md.OFS_TIMESTAMP] = parse_date(dt)[0]
             return (max(lts, md.timestamp), md)
         except (ValueError, TypeError):
             pass
@@ -140,9 +138,7 @@ def make_ts_and_Metadata(now, lts, raw_headers, *args):
     rcvd_ts = []
     for rcvd in parse_header(raw_headers).get('received', []):
         try:
-            tt = email.utils.parsedate_tz(rcvd['date'])
-            ts = int(time.mktime(tt[:9])) - tt[9]
-            rcvd_ts.append(ts)
+            rcvd_ts.append(parse_date(rcvd['date'])[0])
         except (ValueError, TypeError):
             pass
     if rcvd_ts:
@@ -220,3 +216,34 @@ From: Daniel Huigens <d.huigens=40protonmail.com@dmarc.ietf.org>
         pass
 
     print('Tests passed OK')
+
+    # Micro-benchmark: scan the headers of our test e-mails (or any files
+    # named on the command line, e.g. mbox files) and extract metadata.
+    import glob, os, sys
+    paths = sys.argv[1:] or glob.glob(os.path.join(
+        os.path.dirname(__file__), '..', '..', 'test-data', 'emails', 'cur', '*'))
+    messages = []
+    for path in paths:
+        with open(path, 'rb') as fd:
+            data = fd.read()
+        beg = 0
+        while 0 <= beg < len(data):
+            messages.append((data, beg))
+            beg = data.find(b'\nFrom ', beg + 1)
+            beg = (beg + 1) if (beg > 0) else -1
+
+    count = max(1, 50000 // len(messages))
+    ptr = Metadata.PTR(0, b'/dev/null', 0)
+    t0 = time.time()
+    for i in range(0, count):
+        parsed = [quick_msgparse(data, beg) for data, beg in messages]
+    t1 = time.time()
+    for i in range(0, count):
+        for hend, hdrs in (p for p in parsed if p):
+            make_ts_and_Metadata(now, 0, hdrs, [ptr], hdrs)
+    t2 = time.time()
+    total = count * len(messages)
+    print(' * quick_msgparse x %d = %.2fs (%.1fus/msg)'
+        % (total, t1-t0, 1000000 * (t1-t0) / total))
+    print(' * make_ts_and_Metadata x %d = %.2fs (%.1fus/msg)'
+        % (total, t2-t1, 1000000 * (t2-t1) / total))
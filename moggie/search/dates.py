@@ -1,3 +1,4 @@
+import calendar
 import datetime
 import logging
 import time
@@ -51,6 +52,77 @@ def ts_to_keywords(msg_ts, kw_date=None):
         'date:%s-%s-%s' % (mdate.year, mdate.month, mdate.day)]
 
 
+def date_term_range(term):
+    """
+    Parse a date search term into a (start, end) range of [year, month, day]
+    lists, both inclusive, or return IntSet.All if it matches everything.
+
+    Raises ValueError (or similar) if the term cannot be parsed.
+    """
+    word = term.split(':', 1)[1].lower()
+    if word == 'recent':
+        word = '13d..today'  # FIXME: Is 2 weeks recent?
+    if '..' in word:
+        start, end = word.split('..')
+        if (not start) and end in ('today', '0d', '0w', '0m', '0q', '0y', ''):
+            return IntSet.All
+        if not end:
+            end = 'today'
+        if not start:
+            start = '20y'  # FIXME: This is incorrect
+    else:
+        start = end = word
+
+    if end in _date_offsets:
+        end = _mk_date(time.time() - _date_offsets[end]*24*3600)
+    elif end[-1:] in _date_offsets:
+        do = _date_offsets[end[-1:]]
+        end = _mk_date(time.time() - int(end[:-1])*do*24*3600)
+    elif len(end) >= 9 and '-' not in end:
+        end = _mk_date(int(end))
+
+    if start in _date_offsets:
+        start = _mk_date(time.time() - _date_offsets[start]*24*3600)
+    elif start[-1:] in _date_offsets:
+        do = _date_offsets[start[-1:]]
+        start = _mk_date(time.time() - int(start[:-1])*do*24*3600)
+    elif len(start) >= 9 and '-' not in start:
+        start = _mk_date(int(start))
+
+    start = [int(p) for p in start.split('-')][:3]
+    end = [int(p) for p in end.split('-')[:3]]
+    while len(start) < 3:
+        start.append(1)
+    if len(end) == 1:
+        end.extend([12, 31])
+    elif len(end) == 2:
+        end.append(31)
+    if not start <= end:
+        raise ValueError()
+
+    return start, end
+
+
+def date_term_timestamps(term):
+    """
+    Convert a date search term into a range of Unix timestamps, returning
+    (beg_ts, end_ts) where beg_ts is inclusive and end_ts is exclusive, or
+    IntSet.All if the term matches everything. Days begin and end at
+    midnight, local time - the same as for the keywords.
+
+    Raises ValueError (or similar) if the term cannot be parsed.
+    """
+    rng = date_term_range(term)
+    if rng == IntSet.All:
+        return rng
+    start, end = rng
+    end[2] = min(end[2], calendar.monthrange(end[0], end[1])[1])
+    start = datetime.date(*start)
+    end = datetime.date(*end) + datetime.timedelta(days=1)
+    return (int(time.mktime(start.timetuple())),
+            int(time.mktime(end.timetuple())))
+
+
 def date_term_magic(term, kw_date=None):
     try:
         if kw_date:
@@ -59,46 +131,10 @@ def date_term_magic(term, kw_date=None):
             kw_year = 'year'
             kw_date = 'date'
 
-        word = term.split(':', 1)[1].lower()
-        if word == 'recent':
-            word = '13d..today'  # FIXME: Is 2 weeks recent?
-        if '..' in word:
-            start, end = word.split('..')
-            if (not start) and end in ('today', '0d', '0w', '0m', '0q', '0y', ''):
-                return IntSet.All
-            if not end:
-                end = 'today'
-            if not start:
-                start = '20y'  # FIXME: This is incorrect
-        else:
-            start = end = word
-
-        if end in _date_offsets:
-            end = _mk_date(time.time() - _date_offsets[end]*24*3600)
-        elif end[-1:] in _date_offsets:
-            do = _date_offsets[end[-1:]]
-            end = _mk_date(time.time() - int(end[:-1])*do*24*3600)
-        elif len(end) >= 9 and '-' not in end:
-            end = _mk_date(int(end))
-
-        if start in _date_offsets:
-            start = _mk_date(time.time() - _date_offsets[start]*24*3600)
-        elif start[-1:] in _date_offsets:
-            do = _date_offsets[start[-1:]]
-            start = _mk_date(time.time() - int(start[:-1])*do*24*3600)
-        elif len(start) >= 9 and '-' not in start:
-            start = _mk_date(int(start))
-
-        start = [int(p) for p in start.split('-')][:3]
-        end = [int(p) for p in end.split('-')[:3]]
-        while len(start) < 3:
-            start.append(1)
-        if len(end) == 1:
-            end.extend([12, 31])
-        elif len(end) == 2:
-            end.append(31)
-        if not start <= end:
-            raise ValueError()
+        rng = date_term_range(term)
+        if rng == IntSet.All:
+            return rng
+        start, end = rng
 
         terms = []
         while start <= end:
@@ -172,4 +208,14 @@ if __name__ == '__main__':
         == ('(date:2021-2-27 OR date:2021-2-28 OR date:2021-2-29'
             ' OR date:2021-3)'))
 
+    beg_ts, end_ts = date_term_timestamps('dates:2021-02-27..2021-03')
+    assert(_mk_date(beg_ts) == '2021-2-27')
+    assert(_mk_date(end_ts) == '2021-4-1')
+    assert(_mk_date(end_ts - 1) == '2021-3-31')
+    beg_ts, end_ts = date_term_timestamps('date:2021-11')
+    assert(_mk_date(end_ts) == '2021-12-1')
+    assert(date_term_timestamps('dates:..') == IntSet.All)
+    beg_ts, end_ts = date_term_timestamps('dates:recent')
+    assert(beg_ts < time.time() < end_ts)
+
     print('Tests pass OK')
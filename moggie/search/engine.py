@@ -44,18 +44,22 @@ import re
 import threading
 import time
 
-from .dates import ts_to_keywords
-from .versions import version_to_keywords
+from .dates import ts_to_keywords, date_term_timestamps
+from .versions import version_to_keywords, version_term_range
 from ..util.dumbcode import *
 from ..util.intset import IntSet
 from ..util.mailpile import msg_id_hash, tag_quote, tag_unquote
 from ..util.wordblob import wordblob_search, create_wordblob, update_wordblob
+from ..util.wordblob import WordBlob
 from ..storage.records import RecordFile, RecordStore
+from ..storage.metadata import IntColumn
 
 
 def explain_ops(ops):
     if isinstance(ops, str):
         return ops
+    if isinstance(ops, IntSet):
+        return '[%d ids]' % ops.count()
     if ops == IntSet.All:
         return 'ALL'
 
@@ -201,11 +205,21 @@ class SearchEngine:
     IDX_EMAIL_SPACE_1 = 2
     IDX_EMAIL_SPACE_2 = 3
     IDX_EMAIL_SPACE_3 = 4
+    IDX_PART_LOG_START = 10
+    IDX_PART_LOG_END = 999
     IDX_HISTORY_STATUS = 1000
     IDX_HISTORY_START = 1001
     IDX_HISTORY_END = 2000
     IDX_MAX_RESERVED = 2000
 
+    # How many times to try applying tag mutations without holding the
+    # lock, before giving up and locking out everyone else.
+    MUTATE_ATTEMPTS = 3
+
+    # Change timestamps are stored with the same accuracy as message dates
+    # in the metadata index.
+    CHANGE_TS_RESOLUTION = 16
+
     IGNORE_SPECIAL_KW_RE = re.compile(r'(^\d+|[:@%"\'<>?!\._-]+)')
     IGNORE_NONLATIN_RE = re.compile(r'(^\d+|[\s:@%"\'<>?!\._-]+|'
         + '[^\u0000-\u007F\u0080-\u00FF\u0100-\u017F\u0180-\u024F])')
@@ -231,9 +245,11 @@ class SearchEngine:
         logging.debug('Search engine config: %s' % (self.config,))
 
         try:
-            self.part_spaces = [self.records[self.IDX_PART_SPACE], set()]
+            part_space = self.records[self.IDX_PART_SPACE]
         except (KeyError, IndexError):
-            self.part_spaces = [bytes(), set()]
+            part_space = bytes()
+        self.part_spaces = [self._make_wordblob(part_space), set()]
+        self.part_spaces[0].replay(self._load_wordblob_log())
 
         try:
             self.email_spaces = [
@@ -251,6 +267,10 @@ class SearchEngine:
         self.maxint = maxint
         self.deleted = IntSet([0])  # FIXME: Should this persist??
         self.lock = threading.RLock()
+        self._open_change_columns()
+
+        # Decoded tag bitmaps, by L1 record: idx -> (blob, [tags])
+        self.tag_cache = {}
 
         # Profiling...
         self.profileB = self.profile1 = self.profile2 = self.profile3 = 0
@@ -265,8 +285,6 @@ class SearchEngine:
             ('*', self.magic_candidates)]
 
         from .dates import date_term_magic
-        from .versions import version_term_magic
-        vmagic = lambda t: version_term_magic(t, self.history.get('ver', 0))
         self.magic_term_map = {
             'message-id': self.msgid_hash_magic,
             'msgid': self.msgid_hash_magic,
@@ -274,15 +292,74 @@ class SearchEngine:
             'tag': self.tag_quote_magic,
             'date': date_term_magic,
             'dates': date_term_magic,
-            'version': vmagic,
-            'vdate': lambda t: date_term_magic(t, kw_date='vdate'),
-            'vdates': lambda t: date_term_magic(t, kw_date='vdate')}
+            'version': self.version_magic,
+            'vdate': self.vdate_magic,
+            'vdates': self.vdate_magic}
 
         self.magic_term_remap = {
             'is:recent': 'date:recent',
             'is:unread': '-in:read',
             'is:read':   'in:read'}
 
+    def _open_change_columns(self):
+        """
+        Open the columns recording when each message was last changed. If
+        they are new, record from which version (and time) onwards they are
+        complete, so we know when they can be used for searching.
+        """
+        self.changed_versions = IntColumn(
+            os.path.join(self.records.workdir, 'changed-versions'))
+        self.changed_timestamps = IntColumn(
+            os.path.join(self.records.workdir, 'changed-timestamps'))
+        if 'columns_since' not in self.history:
+            with self.lock:
+                self.history['columns_since'] = [
+                    self.history.get('ver', 0) + 1, int(time.time())]
+                self.records[self.IDX_HISTORY_STATUS] = self.history
+
+    def _record_changes(self, ids, version, ts):
+        if isinstance(ids, IntSet):
+            ids = ids.as_array()
+        with self.lock:
+            self.changed_versions.set_many(ids, version)
+            self.changed_timestamps.set_many(ids,
+                int(ts) // self.CHANGE_TS_RESOLUTION)
+
+    def version_magic(self, term):
+        """
+        Open-ended version ranges (version:N..) are answered directly from
+        the changed-versions column, other ranges expand to keywords.
+        """
+        from .versions import version_term_magic
+        ver = self.history.get('ver', 0)
+        try:
+            rng = version_term_range(term, ver)
+            if rng != IntSet.All:
+                beg, end = rng
+                if (end >= ver) and (beg >= self.history['columns_since'][0]):
+                    return (IntSet.Or, self.changed_versions.in_range(beg))
+        except (ValueError, KeyError, IndexError):
+            pass
+        return version_term_magic(term, ver)
+
+    def vdate_magic(self, term):
+        """
+        Open-ended ranges of modification dates (vdates:2023-01-01..) are
+        answered from the changed-timestamps column, others use keywords.
+        """
+        from .dates import date_term_magic
+        try:
+            rng = date_term_timestamps(term)
+            if rng != IntSet.All:
+                beg_ts, end_ts = rng
+                if ((end_ts > time.time())
+                        and (beg_ts >= self.history['columns_since'][1])):
+                    return (IntSet.Or, self.changed_timestamps.in_range(
+                        beg_ts // self.CHANGE_TS_RESOLUTION))
+        except (ValueError, KeyError, IndexError):
+            pass
+        return date_term_magic(term, kw_date='vdate')
+
     def _allocate_history_slot(self):
         with self.lock:
             pos = self.history.get('pos', self.IDX_HISTORY_END) + 1
@@ -296,38 +373,65 @@ class SearchEngine:
     def delete_everything(self, *args):
         with self.lock:
             self.records.delete_everything(*args)
+            for col in (self.changed_versions, self.changed_timestamps):
+                col.close()
+                if os.path.exists(col.filepath):
+                    os.remove(col.filepath)
 
     def flush(self):
         with self.lock:
+            self.changed_versions.flush()
+            self.changed_timestamps.flush()
             return self.records.flush()
 
     def close(self):
         with self.lock:
+            self.changed_versions.close()
+            self.changed_timestamps.close()
             return self.records.close()
 
+    def _l1_tags(self, idx):
+        """
+        Return a list of (keyword, comment, IntSet) tuples for the tags
+        stored in a given L1 record, or None if there is no such record.
+
+        Decoded bitmaps are cached until the record changes; the cache is
+        checked against the record store's (cached) blob, so any write to
+        the record invalidates it. Callers must not modify the sets.
+        """
+        with self.lock:
+            if idx not in self.records:
+                self.tag_cache.pop(idx, None)
+                return None
+            blob = self.records.get(idx, cache=True)
+            cached = self.tag_cache.get(idx)
+            if cached and cached[0] is blob:
+                return cached[1]
+
+            tags = []
+            for kw, comment, iset in PostingListBucket(blob).items(decode=False):
+                kw = str(kw, 'utf-8')
+                if (len(kw) > 3) and (kw[:3] == 'in:') and (kw[3] != '@'):
+                    tags.append((kw, comment, dumb_decode(iset) or IntSet()))
+            self.tag_cache[idx] = (blob, tags)
+            return tags
+
     def iter_tags(self, tag_namespace=''):
+        """
+        Iterate through all tags, yielding (tag, (comment, IntSet)) pairs.
+        The IntSets may be shared with our cache and must not be modified.
+        """
         if tag_namespace:
             tag_namespace = '@' + tag_namespace
-        no_hits = IntSet()
         for idx in range(self.l1_begin, self.l2_begin):
-            with self.lock:
-                if idx not in self.records:
-                    return
-                plb = PostingListBucket(self.records.get(idx, cache=True))
+            tags = self._l1_tags(idx)
+            if tags is None:
+                return
+            for kw, comment, iset in tags:
                 if not tag_namespace:
-                    for kw, comment, iset in plb.items(decode=False):
-                        kw = str(kw, 'utf-8')
-                        if ((len(kw) > 3)
-                                and (kw[:3] == 'in:') and (kw[3] != '@')):
-                            yield (kw, (comment, dumb_decode(iset) or no_hits))
-                else:
-                    for kw, comment, iset in plb.items(decode=False):
-                        kw = str(kw, 'utf-8')
-                        if ((len(kw) > 3)
-                               and (kw[:3] == 'in:') and (kw[3] != '@')
-                               and kw.endswith(tag_namespace)):
-                            kw = kw.split('@')[0]
-                            yield (kw, (comment, dumb_decode(iset) or no_hits))
+                    yield (kw, (comment, iset))
+                elif kw.endswith(tag_namespace):
+                    yield (kw.split('@')[0], (comment, iset))
 
     def iter_byte_keywords(self, min_hits=1, ignore_re=None):
         for i in range(self.l2_begin, len(self.records)):
@@ -350,17 +454,46 @@ class SearchEngine:
             except (IndexError, KeyError):
                 pass
 
+    def _make_wordblob(self, blob):
+        return WordBlob(blob,
+            shortest=self.config['partial_shortest'],
+            longest=self.config['partial_longest'],
+            maxlen=self.config['partial_list_len'],
+            max_log=(self.IDX_PART_LOG_END - self.IDX_PART_LOG_START))
+
+    def _load_wordblob_log(self):
+        log = []
+        for idx in range(self.IDX_PART_LOG_START, self.IDX_PART_LOG_END):
+            if idx not in self.records:
+                break
+            log.append(self.records[idx])
+        return log
+
+    def _save_wordblob(self, wordblob, checkpoint):
+        # Persisting the full blob is expensive, so we usually just record
+        # the latest update in the log and rewrite the blob occasionally.
+        with self.lock:
+            if checkpoint:
+                self.records[self.IDX_PART_SPACE] = wordblob.tobytes()
+                for idx in range(self.IDX_PART_LOG_START, self.IDX_PART_LOG_END):
+                    if idx not in self.records:
+                        break
+                    del self.records[idx]
+            elif wordblob.log:
+                idx = self.IDX_PART_LOG_START + len(wordblob.log) - 1
+                self.records[idx] = wordblob.log[-1]
+
     def create_part_space(self, min_hits=0, ignore_re=IGNORE_NONLATIN_RE):
-        self.part_spaces[0] = create_wordblob(self.iter_byte_keywords(
+        self.part_spaces[0] = self._make_wordblob(create_wordblob(
+            self.iter_byte_keywords(
                 min_hits=(min_hits or self.config['partial_min_hits']),
                 ignore_re=ignore_re),
             shortest=self.config['partial_shortest'],
             longest=self.config['partial_longest'],
             maxlen=self.config['partial_list_len'],
-            lru=True)
-        with self.lock:
-            self.records[self.IDX_PART_SPACE] = self.part_spaces[0]
-            return self.part_spaces[0]
+            lru=True))
+        self._save_wordblob(self.part_spaces[0], True)
+        return self.part_spaces[0]
 
     def part_space_count(self, term, min_hits):
         count = 0
@@ -411,14 +544,17 @@ class SearchEngine:
                 adding -= wset
 
         if adding or removing:
-            spaces[0] = update_wordblob(adding, spaces[0],
-                blacklist=blacklist,
-                shortest=self.config['partial_shortest'],
-                longest=self.config['partial_longest'],
-                maxlen=self.config['partial_list_len'],
-                lru=True)
-            # FIXME: This becomes expensive if update batches are small!
-            self.records[self.IDX_PART_SPACE] = spaces[0]
+            if isinstance(spaces[0], WordBlob):
+                checkpoint = spaces[0].update(adding, blacklist=blacklist)
+                if spaces is self.part_spaces:
+                    self._save_wordblob(spaces[0], checkpoint)
+            else:
+                spaces[0] = update_wordblob(adding, spaces[0],
+                    blacklist=blacklist,
+                    shortest=self.config['partial_shortest'],
+                    longest=self.config['partial_longest'],
+                    maxlen=self.config['partial_list_len'],
+                    lru=True)
 
         spaces[1] = set()
         return spaces[0]
@@ -432,10 +568,10 @@ class SearchEngine:
             (bytes(w, 'utf-8') if isinstance(w, str) else w)
             for w in wordlist
             if shortest <= len(w) <= longest])
-        spaces.append((create_wordblob(words,
+        spaces.append((WordBlob(create_wordblob(words,
                 shortest=shortest,
                 longest=longest,
-                maxlen=len(words)+1),
+                maxlen=len(words)+1)),
             words))
 
     def add_dictionary_terms(self, dict_path, spaces=None):
@@ -494,39 +630,65 @@ class SearchEngine:
         keywords = {}
         hits = []
         extra_kws = ['in:'] if tag_ns else []
+        touched = []
         if touch:
             extra_kws.extend(self.touch())
+            touch_version, touch_ts = self.get_version(), time.time()
+        kw_sets = {}
         for (r_ids, kw_list) in results:
             if isinstance(r_ids, int):
                 r_ids = [r_ids]
             if isinstance(kw_list, str):
                 kw_list = [kw_list]
-            for r_id in r_ids:
-                if not isinstance(r_id, int):
-                    raise ValueError('Results must be integers')
-                if r_id >= self.maxint:
-                    self.maxint = r_id + 1
-                for kw in kw_list + extra_kws:
-                    kw = kw.replace('*', '')  # Otherwise partial search breaks..
-
-                    # Treat tag: prefix as alternatives to in: for tags.
-                    if kw[:4] == 'tag:':
-                        kw = 'in:' + kw[4:]
-
-                    if kw[:3] == 'in:':
-                        if tag_ns:
-                            kw = '%s@%s' % (kw, tag_ns)
-                        kw = self.tag_quote_magic(kw)
-
-                    keywords[kw] = keywords.get(kw, []) + [r_id]
-                if kw_list:
-                    hits.append(r_id)
+            if isinstance(r_ids, IntSet):
+                # Large sets are merged as bitmaps, not one ID at a time
+                r_list = r_ids.as_array().tolist()
+            else:
+                r_ids = r_list = list(r_ids)
+                for r_id in r_list:
+                    if not isinstance(r_id, int):
+                        raise ValueError('Results must be integers')
+            if not r_list:
+                continue
+            if max(r_list) >= self.maxint:
+                self.maxint = max(r_list) + 1
+
+            for kw in kw_list + extra_kws:
+                kw = kw.replace('*', '')  # Otherwise partial search breaks..
+
+                # Treat tag: prefix as alternatives to in: for tags.
+                if kw[:4] == 'tag:':
+                    kw = 'in:' + kw[4:]
+
+                if kw[:3] == 'in:':
+                    if tag_ns:
+                        kw = '%s@%s' % (kw, tag_ns)
+                    kw = self.tag_quote_magic(kw)
+
+                if isinstance(r_ids, IntSet):
+                    keywords.setdefault(kw, [])
+                    if kw in kw_sets:
+                        kw_sets[kw] |= r_ids
+                    else:
+                        kw_sets[kw] = IntSet(copy=r_ids)
+                else:
+                    keywords.setdefault(kw, []).extend(r_list)
+            if kw_list:
+                hits.extend(r_list)
+            if touch:
+                touched.extend(r_list)
+
+        if touched:
+            self._record_changes(touched, touch_version, touch_ts)
 
         kw_idx_list = [
             (self.keyword_index(k, prefer_l1=prefer_l1, create=create), k)
             for k in keywords]
         for k in keywords:
-            keywords[k] = IntSet(keywords[k])
+            iset = IntSet(keywords[k])
+            if k in kw_sets:
+                iset |= kw_sets[k]
+            keywords[k] = iset
 
         return kw_idx_list, keywords, hits
 
@@ -634,8 +796,88 @@ class SearchEngine:
         logging.debug('Version is now %s at %s' % (version, kws[-1]))
         if ids is not None:
             self.add_results([(ids, kws)], touch=False)
+            self._record_changes(ids, version, ts or time.time())
         return kws
 
+    def _update_posting_lists(self, idx, update_func):
+        """
+        Update the record at idx, by calling update_func on a
+        PostingListBucket of its contents. The update happens without
+        holding the lock, and is retried if the record changes meanwhile;
+        the last attempt is made while holding the lock.
+
+        Returns a tuple of (the old blob, the updated PostingListBucket).
+        """
+        for attempt in range(1, self.MUTATE_ATTEMPTS + 1):
+            locked = (attempt == self.MUTATE_ATTEMPTS)
+            if locked:
+                self.lock.acquire()
+            try:
+                with self.lock:
+                    blob = self.records.get(idx) or b''
+                plb = PostingListBucket(blob)
+                update_func(plb)
+                with self.lock:
+                    if locked or ((self.records.get(idx) or b'') == blob):
+                        self.records[idx] = plb.blob
+                        return blob, plb
+            finally:
+                if locked:
+                    self.lock.release()
+
+    def _plan_mutations(self, ops, snapshot):
+        """
+        Apply a list of (mset, op, keyword, idx) tag operations to a
+        snapshot of the affected records (a dict of idx -> blob). The
+        snapshot is not modified, so this is safe to run unlocked.
+
+        Returns a tuple of (blobs, changed, changes, mutations), where
+        blobs is a dict of updated records, changed an IntSet of the
+        messages whose tags changed and changes a list of (keyword, idx,
+        old IntSet, new IntSet) for the history, scoped to each mset.
+        """
+        plbs = {}
+        cset_all = IntSet()
+        changes = []
+        mutations = 0
+        for mset, op, kw, idx in ops:
+            plb = plbs.get(idx)
+            if plb is None:
+                plb = plbs[idx] = PostingListBucket(snapshot[idx] or b'')
+            comment, iset = plb.get(kw, with_comment=True)
+
+            if isinstance(mset, dict):
+                cdata = from_json(comment) if comment else {}
+                if op in (IntSet.Or, '+'):
+                    cdata.update(mset)
+                else:
+                    for k, v in mset.items():
+                        if k in cdata:
+                            del cdata[k]
+                plb.set_comment(kw, to_json(cdata))
+                continue
+
+            if iset is None:
+                iset = IntSet()
+            oset = op(iset, mset)
+            if iset != oset:
+                plb.set(kw, oset)
+                mutations += 1
+
+                # We assume the mset has already been scoped.
+                cset = IntSet()
+                cset |= iset
+                cset ^= oset  # XOR tells us which bits changed
+                cset &= mset  # Scope
+                cset_all |= cset
+
+                iset &= mset  # Scope
+                oset &= mset  # Scope
+                changes.append((kw, idx, iset, oset))
+
+        blobs = dict((idx, plb.blob) for idx, plb in plbs.items())
+        return blobs, cset_all, changes, mutations
+
     def mutate(self, mlist, record_history=None, tag_namespace=''):
         def _op(o):
             o = {'+': IntSet.Or,
@@ -658,60 +900,52 @@ class SearchEngine:
                 kw = self._ns(kw, tag_namespace)
                 yield (op, kw, self.keyword_index(kw, create=(op==IntSet.Or)))
 
-        slot = version = None
-        cset_all = IntSet()
-        changes = []
-        mutations = 0
+        ops = []
         with self.lock:
             for mset, op_kw_list in mlist:
-                op_idx_kw_list = []
                 for op, kw in op_kw_list:
-                    op_idx_kw_list.extend(_op_kwi(op, kw))
-
-                for op, kw, idx in op_idx_kw_list:
-                    plb = PostingListBucket(self.records.get(idx) or b'')
-                    comment, iset = plb.get(kw, with_comment=True)
-
-                    if isinstance(mset, dict):
-                        cdata = from_json(comment) if comment else {}
-                        if op in (IntSet.Or, '+'):
-                            cdata.update(mset)
-                        else:
-                            for k, v in mset.items():
-                                if k in cdata:
-                                    del cdata[k]
-                        plb.set_comment(kw, to_json(cdata))
-                        self.records[idx] = plb.blob
-
-                    else:
-                        if iset is None:
-                            iset = IntSet()
-                        oset = op(iset, mset)
-
-                        if iset != oset:
-                            plb.set(kw, oset)
-                            self.records[idx] = plb.blob
-                            mutations += 1
-
-                            # Only keep history and report results regarding the
-                            # mutation itself, to save space (zeros compress well)
-                            # and avoid leaking data from outside our tag namespace.
-                            # We assume the mset has already been scoped.
-                            cset = IntSet()
-                            cset |= iset
-                            cset ^= oset  # XOR tells us which bits changed
-                            cset &= mset  # Scope
-                            cset_all |= cset
-
-                            iset &= mset  # Scope
-                            oset &= mset  # Scope
-                            changes.append([kw, idx,
-                                dumb_encode_asc(iset, compress=256),
-                                dumb_encode_asc(oset, compress=256)])
-
-            if record_history:
-                # Allocate slot while still locked, then release.
-                slot, version = self._allocate_history_slot()
+                    ops.extend((mset, o, k, i) for o, k, i in _op_kwi(op, kw))
+        idxs = sorted(set(idx for mset, op, kw, idx in ops))
+
+        # The posting lists are updated without holding the lock, working
+        # on a snapshot of the records. The results are then written in a
+        # single batch, unless someone else changed the records meanwhile,
+        # in which case we try again. The last attempt holds the lock all
+        # the way through, so we always make progress.
+        slot = version = None
+        for attempt in range(1, self.MUTATE_ATTEMPTS + 1):
+            locked = (attempt == self.MUTATE_ATTEMPTS)
+            if locked:
+                self.lock.acquire()
+            try:
+                with self.lock:
+                    snapshot = dict((i, self.records.get(i)) for i in idxs)
+                blobs, cset_all, changes, mutations = self._plan_mutations(
+                    ops, snapshot)
+                with self.lock, self.records.batch():
+                    if not locked and any(
+                            self.records.get(i) != snapshot[i] for i in idxs):
+                        logging.debug('mutate: Records changed, retrying')
+                        continue
+                    for idx, blob in blobs.items():
+                        if blob != (snapshot[idx] or b''):
+                            self.records[idx] = blob
+                            self.tag_cache.pop(idx, None)
+                    if record_history:
+                        slot, version = self._allocate_history_slot()
+                    break
+            finally:
+                if locked:
+                    self.lock.release()
+
+        # Only keep history and report results regarding the mutation
+        # itself, to save space (zeros compress well) and avoid leaking
+        # data from outside our tag namespace.
+        changes = [
+            [kw, idx,
+                dumb_encode_asc(iset, compress=256),
+                dumb_encode_asc(oset, compress=256)]
+            for kw, idx, iset, oset in changes]
 
         if record_history:
             changes = {
@@ -786,13 +1020,11 @@ class SearchEngine:
         oc = 0
         bc = 0
         for idx, kw in sorted(kw_idx_list):
-            with self.lock:
-                plb = PostingListBucket(self.records.get(idx) or b'')
-                oc += len(plb.blob)
-
+            def _add(plb):
                 plb.deleted = self.deleted
                 plb.add(kw, keywords[kw])
-                self.records[idx] = plb.blob
+            blob, plb = self._update_posting_lists(idx, _add)
+            oc += len(blob)
             bc += len(plb.blob)
 
         t2 = time.time()
@@ -823,11 +1055,21 @@ class SearchEngine:
             ids = []
         return ids
 
-    def _search(self, term, tag_ns):
+    def _cached_get(self, keyword, cache):
+        if cache is None:
+            return self[keyword]
+        iset = cache.get(keyword)
+        if iset is None:
+            iset = cache[keyword] = self[keyword]
+        return iset
+
+    def _search(self, term, tag_ns, cache=None):
+        # Note: If a cache is provided, the IntSets returned may be shared
+        #       and the caller must not modify them in place.
         if isinstance(term, tuple):
             if len(term) > 1:
                 op = term[0]
-                return op(*[self._search(t, tag_ns) for t in term[1:]])
+                return op(*[self._search(t, tag_ns, cache) for t in term[1:]])
             else:
                 return IntSet()
 
@@ -837,20 +1079,24 @@ class SearchEngine:
                term = 'in:' + term[4:]
 
             if tag_ns and (term[:3] == 'in:'):
-               return self['%s@%s' % (term, tag_ns)]
+               return self._cached_get('%s@%s' % (term, tag_ns), cache)
             elif term in ('in:', 'all:mail', '*'):
                term = IntSet.All
             elif term[:3] == 'id:' or term[:4] == 'mid:':
                return IntSet(self._id_list(term.split(':', 1)[1]))
             else:
-               return self[term]
+               return self._cached_get(term, cache)
 
         if isinstance(term, list):
-            return IntSet.And(*[self._search(t, tag_ns) for t in term])
+            return IntSet.And(*[self._search(t, tag_ns, cache) for t in term])
+
+        if isinstance(term, IntSet):
+            # Pre-computed results, e.g. from a date range lookup
+            return term
 
         if term == IntSet.All:
             if tag_ns:
-                return self['in:@%s' % tag_ns]
+                return self._cached_get('in:@%s' % tag_ns, cache)
             return IntSet.All(self.maxint)
 
         raise ValueError('Unknown supported search type: %s' % type(term))
@@ -903,6 +1149,61 @@ class SearchEngine:
             rv = (tag_namespace, ops, rv)
         return rv
 
+    def search_counts(self, terms_list,
+            tag_namespace='',
+            mask_deleted=True, mask_tags=None, more_terms=None):
+        """
+        Count the results for many searches at once, returning a dictionary
+        of (terms => int) mappings.
+
+        This is equivalent to calling search() for each of the terms and
+        counting the results, but the scope (namespace, more_terms, deleted
+        messages and masked tags) is only calculated once, and posting lists
+        used by more than one search are only loaded once.
+        """
+        if more_terms and isinstance(more_terms, str):
+            more_terms = self.parse_terms(more_terms, self.magic_map)
+
+        # Parse before taking the lock, as magic terms may need to ask
+        # other workers for help (date: asks the metadata worker).
+        parsed = [
+            (terms, self.parse_terms(terms, self.magic_map)
+                if isinstance(terms, str) else terms)
+            for terms in terms_list]
+
+        counts = {}
+        cache = {}
+        with self.lock:
+            scope = []
+            if tag_namespace:
+                scope.append(self._search(IntSet.All, tag_namespace, cache))
+            if more_terms:
+                scope.append(self._search(more_terms, tag_namespace, cache))
+            scope = IntSet.And(*scope) if scope else None
+
+            exclude = IntSet(copy=self.deleted) if mask_deleted else IntSet()
+            masked_exclude = None
+
+            for terms, ops in parsed:
+                # Same rule as in search(): masking is only applied if none
+                # of the masked tags were explicitly requested.
+                if mask_tags and not [t for t in mask_tags if t in terms]:
+                    if masked_exclude is None:
+                        masked_exclude = IntSet.Or(exclude, self._search(
+                            tuple([IntSet.Or] + list(mask_tags)),
+                            tag_namespace, cache))
+                    t_exclude = masked_exclude
+                else:
+                    t_exclude = exclude
+
+                rv = IntSet.And(self._search(ops, tag_namespace, cache))
+                if scope is not None:
+                    rv &= scope
+                rv -= t_exclude
+                counts[terms] = rv.count()
+
+        return counts
+
     def search_tags(self, search_set, tag_namespace=''):
         """
         Search for tags that match a search (terms or tuple) or result set
@@ -918,9 +1219,28 @@ class SearchEngine:
             search_set = iset
         results = {}
         for tag, (bcom, iset) in self.iter_tags(tag_namespace=tag_namespace):
-            iset &= search_set
-            if iset:
-                results[tag_unquote(tag)] = (bcom, iset)
+            if iset.intersection_count(search_set):
+                results[tag_unquote(tag)] = (bcom, IntSet.And(iset, search_set))
+        return results
+
+    def search_tag_counts(self, search_set, tag_namespace=''):
+        """
+        Count how many results from a search or result set (see search_tags)
+        have each tag, without constructing the intersections.
+
+        Returns a dictionary of (tag => (comment, count)) mappings.
+        """
+        if isinstance(search_set, (tuple, str)):
+            search_set = self.search(search_set, tag_namespace=tag_namespace)
+        if not isinstance(search_set, IntSet):
+            iset = IntSet()
+            iset |= search_set
+            search_set = iset
+        results = {}
+        for tag, (bcom, iset) in self.iter_tags(tag_namespace=tag_namespace):
+            count = iset.intersection_count(search_set)
+            if count:
+                results[tag_unquote(tag)] = (bcom, count)
         return results
 
     def tag_quote_magic(self, term):
@@ -1011,6 +1331,15 @@ if __name__ == '__main__':
     se.deleted |= 0
     _assert(list(se.search(IntSet.All)), [1, 2, 3, 4, 5])
 
+    # Open-ended version and vdate ranges use the changed-* columns
+    ver = se.get_version()
+    se.add_results([(6, ['changed'])])
+    _assert(se.magic_term_map['version']('version:%d..' % (ver+1))[0], IntSet.Or)
+    _assert(list(se.search('version:%d..' % (ver+1))), [6])
+    _assert(list(se.search('version:%d' % (ver+1))), [6])
+    _assert(6 in se.search('vdates:today..'))
+    se.deleted |= 6
+
     _assert(3 in se.search('please'))
     _assert(5 in se.search('please'))
     _assert(5 in se.search('please', tag_namespace='work'))
@@ -1033,6 +1362,38 @@ if __name__ == '__main__':
     _assert('in:inbox' in se.search_tags([4, 55]))
     _assert('in:inbox' not in se.search_tags('please'))
     _assert('in:inbox' in se.search_tags('please', tag_namespace='work'))
+    _assert(se.search_tag_counts([4, 5, 55])['in:inbox'][1], 1)
+    _assert(se.search_tag_counts([4, 5], tag_namespace='work')['in:inbox'][1], 1)
+    _assert(list(se.search_tags([4, 5])['in:inbox'][1]), [4])
+    _assert(list(dict(se.iter_tags())['in:inbox'][1]), [4])  # Unmodified
+
+    # Batched counts should match individual searches
+    for ns in ('', 'work'):
+        for mt in (None, ('in:testing',)):
+            tl = ['please', 'hello', 'in:inbox', 'in:testing', '*', 'notfound']
+            counts = se.search_counts(tl,
+                tag_namespace=ns, mask_tags=mt, more_terms='in:inbox + hello')
+            for t in tl:
+                _assert(counts[t], se.search(t,
+                    tag_namespace=ns, mask_tags=mt,
+                    more_terms='in:inbox + hello').count())
+
+    # Terms get parsed (and magic expanded) without holding the engine lock
+    def _lock_free():
+        got = se.lock.acquire(timeout=1)
+        if got:
+            se.lock.release()
+        return got
+    _parse_terms, locked = se.parse_terms, []
+    def _checked_parse_terms(*args):
+        checker = threading.Thread(target=lambda: locked.append(_lock_free()))
+        checker.start()
+        checker.join()
+        return _parse_terms(*args)
+    se.parse_terms = _checked_parse_terms
+    se.search_counts(['please', 'hello'], more_terms='in:inbox')
+    se.parse_terms = _parse_terms
+    _assert(locked, [True, True, True])
 
     _assert(3 in se.search('remove'))
     se.del_results([(3, ['please'])])
@@ -1044,16 +1405,29 @@ if __name__ == '__main__':
     _assert(4 not in se.search('all:mail', tag_namespace='work'))
     _assert(3 not in se.search('in:inbox'))
     _assert(4 in se.search('in:testing'))
+    _assert(se.search_tag_counts([3, 4])['in:inbox'][1], 1)
 
     mr = se.mutate([
         (IntSet([4, 3]), [('-', 'in:testing'), (IntSet.Or, 'in:inbox')]),
         ], record_history='Testing')
+    _assert(se.search_tag_counts([3, 4])['in:inbox'][1], 2)
+    _assert('in:testing' not in se.search_tag_counts([3, 4]))
 
     _assert(5 not in se.search('in:imaginary'))
     mr2 = se.mutate([
         (IntSet([5, 6]), [('+', 'in:imaginary')])
         ], record_history='Test2')
     _assert(5 in se.search('in:imaginary'))
+    _assert(list(mr2['changed']), [5, 6])
+
+    # Only messages whose tags actually changed are reported
+    mr3 = se.mutate([(IntSet([5, 6, 7]), [('+', 'in:imaginary')])])
+    _assert(list(mr3['changed']), [7])
+    _assert(mr3['mutations'], 1)
+
+    # Sets of results are merged as sets
+    se.add_results([(IntSet([7, 8]), ['bulky']), (9, ['bulky'])])
+    _assert(list(se.search('bulky')), [7, 8, 9])
 
     slot = int(mr['history']['id'].split('-')[0], 16)
     _assert(slot, se.IDX_HISTORY_START)
@@ -1093,8 +1467,15 @@ if __name__ == '__main__':
         _assert(4 in se.search('in:OUTBOX'))
         _assert(4 not in se.search('in:inbox'))
 
+        # Incremental updates to the partial word index should persist
+        if round == 1:
+            _assert('sunflowers' in se.candidates('sunflow*', 10))
+
         # Enable and test partial word searches
         se.create_part_space(min_hits=1)
+        if round == 0:
+            se.update_terms(['sunflowers'])
+            _assert('sunflowers' in se.candidates('sunflow*', 10))
         _assert(b'*' not in se.part_spaces[0])
         _assert(b'evil' in se.part_spaces[0])  # Verify that * gets stripped
         #print('%s' % se.part_space)
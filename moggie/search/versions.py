@@ -14,44 +14,59 @@ def version_to_keywords(version):
         yield 'v:%d%s' % (version // div, c) 
 
 
+def _intify(ver):
+    if isinstance(ver, int):
+        return ver
+    elif ver in _version_muls:
+        return _version_muls[ver]
+    elif ver[-1:] in _version_muls:
+        return _version_muls[ver[-1:]] * int(ver[:-1])
+    else:
+        return int(ver)
+
+
+def version_term_range(term, max_version):
+    """
+    Parse a version search term into a (beg, end) range of versions, both
+    inclusive, or return IntSet.All if it matches everything.
+
+    Raises ValueError (or similar) if the term cannot be parsed.
+    """
+    word = term.split(':', 1)[1].lower()
+    if '..' in word:
+        beg, end = word.split('..')
+        if (not beg) and end in ('current', ''):
+            return IntSet.All
+        if not end or end == 'current':
+            end = max_version
+        if not beg:
+            beg = 0
+        elif beg[-1:] == '+':
+            beg = int(beg[:-1]) + 1
+    elif word[-1:] == '+':
+        beg = int(word[:-1]) + 1
+        end = max_version
+    elif word == 'recent':
+        end = max_version
+        beg = end - 200    # FIXME: magic number, may be a poor choice
+    else:
+        beg = end = word
+
+    beg = max(0, _intify(beg))
+    end = max(0, _intify(end))
+    if beg > end:
+        raise ValueError('%s > %s (out of range)' % (beg, end))
+    return beg, end
+
+
 def version_term_magic(term, max_version):
     try:
-        word = term.split(':', 1)[1].lower()
-        if '..' in word:
-            beg, end = word.split('..')
-            if (not beg) and end in ('current', ''):
-                return IntSet.All
-            if not end or end == 'current':
-                end = max_version
-            if not beg:
-                beg = 0
-            elif beg[-1:] == '+':
-                beg = int(beg[:-1]) + 1
-        elif word[-1:] == '+':
-            beg = int(word[:-1]) + 1
-            end = max_version
-        elif word == 'recent':
-            end = max_version
-            beg = end - 200    # FIXME: magic number, may be a poor choice
-        else:
-            beg = end = word
-
-        def _intify(ver):
-            if isinstance(ver, int):
-                return ver
-            elif ver in _version_muls:
-                return _version_muls[ver]
-            elif ver[-1:] in _version_muls:
-                return _version_muls[ver[-1:]] * int(ver[:-1])
-            else:
-                return int(ver)
+        rng = version_term_range(term, max_version)
+        if rng == IntSet.All:
+            return rng
+        beg, end = rng
 
         terms = []
-        beg = max(0, _intify(beg))
-        end = max(0, _intify(end))
-        if beg > end:
-            raise ValueError('%s > %s (out of range)' % (beg, end))
-
         k = 2**10
         m = 2**20
         beg_k = k * (beg // k + 1)
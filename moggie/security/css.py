@@ -17,12 +17,18 @@ import copy
 import logging
 import re
 import traceback
+from types import MappingProxyType
 
 
 class CSSSelector:
     RE_RULEPARTS = re.compile(r'(>|\S[^#\.:\[>]*)')
     RE_ALNUM = re.compile(r'^[a-zA-Z0-9_-]+$')
 
+    # Elements repeat a lot within (and across) messages, so we memoize
+    # their descriptions. This is cleared when it grows too large.
+    DESCRIBE_CACHE = {}
+    DESCRIBE_CACHE_MAX = 10000
+
     def __init__(self, rulestring):
         self.rules = self.make_rules(rulestring)
 
@@ -50,6 +56,11 @@ class CSSSelector:
         and parse it into a set of attributes CSS might select on.
         """
         tag, attrs = element[:2]
+        key = (tag, tuple(attrs))
+        description = cls.DESCRIBE_CACHE.get(key)
+        if description is not None:
+            return description
+
         description = set()
         description.add(tag)
         for a, v in attrs:
@@ -62,6 +73,10 @@ class CSSSelector:
                 description.add('#' + v)
             elif cls.RE_ALNUM.match(a):
                 description.add('[%s="%s"]' % (a, (v or '').replace('"', '\\"')))
+
+        if len(cls.DESCRIBE_CACHE) >= cls.DESCRIBE_CACHE_MAX:
+            cls.DESCRIBE_CACHE.clear()
+        description = cls.DESCRIBE_CACHE[key] = frozenset(description)
         return description
 
     def match(self, element_stack, more=None):
@@ -69,8 +84,16 @@ class CSSSelector:
         This will check an element stack against our ruleset, returning
         True if it matches, False otherwise.
         """
+        return self.match_described(
+            [self.describe(element) for element in element_stack], more)
+
+    def match_described(self, descriptions, more=None):
+        """
+        Like match(), but takes a list of element descriptions (as
+        generated by describe()), so they can be shared by many selectors.
+        """
         rules = more or self.rules
-        if not (rules and element_stack):
+        if not (rules and descriptions):
             return False
 
         tight, rule = False, rules[-1]
@@ -80,18 +103,19 @@ class CSSSelector:
                 return False
             tight, rule = True, rules[-1]
 
-        for i, element in enumerate(reversed(element_stack)):
-            if not (rule - self.describe(element)):
+        for i, description in enumerate(reversed(descriptions)):
+            if not (rule - description):
                 # Empty set: all criteria match!
                 if len(rules) == 1:
                     # This is the only rule, we are done. Success!
                     return True
-                elif len(element_stack) <= (i+1):
+                elif len(descriptions) <= (i+1):
                     # Have more rules, but out of elements: fail!
                     return False
                 else:
                     # OK great, check the next rule.
-                    return self.match(element_stack[:-(i+1)], more=rules[:-1])
+                    return self.match_described(
+                        descriptions[:-(i+1)], more=rules[:-1])
             elif (not more) or tight:
                 # Final rule must match final element to avoid over-matching.
                 return False
@@ -113,20 +137,13 @@ class CSSParser:
     RE_END_COMMENT = re.compile(r'\s*(\*\/)')
     RE_END_CLINE   = re.compile(r'\s*(\n)')
 
-    def __init__(self):
-        self.statemap = {
-            self.STATE_SEL: self._parse_selectors,
-            self.STATE_STYLES: self._parse_styles,
-            self.STATE_STYLES_DONE: self._state_styles_done,
-            self.STATE_CLINE: self._parse_cline,
-            self.STATE_COMMENT: self._parse_comment}
-        self.delimmap = {
-            '@media': self.STATE_DONE,  # FIXME: We just stop, which is lame
-            '': self.STATE_DONE,
-            '{': self.STATE_STYLES,
-            '}': self.STATE_STYLES_DONE,
-            '//': self.STATE_CLINE,
-            '/*': self.STATE_COMMENT}
+    DELIMMAP = MappingProxyType({
+        '@media': STATE_DONE,  # FIXME: We just stop, which is lame
+        '': STATE_DONE,
+        '{': STATE_STYLES,
+        '}': STATE_STYLES_DONE,
+        '//': STATE_CLINE,
+        '/*': STATE_COMMENT})
 
     def parse_styles(self, style_block):
         return self.parse(style_block, state=self.STATE_STYLES)
@@ -140,9 +157,10 @@ class CSSParser:
         self.found_rulesets = 0
         self.selectors = []
         self.styles = []
+        statemap = self.STATEMAP
         while self.state != self.STATE_DONE:
             try:
-                self.statemap[self.state]()
+                statemap[self.state](self)
             except:
                 logging.exception('CSSParser.parse() bailed out')
                 self.state = self.STATE_DONE
@@ -152,13 +170,15 @@ class CSSParser:
         return self
 
     def _pb(self, end_re, on_found, next_state):
-        next_block = end_re.search(self.data[self.pos:]) if self.data else None
+        # Note: We scan from an offset, instead of slicing off what we have
+        #       already parsed, to keep this linear on large style blocks.
+        next_block = end_re.search(self.data, self.pos) if self.data else None
         if next_block:
-            next_delim = next_block.group(0)
-            next_pos = self.pos + next_block.span()[0]
+            next_pos, end_pos = next_block.span()
             if next_pos > self.pos:
                 on_found(self.data[self.pos:next_pos])
-            self.pos = next_pos + len(next_delim)
+            next_delim = next_block.group(0)
+            self.pos = end_pos
             self.last_state, self.state = self.state, next_state(next_delim)
         else:
             self.last_state, self.state = self.state, self.STATE_DONE
@@ -167,7 +187,7 @@ class CSSParser:
         return self.last_state
 
     def _delim_state(self, next_delim):
-        return self.delimmap[next_delim.strip()]
+        return self.DELIMMAP[next_delim.strip()]
 
     def _parse_selectors(self):
         self._pb(self.RE_END_SEL, self.have_selectors, self._delim_state)
@@ -199,6 +219,13 @@ class CSSParser:
         self.styles = []
         self.last_state, self.state = self.state, self.STATE_SEL
 
+    STATEMAP = MappingProxyType({
+        STATE_SEL: _parse_selectors,
+        STATE_STYLES: _parse_styles,
+        STATE_STYLES_DONE: _state_styles_done,
+        STATE_CLINE: _parse_cline,
+        STATE_COMMENT: _parse_comment})
+
     def have_selectors(self, data):
         self.selectors.append(data)
 
@@ -253,7 +280,12 @@ class CSSCleaner(CSSParser):
     CHECK_WORDSPACE = _rc(r'^(inherit|normal)$')
     CHECK_ZERO      = _rc(r'^(none|(0\s*(pt|px|em|))*)$')
 
-    ALLOWED_STYLES = {
+    # Style-attribute strings repeat heavily in HTML e-mail (especially
+    # marketing e-mail), so we memoize the parsed and cleaned results.
+    STYLE_ATTR_CACHE = {}
+    STYLE_ATTR_CACHE_MAX = 5000
+
+    ALLOWED_STYLES = MappingProxyType({
         'background': CHECK_COLOR,
         'background-color': CHECK_COLOR,
         'border': CHECK_ZERO,
@@ -296,18 +328,24 @@ class CSSCleaner(CSSParser):
         'width': CHECK_SIZE,
         'white-space': CHECK_WHITESPCE,
         'word-break': CHECK_WORDBREAK,
-        'word-spacing': CHECK_WORDSPACE}
+        'word-spacing': CHECK_WORDSPACE})
 
     def __init__(self, checks=None):
         super().__init__()
         self.rule_sets = []
         self.dropped = set()
-        self.checks = copy.copy(self.ALLOWED_STYLES)
-        if checks:
+        if checks and (checks is not self.ALLOWED_STYLES):
+            self.checks = dict(self.ALLOWED_STYLES)
             self.checks.update(checks)
+            self.style_attr_cache = {}
+        else:
+            self.checks = self.ALLOWED_STYLES
+            self.style_attr_cache = self.STYLE_ATTR_CACHE
 
     def copy(self):
-        dup = CSSCleaner(self.checks)
+        dup = CSSCleaner()
+        dup.checks = self.checks
+        dup.style_attr_cache = self.style_attr_cache
         dup.rule_sets = copy.copy(self.rule_sets)
         dup.dropped = self.dropped
         return dup
@@ -367,15 +405,45 @@ class CSSCleaner(CSSParser):
                 list(self.clean_selectors(selectors)),
                 list(self.clean_styles(styles))))
 
-    def apply_styles(self, element_stack):
+    def parse_style_attr(self, style):
+        """
+        Parse and clean a local style='' declaration, returning a tuple of
+        rule-sets for use with apply_styles(). Results are memoized.
+        """
+        cache = self.style_attr_cache
+        cached = cache.get(style)
+        if cached is None:
+            parsed = CSSCleaner(self.checks).parse_styles(style)
+            cached = (tuple(parsed.rule_sets), frozenset(parsed.dropped))
+            if len(cache) >= self.STYLE_ATTR_CACHE_MAX:
+                cache.clear()
+            cache[style] = cached
+        self.dropped |= cached[1]
+        return cached[0]
+
+    def apply_styles(self, element_stack, local_rule_sets=None):
+        """
+        Generate a style='' declaration for the element at the top of the
+        stack, combining any matching global rule-sets with the local ones
+        (as returned by parse_style_attr()).
+        """
         # FIXME: Make this smarter, faster?
+        rule_sets = self.rule_sets
+        if local_rule_sets:
+            room = max(0, self.MAX_RULES - len(rule_sets))
+            rule_sets = rule_sets + list(local_rule_sets[:room])
+
+        descriptions = None
         found_styles = {}
-        for selectors, styles in self.rule_sets:
+        for selectors, styles in rule_sets:
             if not selectors:
                 for s, v in styles:
                     found_styles[s] = v
+            elif descriptions is None:
+                descriptions = [
+                    CSSSelector.describe(e) for e in element_stack]
             for sel in selectors:
-                if sel.match(element_stack):
+                if sel.match_described(descriptions):
                     for s, v in styles:
                         found_styles[s] = v
                     break
@@ -395,7 +463,7 @@ if __name__ == "__main__":
            bottom: 2px;}}}}"""
 
     simple = CSSCleaner().parse_styles(TEST_SIMPLE)
-    assert(str(simple) == 'color: #fff; font-size: 1px;')
+    assert(str(simple) == 'color:#fff; font-size:1px;')
 
     fancy = CSSCleaner().parse(TEST_STYLES)
     print('%s%s' % (fancy, fancy.render_report()))
@@ -404,7 +472,7 @@ if __name__ == "__main__":
         ('table', []),
         ('tr', []),
         ('td', [('class', 'ugly nice')])])
-    assert(applied == 'color: #000; font-size: 1px; width: 10px;')
+    assert(applied == 'color:#000; font-size:1px; width:10px;')
 
 
     class MockCSSParser(CSSParser):
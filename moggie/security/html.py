@@ -1,7 +1,7 @@
-import copy
 import re
 import logging
 import hashlib
+from types import MappingProxyType
 
 from html.parser import HTMLParser
 from moggie.security.mime import magic_part_id
@@ -36,7 +36,7 @@ class HTMLCleaner(HTMLParser):
     CHECK_LANG = re.compile(r'^[a-zA-Z-]+$').match
     CHECK_DIR = re.compile(r'^(ltr|rtl)$').match
     CHECK_CLASS = re.compile(r'^(mHtmlBody|mRemoteImage|mInlineImage|mso[a-z]+|wordsection\d+)$', re.IGNORECASE).match
-    ALLOWED_ATTRIBUTES = {
+    ALLOWED_ATTRIBUTES = MappingProxyType({
         'alt':         ALLOW,
         'title':       ALLOW,
         'href':        ALLOW,  # FIXME
@@ -56,7 +56,10 @@ class HTMLCleaner(HTMLParser):
         'colspan':     CHECK_DIGIT,
         'rowspan':     CHECK_DIGIT,
         'cellspacing': CHECK_DIGIT,
-        'cellpadding': CHECK_DIGIT}
+        'cellpadding': CHECK_DIGIT})
+    # If we have a CSSCleaner, it takes care of validating styles
+    ALLOWED_ATTRIBUTES_WITH_CSS = MappingProxyType(dict(ALLOWED_ATTRIBUTES,
+        style=ALLOW))
 
     PROCESSED_TAGS = set([
         # We process these, so we can suppress them!
@@ -91,12 +94,13 @@ class HTMLCleaner(HTMLParser):
         self.dropped_attrs = set()
         self.a_hrefs = []
         self.img_srcs = []
-        self.attribute_checks = copy.copy(self.ALLOWED_ATTRIBUTES)
         self.stop_after = stop_after
 
         self.css_cleaner = css_cleaner
         if css_cleaner:
-            self.attribute_checks['style'] = lambda v: True
+            self.attribute_checks = self.ALLOWED_ATTRIBUTES_WITH_CSS
+        else:
+            self.attribute_checks = self.ALLOWED_ATTRIBUTES
 
         self.builtins = {
             'body': lambda s,t,a,b: ('div', s._aa(a, 'class', 'mHtmlBody'), b),
@@ -257,8 +261,8 @@ class HTMLCleaner(HTMLParser):
             try:
                 if validator and validator(v):
                     if css_cleaner and (a == 'style'):
-                        c = css_cleaner.copy().parse_styles(v)
-                        v = c.apply_styles(self.tag_stack)
+                        v = css_cleaner.apply_styles(self.tag_stack,
+                            css_cleaner.parse_style_attr(v))
                         saw_style = True
                     if v:
                         yield a, v
@@ -54,6 +54,7 @@ class FileStorage(BaseStorage, MailboxStorageMixin):
 
         super().__init__()
         self.dict = None
+        self.filemaps = None
 
     @classmethod
     def RegisterFormat(cls, fmt):
@@ -111,6 +112,16 @@ class FileStorage(BaseStorage, MailboxStorageMixin):
             del cd[sub_path]
 
     def get_filemap(self, path, prefer_access=mmap.ACCESS_WRITE):
+        if self.filemaps is not None:
+            # During bulk reads (see messages()), we keep the most recently
+            # used file mapped, instead of mapping it once per message.
+            if path not in self.filemaps:
+                self.filemaps.clear()
+                self.filemaps[path] = self._get_filemap(path, prefer_access)
+            return self.filemaps[path]
+        return self._get_filemap(path, prefer_access)
+
+    def _get_filemap(self, path, prefer_access):
         try:
             try:
                 with open(path, 'rb+') as fd:
@@ -304,6 +315,20 @@ class FileStorage(BaseStorage, MailboxStorageMixin):
     def can_handle_ptr(self, ptr):
         return (ptr.ptr_type == Metadata.PTR.IS_FS)
 
+    def read_order(self, ptr):
+        # Group messages by file, and order by position within the file if
+        # the format can tell us (mailzip).
+        try:
+            paths = self.key_to_paths(ptr.ptr_path)
+        except (ValueError, KeyError):
+            return (ptr.ptr_path, 0)
+        offset = 0
+        if len(paths) == 2:
+            fmt = FORMATS.get(paths[1][0])
+            if hasattr(fmt, 'ReadOffset'):
+                offset = fmt.ReadOffset(self, paths[0], paths[1][1])
+        return (dumb_encode_asc(paths[0]), offset)
+
 
 if __name__ == "__main__":
     import sys
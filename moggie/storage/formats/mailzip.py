@@ -18,12 +18,42 @@ from .base import FormatBytes
 COUNTER = 0
 
 
+class MailzipIndex:
+    """
+    The parsed central directory of a mailzip: an open (read-only) zip
+    file, the sorted list of message keys and a map of maildir idx hashes
+    to keys. Loading this is expensive for large archives, so indexes are
+    cached and reused until the file changes; see FormatMailzip.Index().
+    """
+    def __init__(self, zf, file_re):
+        self.zf = zf
+        self.keys = sorted(['/' + i.filename
+            for i in zf.infolist() if file_re.search(i.filename)])
+        self._by_hash = None
+
+    def by_hash(self):
+        if self._by_hash is None:
+            by_hash = {}
+            for i, key in enumerate(self.keys):
+                (p, h) = unpack_maildir_idx(mk_maildir_idx(key[1:], i))
+                by_hash.setdefault(h, []).append((i, key))
+            self._by_hash = by_hash
+        return self._by_hash
+
+    def offset(self, key):
+        return self.zf.getinfo(key[1:]).header_offset
+
+
 class FormatMailzip(FormatBytes):
     NAME = 'mailzip'
     TAG = b'mz'
 
     FILE_RE = re.compile(r'(^|/)(cur|new)/[^/]+[:;-]2,[^/]*$')
 
+    # Cached MailzipIndex objects, by path: path -> (stat info, index)
+    INDEXES = {}
+    INDEXES_MAX = 10
+
     @classmethod
     def Zipfile(self, parent, key, mode='a'):
         if hasattr(key, 'fileno'):
@@ -33,42 +63,77 @@ class FormatMailzip(FormatBytes):
                 key = bytes(key, 'utf-8')
             return zipfile.AESZipFile(parent.key_to_path(key), mode=mode)
 
+    @classmethod
+    def Index(cls, parent, key):
+        """
+        Return a MailzipIndex for the given mailzip, using our cache if the
+        file has not changed since we last read its central directory.
+        """
+        if hasattr(key, 'fileno'):
+            return MailzipIndex(cls.Zipfile(parent, key, mode='r'), cls.FILE_RE)
+
+        path = parent.key_to_path(
+            bytes(key, 'utf-8') if isinstance(key, str) else key)
+        st = os.stat(path)
+        sig = (st.st_size, st.st_mtime_ns, st.st_ino)
+        cached = cls.INDEXES.get(path)
+        if cached and cached[0] == sig:
+            return cached[1]
+
+        # Note: pyzipper only accepts str paths, not bytes.
+        zf = zipfile.AESZipFile(os.fsdecode(path), mode='r')
+        index = MailzipIndex(zf, cls.FILE_RE)
+        while len(cls.INDEXES) >= cls.INDEXES_MAX:
+            cls.INDEXES.pop(next(iter(cls.INDEXES)))
+        cls.INDEXES[path] = (sig, index)
+        return index
+
     @classmethod
     def Magic(cls, parent, key, info=None, is_dir=None):
         if is_dir:
             return False
         try:
-            with cls.Zipfile(parent, key, mode='r') as zf:
-                for name in zf.namelist():
-                    if cls.FILE_RE.search(name):
-                        return True
-            return False
+            return bool(cls.Index(parent, key).keys)
         except (zipfile.BadZipFile, IOError, OSError):
             return False
 
+    @classmethod
+    def ReadOffset(cls, parent, path, key):
+        try:
+            if isinstance(key, bytes):
+                key = str(key, 'utf-8')
+            return cls.Index(parent, path).offset(key)
+        except (KeyError, zipfile.BadZipFile, IOError, OSError):
+            return 0
+
     def __init__(self, parent, path, container, **kwargs):
         super().__init__(parent, path, container, **kwargs)
-        self.zf = self.Zipfile(parent, path[0], mode='r')
+        self.index = self.Index(parent, path[0])
+        self.zf = self.index.zf
+        self.password = None
         password = kwargs.get('password')
         if password:
             self.unlock(None, password)
 
     def unlock(self, ignored_username, password, ask_key=None, set_key=None):
+        # Note: The zip file object is shared (cached), so we pass our
+        #       password to open() instead of calling setpassword().
         if password:
             if not isinstance(password, bytes):
                 password = bytes(password, 'utf-8')
             self.password = password
-            self.zf.setpassword(password)
         return self
 
     def __contains__(self, key):
-        return key[1:] in self.zf
+        if isinstance(key, bytes):
+            key = str(key, 'utf-8')
+        return key[1:] in self.zf.NameToInfo
 
     def __getitem__(self, key):
         if isinstance(key, bytes):
             key = str(key, 'utf-8')
         try:
-            with self.zf.open(key[1:], 'r') as fd:
+            with self.zf.open(key[1:], 'r', pwd=self.password) as fd:
                 return fd.read()
         except RuntimeError as e:
             try:
@@ -95,8 +160,7 @@ class FormatMailzip(FormatBytes):
         raise IOError('FIXME: Cannot add to mailzips yet')
 
     def keys(self):
-        return sorted(['/' + i.filename
-            for i in self.zf.infolist() if self.FILE_RE.search(i.filename)])
+        return list(self.index.keys)
 
     def compare_idxs(self, idx1, idx2):
         (p1, h1) = unpack_maildir_idx(idx1)
@@ -109,17 +173,21 @@ class FormatMailzip(FormatBytes):
 
         if ids:
             # Our IDs are entirely based on the keys, not the data. So if
-            # ids are requested, we can avoid loading all the mail.
+            # ids are requested, we can look them up in our index and
+            # avoid loading all the mail. They are read in the order they
+            # are stored within the file, to minimize seeking.
+            by_hash = self.index.by_hash()
             h_ids = set([h for h in
                 (unpack_maildir_idx(i)[1] for i in ids) if h])
             def _iterator():
-                for i, key in enumerate(self.keys()):
-                    (p, h) = unpack_maildir_idx(mk_maildir_idx(key[1:], i))
-                    if h in h_ids:
-                        yield i, key
+                found = []
+                for h in h_ids:
+                    found.extend(by_hash.get(h, []))
+                found.sort(key=lambda ik: self.index.offset(ik[1]))
+                yield from found
         else:
             def _iterator():
-                yield from enumerate(self.keys())
+                yield from enumerate(self.index.keys)
 
         iterator = _iterator()
         if reverse:
@@ -163,5 +231,10 @@ if __name__ == "__main__":
         print('=== %s (%d) ===' % (path, len(md)))
         print('%s' % '\n'.join(md.keys()))
         print('%s' % '\n'.join('%s' % m for m in md.iter_email_metadata(reverse=True)))
+
+        # Looking up by ID uses the index, and reads in file order
+        some = [m.idx for m in md.iter_email_metadata()][::3]
+        found = [m.idx for m in md.iter_email_metadata(ids=some)]
+        assert(sorted(found) == sorted(some))
         print('=== %s (%d) ===' % (path, len(md)))
 
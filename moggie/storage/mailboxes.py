@@ -27,6 +27,13 @@ class MailboxStorageMixin:
                 return True
         return False
 
+    def read_order(self, ptr):
+        """
+        Returns a (container, position) sort key for a pointer, used to
+        order bulk reads (see messages()).
+        """
+        return (ptr.ptr_path, 0)
+
     def unlock_mailbox(self, mailbox, username, password, context, sec_ttl):
         if hasattr(mailbox, 'unlock'):
             _unlock_kwa = {}
@@ -122,6 +129,34 @@ class MailboxStorageMixin:
 
         raise KeyError('Not found: %s' % _u(dumb_decode(ptr.ptr_path)))
 
+    def messages(self, metadata_list, **kwargs):
+        """
+        Yields (metadata, bytes) tuples for a list of messages; the bytes
+        will be None if a message could not be loaded. Messages are loaded
+        one mailbox at a time, rather than in the order requested, so each
+        mailbox only needs to be opened (or mapped into memory) once.
+        Within a mailbox, messages are read in the order they are stored,
+        where we know it (see read_order()).
+        """
+        def _location(md):
+            for ptr in md.pointers:
+                if self.can_handle_ptr(ptr):
+                    return self.read_order(ptr) + (ptr.ptr_path,)
+            return ('', 0, '')
+
+        bulk = hasattr(self, 'filemaps')
+        if bulk:
+            self.filemaps = {}
+        try:
+            for md in sorted(metadata_list, key=_location):
+                try:
+                    yield md, self.message(md, **kwargs)
+                except (KeyError, OSError, IOError):
+                    yield md, None
+        finally:
+            if bulk:
+                self.filemaps = None
+
     def parse_message(self, metadata, **kwargs):
         msg = self.message(metadata, **kwargs)
         return ep_parse_message(msg, fix_mbox_from=(msg[:5] == b'From '))
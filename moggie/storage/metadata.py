@@ -1,3 +1,4 @@
+import bisect
 import copy
 import io
 import logging
@@ -6,11 +7,14 @@ import struct
 import time
 import zlib
 
+import numpy
+
 from mmap import mmap, ACCESS_WRITE
 
 from .records import RecordStore
 from ..email.metadata import Metadata
 from ..util.dumbcode import dumb_decode, dumb_encode_asc, dumb_encode_bin
+from ..util.intset import IntSet
 
 
 # This is not actually a valid Metadata entry, but it contains strings we
@@ -73,6 +77,51 @@ class IntColumn:
         _fmt = 'I' * (len(self.ranking) // self.int_size)
         return struct.unpack(_fmt, self.ranking)
 
+    def npa(self):
+        """
+        Return a numpy array of the raw (unadjusted) column values, where
+        zero means the value is unset.
+        """
+        return numpy.frombuffer(bytes(self.ranking), dtype=numpy.uint32)
+
+    def in_range(self, beg, end=None):
+        """
+        Return an IntSet of the indexes whose values are set and within the
+        range beg <= value < end. If end is None, the range is open-ended.
+        """
+        values = self.npa()
+        mask = (values >= max(1, beg - self.baseline))
+        if end is not None:
+            mask &= (values < max(0, end - self.baseline))
+        return IntSet.FromMask(mask)
+
+    def set_many(self, idxs, value):
+        """
+        Set the same value for many indexes at once, which is much faster
+        than setting them one by one.
+        """
+        idxs = numpy.asarray(idxs, dtype=numpy.int64)
+        if not len(idxs):
+            return
+        self[int(idxs.max())] = value  # Grows the file if necessary
+        values = numpy.frombuffer(self.ranking, dtype=numpy.uint32)
+        values[idxs] = max(self.baseline + 1, value) - self.baseline
+        del values  # Release our reference to the mmap
+
+    def set_values(self, idxs, values):
+        """
+        Set many indexes to (different) values at once. Indexes must be
+        unique, values are adjusted the same way as by __setitem__.
+        """
+        idxs = numpy.asarray(idxs, dtype=numpy.int64)
+        if not len(idxs):
+            return
+        values = numpy.asarray(values, dtype=numpy.int64)
+        self[int(idxs.max())] = 1  # Grows the file if necessary
+        column = numpy.frombuffer(self.ranking, dtype=numpy.uint32)
+        column[idxs] = numpy.maximum(self.baseline + 1, values) - self.baseline
+        del column  # Release our reference to the mmap
+
     def __iter__(self):
         return (i for (i, v) in enumerate(self.values()) if v > 0)
 
@@ -150,6 +199,7 @@ class MetadataStore(RecordStore):
         self.thread_ids = IntColumn(os.path.join(workdir, 'threads'))
         self.mtimes = IntColumn(os.path.join(workdir, 'mtimes'))
         self.thread_cache = None
+        self.pending_ranks = None
 
         if 0 not in self:
             record_0 = Metadata.ghost('<internal-ghost-zero@moggie>')
@@ -165,6 +215,7 @@ class MetadataStore(RecordStore):
 
     def delete_everything(self, *args):
         super().delete_everything(*args)
+        self.thread_cache = None
         for f in ('timestamps', 'threads', 'mtimes'):
             if os.path.exists(os.path.join(self.workdir, f)):
                  os.remove(os.path.join(self.workdir, f))
@@ -221,13 +272,15 @@ class MetadataStore(RecordStore):
             root.more.get('thread', []) + [idx] + thread + kids)))
         self.set(tid, root, rerank=False)
 
+        # Only former thread roots have a list of kids to get rid of, so
+        # that is the only time we need to rewrite the kid's metadata.
         for kid in set(kids + thread):
             try:
                 km = self[kid]
                 if 'thread' in km.more:
                     del km.more['thread']
-                self.set(kid, km, rerank=False)
-                self.thread_ids[kid] = self.thread_id = tid
+                    self.set(kid, km, rerank=False)
+                self._set_thread_id(kid, tid)
             except KeyError:
                 pass
 
@@ -252,8 +305,12 @@ class MetadataStore(RecordStore):
         if mtime:
             metadata.mtime = mtime = int(time.time())
             self.mtimes[idx] = (metadata.mtime // self.TS_RESOLUTION)
-            self.rank_by_date[idx] = max(
+            rank = max(
                 1, min(mtime, int(metadata.timestamp) // self.TS_RESOLUTION))
+            if self.pending_ranks is not None:
+                self.pending_ranks[idx] = rank
+            else:
+                self.rank_by_date[idx] = rank
             changed = True
 
         if threading:
@@ -263,8 +320,7 @@ class MetadataStore(RecordStore):
             if metadata[metadata.OFS_THREAD_ID] in (None, 0, idx):
                 changed = self._add_to_thread(idx, metadata) or changed
 
-            self.thread_ids[idx] = metadata.thread_id
-            self.thread_cache = None
+            self._set_thread_id(idx, metadata.thread_id)
 
         return changed
 
@@ -347,6 +403,42 @@ class MetadataStore(RecordStore):
         else:
             return self.set(all_keys, self._clean(metadata))
 
+    def add_many(self, metadatas, update=True, **key_kwargs):
+        """
+        Add many messages to the index at once, returning a tuple of lists
+        (added, updated) of metadata indexes. Existing messages are updated
+        if `update` is set, otherwise they are left alone.
+
+        The results are the same as calling update_or_add() or add_if_new()
+        for each message in turn (so messages may thread with each other),
+        but the store is only locked once, record writes are coalesced
+        and the date ranking is updated in one go at the end.
+        """
+        added, updated = [], []
+        with self.batch():
+            outermost = (self.pending_ranks is None)
+            if outermost:
+                self.pending_ranks = {}
+            try:
+                for metadata in metadatas:
+                    if update:
+                        is_new, idx = self.update_or_add(metadata,
+                            **key_kwargs)
+                    else:
+                        is_new = False
+                        idx = self.add_if_new(metadata, **key_kwargs)
+                    if idx:
+                        if is_new:
+                            added.append(idx)
+                        else:
+                            updated.append(idx)
+            finally:
+                if outermost:
+                    ranks, self.pending_ranks = self.pending_ranks, None
+                    self.rank_by_date.set_values(
+                        list(ranks.keys()), list(ranks.values()))
+        return added, updated
+
     def append(self, metadata,
             extra_keys=[], imap_keys=False, fs_path_keys=False,
             **kwargs):
@@ -358,12 +450,13 @@ class MetadataStore(RecordStore):
                     imap_keys=imap_keys, fs_path_keys=fs_path_keys))
                 + extra_keys) or None
 
-        # FIXME: This almost always writes twice, because of the ranking.
-        #        It would be nice if that were not the case!
+        # Ranking almost always updates the record we just appended, so
+        # we batch the writes and only the final version hits the disk.
         metadata = self._clean(metadata)
-        idx = super().append(metadata, **kwargs)
-        if self._rank(idx, metadata):
-            super().set(idx, metadata)
+        with self.batch():
+            idx = super().append(metadata, **kwargs)
+            if self._rank(idx, metadata):
+                super().set(idx, metadata)
 
         return idx
 
@@ -401,17 +494,57 @@ class MetadataStore(RecordStore):
         # FIXME: Fetch the item, delete all the pointers!
         super().__delitem__(key)
         idx = self.key_to_index(key)
+        if self.pending_ranks:
+            self.pending_ranks.pop(idx, None)
         del self.rank_by_date[idx]
-        del self.thread_ids[idx]
+        self._set_thread_id(idx, None)
         del self.mtimes[idx]
-        self.thread_cache = None
+
+    def _set_thread_id(self, idx, tid):
+        """
+        Record which thread a message belongs to (None to forget), keeping
+        the thread cache up to date in O(thread size).
+        """
+        try:
+            old_tid = self.thread_ids[idx]
+        except (IndexError, KeyError):
+            old_tid = None
+        if old_tid == tid:
+            return
+
+        if tid is None:
+            del self.thread_ids[idx]
+        else:
+            self.thread_ids[idx] = tid
+
+        cache = self.thread_cache
+        if cache is None:
+            return
+        if (old_tid is not None) and (old_tid != idx):
+            members = cache.get(old_tid)
+            if members:
+                pos = bisect.bisect_left(members, idx, 1)
+                if pos < len(members) and members[pos] == idx:
+                    del members[pos]
+                if len(members) < 2:
+                    del cache[old_tid]
+        if (tid is not None) and (tid != idx):
+            members = cache.get(tid)
+            if members is None:
+                cache[tid] = [tid, idx]
+            else:
+                bisect.insort(members, idx, 1)
 
     def _make_thread_cache(self):
-        pairs = [(t, i) for i, t in self.thread_ids.items()]
-        pairs.sort()
+        tids = self.thread_ids.npa()
+        idxs = numpy.flatnonzero(tids)
+        tids = tids[idxs].astype(numpy.int64) + self.thread_ids.baseline
+        order = numpy.lexsort((idxs, tids))
+        idxs, tids = idxs[order].tolist(), tids[order].tolist()
+
         cur = [-1]
         self.thread_cache = {}
-        for t, i in pairs:
+        for t, i in zip(tids, idxs):
             if t != cur[0]:
                 if len(cur) > 1:
                     self.thread_cache[cur[0]] = cur
@@ -422,9 +555,12 @@ class MetadataStore(RecordStore):
             self.thread_cache[cur[0]] = cur
 
     def get_thread_idxs(self, thread_id):
+        """
+        Return a list of the messages in a thread, the thread ID first.
+        """
         if self.thread_cache is None:
             self._make_thread_cache()
-        return self.thread_cache.get(thread_id, [thread_id])
+        return list(self.thread_cache.get(thread_id, [thread_id]))
 
     def date_sorting_keyfunc(self, key):
         """
@@ -437,6 +573,18 @@ class MetadataStore(RecordStore):
         except (IndexError, KeyError):
             return (0, idx)
 
+    def date_range(self, beg_ts, end_ts=None):
+        """
+        Return an IntSet of the messages dated beg_ts <= timestamp < end_ts.
+
+        Dates are stored with TS_RESOLUTION accuracy, so if the boundaries
+        are not multiples of TS_RESOLUTION, results may be off by a few
+        seconds at either end.
+        """
+        R = self.TS_RESOLUTION
+        return self.rank_by_date.in_range(beg_ts // R,
+            None if (end_ts is None) else (end_ts // R))
+
     def thread_sorting_keyfunc(self, key):
         """
         For use with [].sort(key=...)
@@ -543,6 +691,22 @@ Subject: Sure, sure
 
     times = set([t1M //  MetadataStore.TS_RESOLUTION])
     assert(len(list(ms.rank_by_date.items(grep=times.__contains__))) == 1)
+    assert(1000000 in ms.date_range(t1M - 16, t1M + 16))
+    assert(1000000 not in ms.date_range(0, t1M - 16))
+    assert(ms.date_range(t1M + 16).count() == 0)
+
+    # Threads are tracked incrementally, as messages arrive
+    parent = ms['<202109010003.181031O6020231@example.org>']
+    assert(ms[i1].thread_id == parent.idx)
+    assert(ms.get_thread_idxs(parent.idx) == [parent.idx, i1])
+    _, i3 = ms.update_or_add(Metadata(now, 0, foo_ptr, b'''\
+Message-Id: <202109010003.181031O6020235@example.org>
+In-Reply-To: <202109010003.181031O6020234@example.org>
+Subject: Re: Sure, sure'''))
+    assert(ms.get_thread_idxs(parent.idx) == [parent.idx, i1, i3])
+    del ms[i3]
+    assert(ms.get_thread_idxs(parent.idx) == [parent.idx, i1])
+    assert(ms.get_thread_idxs(i3) == [i3])
 
     del ms[100000]
     try:
@@ -1,13 +1,15 @@
 import binascii
+import bisect
 import copy
 import hashlib
 import io
 import logging
+import multiprocessing
 import time
 import os
 import re
-import random
 import struct
+import threading
 import traceback
 
 from mmap import mmap, ACCESS_READ, ACCESS_WRITE
@@ -70,7 +72,9 @@ class RecordFile:
         self.header_size += (len(self.prefix) + self.int_size + self.long_size)
         self.compress = compress
         self.padding = b' ' * padding
-        self.empties = []
+        self.empties = None
+        self.empty_bytes = 0
+        self.batch = None
 
         self.encoding_kwargs = encoding_kwargs
         if self.encoding_kwargs is None:
@@ -110,6 +114,54 @@ class RecordFile:
         if (marker > 0) and marker != self.fd.tell():
             raise ValueError('File (marker=%d) is corrupt, help!' % marker)
 
+    def get_empties(self):
+        """
+        Return our free-space map: a size-ordered list of (length, offset)
+        slots which can be reused by set(). The map is rebuilt lazily from
+        the offset table, so it survives restarts without needing a file
+        of its own: anything between the end of one live record and the
+        start of the next is free space.
+        """
+        if self.empties is not None:
+            return self.empties
+
+        live = []
+        for idx, ofs in enumerate(self.offsets):
+            if ofs > 0:
+                try:
+                    rec_end = ofs + 2*self.int_size + self.length(idx)
+                    live.append((ofs, rec_end))
+                except (IndexError, struct.error):
+                    # Something is off; play it safe and reuse nothing.
+                    self.empties = []
+                    return self.empties
+        live.append((os.fstat(self.fd.fileno()).st_size, 0))
+        live.sort()
+
+        self.empties, self.empty_bytes = [], 0
+        pos = self.header_size
+        for beg, end in live:
+            if beg - pos > 2*self.int_size:
+                self._add_empty(beg - pos - 2*self.int_size, pos)
+            pos = max(pos, end)
+        return self.empties
+
+    def _add_empty(self, length, ofs):
+        bisect.insort(self.empties, (length, ofs))
+        self.empty_bytes += length + 2*self.int_size
+
+    def fragmentation(self):
+        """
+        Return statistics about how much of this file is wasted space.
+        """
+        empties = self.get_empties()
+        data_bytes = os.fstat(self.fd.fileno()).st_size - self.header_size
+        return {
+            'bytes': data_bytes,
+            'free_bytes': self.empty_bytes,
+            'free_slots': len(empties),
+            'free_ratio': (self.empty_bytes / data_bytes) if data_bytes else 0}
+
     def __getitem__(self, idx):
         ts = time.time()
         rv = self.get(idx, default=ts)
@@ -146,6 +198,9 @@ class RecordFile:
     def __delitem__(self, idx):
         if not (0 <= idx < self.chunk_records):
             raise IndexError('Out of bounds: %d' % idx)
+        ofs = self.offsets[idx]
+        if (ofs > 0) and (self.empties is not None):
+            self._add_empty(self.length(idx), ofs)
         beg = idx * self.int_size + len(self.prefix)
         end = beg + self.int_size
         self.safe_mmap(end)[beg:end] = struct.pack('I', 0)
@@ -197,9 +252,12 @@ class RecordFile:
         else:
             return bytes(self.safe_mmap(end)[beg:end])
 
-    def set(self, idx, value, encode=True, encrypt=True, aes_key=None):
+    def set(self, idx, value,
+            encode=True, encrypt=True, aes_key=None, pad=None):
         if not (0 <= idx < self.chunk_records):
             raise IndexError('Out of bounds: %d' % idx)
+        if pad is None:
+            pad = encode
 
         ofs = self.offsets[idx]
         cur_len = self.length(idx) if (ofs > 0) else 0
@@ -224,19 +282,26 @@ class RecordFile:
         moved = append = (ofs < 1) or (enc_len > cur_len)
         pad_len = min(16*1024, max(int(0.15 * enc_len), len(self.padding)))
         if append:
-            if ofs > 0:
-                self.empties.append((cur_len, ofs))
+            empties = self.get_empties()
+            if (ofs > 0) and (self.batch is not None):
+                # Not reused until the batch is done and nothing points here
+                self.batch['freed'].append((cur_len, ofs))
+            elif ofs > 0:
+                self._add_empty(cur_len, ofs)
             target_len = enc_len + pad_len
-            for pair in self.empties:
-                _ln, _ofs = pair
-                if target_len <= _ln < enc_len*2:
-                    cur_len, ofs, append = _ln, _ofs, False
-                    break
-            if not append:
-                self.empties.remove(pair)
+            i = bisect.bisect_left(empties, (target_len, 0))
+            if i < len(empties):
+                # Best fit; if there is room to spare, split the slot.
+                cur_len, ofs = empties.pop(i)
+                self.empty_bytes -= cur_len + 2*self.int_size
+                spare = cur_len - target_len - 2*self.int_size
+                if spare >= 64:
+                    self._add_empty(spare, ofs + 2*self.int_size + target_len)
+                    cur_len = target_len
+                append = False
 
         padding = b''
-        if encode:
+        if pad:
             if append and self.padding:
                 # Always waste a bit of space, to facilitate overwrites later
                 padding = b' ' * pad_len
@@ -248,7 +313,9 @@ class RecordFile:
         encoded = padding + encoded
         enc_len = len(encoded)
         rec_len = (2*self.int_size) + enc_len
-        if append:
+        if append and (self.batch is not None):
+            ofs = self.batch['end']
+        elif append:
             self.fd.seek(0, io.SEEK_END)
             ofs = self.fd.tell()
 
@@ -257,23 +324,58 @@ class RecordFile:
 
         if not append:
             end = ofs + rec_len
-            self.mmap[ofs:end] = (enc_iofs + enc_ilen + encoded)
+            self.safe_mmap(end)[ofs:end] = (enc_iofs + enc_ilen + encoded)
+        elif self.batch is not None:
+            self.batch['data'].append(enc_iofs + enc_ilen + encoded)
+            self.batch['end'] += rec_len
         else:
             self.fd.write(enc_iofs + enc_ilen + encoded)
 
-        if moved:
+        if moved and (self.batch is not None):
+            self.batch['moved'].append((idx, ofs))
+        elif moved:
             # Unsafe mmap usage follows, this is just the index
             beg = idx * self.int_size + len(self.prefix)
             end = beg + self.int_size
             self.mmap[beg:end] = struct.pack('I', ofs)
             self.offsets[idx] = ofs
-        if append:
+        if append and (self.batch is None):
             # Record how long the chunk file should be; if this does not
             # match we know we died mid-operation and may be corrupt.
             beg = self.int_size * self.chunk_records + len(self.prefix)
             end = beg + self.int_size
             self.mmap[beg:end] = struct.pack('I', self.fd.tell())
 
+    def set_many(self, items):
+        """
+        Write many records at once, from a list of (idx, value, kwargs)
+        tuples, where the kwargs are as for set() and each idx appears only
+        once. New and grown records are appended with a single write, and
+        the offset table and end-of-file marker are updated once at the end.
+        """
+        self.fd.seek(0, io.SEEK_END)
+        self.batch = batch = {
+            'data': [], 'end': self.fd.tell(), 'moved': [], 'freed': []}
+        try:
+            for idx, value, kwargs in items:
+                self.set(idx, value, **kwargs)
+        finally:
+            self.batch = None
+
+        if batch['data']:
+            self.fd.seek(0, io.SEEK_END)
+            self.fd.write(b''.join(batch['data']))
+        mmap = self.safe_mmap(self.header_size)
+        for idx, ofs in batch['moved']:
+            beg = idx * self.int_size + len(self.prefix)
+            mmap[beg:beg + self.int_size] = struct.pack('I', ofs)
+            self.offsets[idx] = ofs
+        if batch['data']:
+            beg = self.int_size * self.chunk_records + len(self.prefix)
+            mmap[beg:beg + self.int_size] = struct.pack('I', self.fd.tell())
+        for cur_len, ofs in batch['freed']:
+            self._add_empty(cur_len, ofs)
+
     def close(self):
         self.mmap.close()
         self.mmap = None
@@ -281,9 +383,7 @@ class RecordFile:
         self.fd = None
 
     def _rotate(self, src, dst):
-        if os.path.exists(dst):
-            os.remove(dst)
-        os.rename(src, dst)
+        os.replace(src, dst)
 
     def compacted_time(self):
         end = self.header_size
@@ -295,22 +395,37 @@ class RecordFile:
         beg = end - self.long_size
         self.mmap[beg:end] = struct.pack('Q', int(time.time()))
 
-    def compact(self,
+    def needs_compacting(self,
             new_aes_key=None, target=None, padding=None, force=False):
+        return (force
+            or not (new_aes_key is False or new_aes_key == self.aes_key)
+            or (padding is not None)
+            or (target is not None)
+            or (os.path.getmtime(self.path) - self.compacted_time() >= 5))
+
+    def compact(self,
+            new_aes_key=None, target=None, padding=None, force=False,
+            skip_errors=False):
+        """
+        Write a compacted copy of this file, and return it. If target is
+        None, the copy replaces this file (which gets closed).
+
+        If skip_errors is set, records which cannot be read are left out
+        instead of raising, and a tuple (compacted, skipped) is returned,
+        skipped being a list of the indexes which were left out. The
+        caller must make sure they get replayed (or give up).
+        """
         tempfile = self.path + '.tmp'
         if os.path.exists(tempfile):
             os.remove(tempfile)
 
-        if ((not force)
-                and (new_aes_key is False or new_aes_key == self.aes_key)
-                and (padding is None)
-                and (target is None)
-                and (os.path.getmtime(self.path) - self.compacted_time() < 5)):
+        if not self.needs_compacting(new_aes_key, target, padding, force):
             logging.info('compact: No changes, doing nothing')
-            return self
+            return (self, []) if skip_errors else self
 
         aes_keys = copy.copy(self.aes_keys)
-        if new_aes_key and (new_aes_key != self.aes_key):
+        rekey = new_aes_key and (new_aes_key != self.aes_key)
+        if rekey:
             fid = self.file_id
             fid = (fid.encode('utf-8') if isinstance(fid, str) else fid)
             aes_keys.append(make_aes_key(fid, new_aes_key))
@@ -323,9 +438,24 @@ class RecordFile:
             aes_keys=aes_keys,
             create=True,
             derive=False)
+        skipped = []
         for i in range(0, self.chunk_records):
             if i in self:
-                compacted[i] = self[i]
+                try:
+                    if rekey:
+                        compacted[i] = self[i]
+                    else:
+                        # Our keys are all still valid, so we can skip the
+                        # decrypt/decode/encode/encrypt cycle and copy the
+                        # raw record (minus old padding) as-is.
+                        raw = self.get(i, decode=False).lstrip(b' ')
+                        compacted.set(i, raw, encode=False, pad=True)
+                except Exception:
+                    # If someone else is writing to the file, records may
+                    # move while we read. The caller must then replay.
+                    if not skip_errors:
+                        raise
+                    skipped.append(i)
         compacted.mark_compacted()
         compacted.padding = self.padding
 
@@ -340,7 +470,44 @@ class RecordFile:
         if backup:
             os.remove(backup)
 
-        return compacted
+        return (compacted, skipped) if skip_errors else compacted
+
+
+def _compact_record_file(args, encoding_kwargs=None, decoding_kwargs=None):
+    """
+    Write a compacted copy of a RecordFile (the next generation) next to
+    the original, which may still be in use. This may run in a worker
+    process, so we open our own private copy of the file.
+
+    Returns a (path, aes_keys, skipped) tuple describing the copy, or
+    None. Skipped is a list of the records which could not be copied.
+    """
+    path, file_id, chunk_records, compress, aes_keys, new_aes_key, force = args
+    for tries in range(0, 10):
+        try:
+            rf = RecordFile(path, file_id, chunk_records,
+                compress=compress,
+                encoding_kwargs=encoding_kwargs,
+                decoding_kwargs=decoding_kwargs,
+                aes_keys=aes_keys,
+                derive=False)
+            break
+        except ValueError:
+            # The file is being appended to, try again in a moment
+            if tries >= 9:
+                raise
+            time.sleep(0.05)
+    try:
+        if not rf.needs_compacting(new_aes_key=new_aes_key, force=force):
+            return None
+        target = path + '.next'
+        compacted, skipped = rf.compact(
+            new_aes_key=new_aes_key, target=target, force=force,
+            skip_errors=True)
+        compacted.close()
+        return (target, compacted.aes_keys, skipped)
+    finally:
+        rf.close()
 
 
 class RecordStoreReadOnly:
@@ -385,6 +552,11 @@ class RecordStoreReadOnly:
             self.aes_key = self.aes_keys[-1]
         self.hashfunc = hashfunc
 
+        self.lock = threading.RLock()
+        self.dirty = {}
+        self.batched = None
+        self.batch_depth = 0
+
         self.int_size = len(struct.pack('I', 0))
         self.hash_size = len(self.hashfunc(self.salt, 'testing'))
         self.hash_zero = b'\0' * self.hash_size
@@ -431,15 +603,16 @@ class RecordStoreReadOnly:
             for fn in fns)
 
     def refresh(self, force=False):
-        modified = self.getmtime()
-        if force or modified != self.loaded:
-            for chunk in self.chunks:
-                self.chunks[chunk].close()
-            self.chunks = {}
-            self.keys = {}
-            self.load_keys()
-            self.next_idx = self.calculate_next_idx()
-            self.loaded = modified
+        with self.lock:
+            modified = self.getmtime()
+            if force or modified != self.loaded:
+                for chunk in self.chunks:
+                    self.chunks[chunk].close()
+                self.chunks = {}
+                self.keys = {}
+                self.load_keys()
+                self.next_idx = self.calculate_next_idx()
+                self.loaded = modified
         return self
 
     def load_keys(self):
@@ -499,38 +672,65 @@ class RecordStoreReadOnly:
         idx %= self.chunk_records
         return (idx, self.chunks[chunk])
 
+    def _from_batch(self, full_idx, decode=True):
+        # If a record was written during the current batch, return
+        # (True, value). Raw reads need the batch committed first.
+        if self.batched and (full_idx in self.batched):
+            value, kwargs = self.batched[full_idx]
+            if decode and kwargs.get('encode', True):
+                return True, value
+            self._commit_batch()
+        return False, None
+
     def __contains__(self, key):
         try:
-            (idx, chunk) = self.get_chunk(self.key_to_index(key))
-            return (idx in chunk)
+            with self.lock:
+                full_idx = self.key_to_index(key)
+                if self.batched and (full_idx in self.batched):
+                    return True
+                (idx, chunk) = self.get_chunk(full_idx)
+                return (idx in chunk)
         except KeyError:
             return False
 
     def length(self, key):
-        (idx, chunk) = self.get_chunk(self.key_to_index(key))
-        return chunk.length(idx)
+        with self.lock:
+            full_idx = self.key_to_index(key)
+            self._from_batch(full_idx, decode=False)
+            (idx, chunk) = self.get_chunk(full_idx)
+            return chunk.length(idx)
 
     def __getitem__(self, key):
-        pair = (idx, chunk) = self.get_chunk(self.key_to_index(key))
-        if pair in self.cache:
-            self.cache_hits += 1
-            return self.cache[pair]
-        self.cache_misses += 1
-        return chunk[idx]
-
-    def get(self, key, decode=True, default=None, aes_key=None, cache=None):
-        try:
-            pair = (idx, chunk) = self.get_chunk(self.key_to_index(key))
-            if decode and (cache is not False) and pair in self.cache:
+        with self.lock:
+            full_idx = self.key_to_index(key)
+            found, rv = self._from_batch(full_idx)
+            if found:
+                return rv
+            pair = (idx, chunk) = self.get_chunk(full_idx)
+            if pair in self.cache:
                 self.cache_hits += 1
                 return self.cache[pair]
-
             self.cache_misses += 1
-            rv = chunk.get(idx,
-                default=default, decode=decode, aes_key=aes_key)
-            if cache and decode and (rv != default):
-                self.cache[pair] = rv
-            return rv
+            return chunk[idx]
+
+    def get(self, key, decode=True, default=None, aes_key=None, cache=None):
+        try:
+            with self.lock:
+                full_idx = self.key_to_index(key)
+                found, rv = self._from_batch(full_idx, decode=decode)
+                if found:
+                    return rv
+                pair = (idx, chunk) = self.get_chunk(full_idx)
+                if decode and (cache is not False) and pair in self.cache:
+                    self.cache_hits += 1
+                    return self.cache[pair]
+
+                self.cache_misses += 1
+                rv = chunk.get(idx,
+                    default=default, decode=decode, aes_key=aes_key)
+                if cache and decode and (rv != default):
+                    self.cache[pair] = rv
+                return rv
         except KeyError:
             return default
 
@@ -542,10 +742,13 @@ class RecordStore(RecordStoreReadOnly):
         pass
 
     def flush(self):
-        for c in self.chunks:
-            self.chunks[c].close()
-        self.chunks = {}
-        self.cache = {}
+        with self.lock:
+            if self.batched:
+                self._commit_batch()
+            for c in self.chunks:
+                self.chunks[c].close()
+            self.chunks = {}
+            self.cache = {}
 
     def close(self):
         self.flush()
@@ -562,71 +765,139 @@ class RecordStore(RecordStoreReadOnly):
             if (f == 'keys') or f.startswith('chunk-'):
                 os.remove(os.path.join(self.workdir, f))
 
+    def _mark_dirty(self, full_idx):
+        # Records changed while their chunk is being compacted get
+        # replayed into the new generation before it is swapped in.
+        if self.dirty:
+            dirty = self.dirty.get(full_idx // self.chunk_records)
+            if dirty is not None:
+                dirty.add(full_idx % self.chunk_records)
+
     def __delitem__(self, key):
-        pair = (idx, chunk) = self.get_chunk(self.key_to_index(key))
-        del chunk[idx]
-        if pair in self.cache:
-            del self.cache[pair]
-        to_delete = [
-            (k, self.keys[k][0]) for k in self.keys if self.keys[k][1] == idx]
-        try:
-            zero = struct.pack('I', 0) + self.hash_zero
-            for kh, beg in to_delete:
-                self.keys_fd.seek(beg, 0)
-                self.keys_fd.write(zero)
-                del self.keys[kh]
-        finally:
-            self.keys_fd.seek(0, io.SEEK_END)
+        with self.lock:
+            full_idx = self.key_to_index(key)
+            if self.batched:
+                self.batched.pop(full_idx, None)
+            pair = (idx, chunk) = self.get_chunk(full_idx)
+            del chunk[idx]
+            self._mark_dirty(full_idx)
+            if pair in self.cache:
+                del self.cache[pair]
+            to_delete = [
+                (k, self.keys[k][0])
+                for k in self.keys if self.keys[k][1] == idx]
+            try:
+                zero = struct.pack('I', 0) + self.hash_zero
+                for kh, beg in to_delete:
+                    self.keys_fd.seek(beg, 0)
+                    self.keys_fd.write(zero)
+                    del self.keys[kh]
+            finally:
+                self.keys_fd.seek(0, io.SEEK_END)
 
     def del_key(self, key):
-        hashed_key = self.hash_key(key)
-        try:
-            if hashed_key in self.keys:
-                beg = self.keys[hashed_key][0]
-                self.keys_fd.seek(beg, 0)
-                self.keys_fd.write(struct.pack('I', 0) + self.hash_zero)
-                del self.keys[hashed_key]
-        finally:
-            self.keys_fd.seek(0, io.SEEK_END)
+        with self.lock:
+            hashed_key = self.hash_key(key)
+            try:
+                if hashed_key in self.keys:
+                    beg = self.keys[hashed_key][0]
+                    self.keys_fd.seek(beg, 0)
+                    self.keys_fd.write(struct.pack('I', 0) + self.hash_zero)
+                    del self.keys[hashed_key]
+            finally:
+                self.keys_fd.seek(0, io.SEEK_END)
 
     def set_key(self, key, idx):
-        hashed_key = self.hash_key(key)
-        try:
-            if hashed_key in self.keys:
-                self.keys_fd.seek(self.keys[hashed_key][0], 0)
-            self.keys[hashed_key] = (self.keys_fd.tell(), idx)
-            output = struct.pack('I', idx) + hashed_key
-            self.keys_fd.write(output)
-        finally:
-            self.keys_fd.seek(0, io.SEEK_END)
+        with self.lock:
+            hashed_key = self.hash_key(key)
+            try:
+                if hashed_key in self.keys:
+                    self.keys_fd.seek(self.keys[hashed_key][0], 0)
+                self.keys[hashed_key] = (self.keys_fd.tell(), idx)
+                output = struct.pack('I', idx) + hashed_key
+                self.keys_fd.write(output)
+            finally:
+                self.keys_fd.seek(0, io.SEEK_END)
 
     def __setitem__(self, key, value):
         self.set(key, value)
 
+    def _set(self, full_idx, c_idx, chunk, value, **kwargs):
+        if self.batched is not None:
+            self.batched[full_idx] = (value, kwargs)
+        else:
+            chunk.set(c_idx, value, **kwargs)
+            self._mark_dirty(full_idx)
+
+    def _commit_batch(self):
+        batched, self.batched = self.batched, {}
+        by_chunk = {}
+        for full_idx in sorted(batched):
+            value, kwargs = batched[full_idx]
+            c_idx = full_idx % self.chunk_records
+            by_chunk.setdefault(full_idx - c_idx, []).append(
+                (c_idx, value, kwargs))
+        for idx, items in by_chunk.items():
+            self.get_chunk(idx, create=True)[1].set_many(items)
+        for full_idx in batched:
+            self._mark_dirty(full_idx)
+
+    def batch(self):
+        """
+        Group writes together: within `with store.batch(): ...`, records
+        are buffered in memory and written when the (outermost) batch ends.
+        Repeated writes to the same record are coalesced, and each chunk
+        gets a single append and one header update per batch.
+
+        The store is locked for the duration of the batch, so other
+        threads see either none or all of its writes.
+        """
+        store = self
+        class ctx:
+            def __enter__(self, *args):
+                store.lock.acquire()
+                store.batch_depth += 1
+                if store.batched is None:
+                    store.batched = {}
+                return store
+            def __exit__(self, *args):
+                try:
+                    store.batch_depth -= 1
+                    if not store.batch_depth:
+                        try:
+                            store._commit_batch()
+                        finally:
+                            store.batched = None
+                finally:
+                    store.lock.release()
+        return ctx()
+
     def set(self, keys, value,
             encode=True, encrypt=True, aes_key=None, cache=False):
         keys = keys if isinstance(keys, list) else [keys]
         for key in keys[1:]:
             if isinstance(key, int):
                 raise ValueError('Int keys must be first')
-        try:
-            full_idx = self.key_to_index(keys[0])
-            pair = (c_idx, chunk) = self.get_chunk(full_idx, create=self.sparse)
-            chunk.set(c_idx, value,
-                encode=encode, encrypt=encrypt, aes_key=aes_key)
-            if encode and (cache or pair in self.cache):
-                self.cache[pair] = value
-            for key in keys[1:]:
-                self.set_key(key, full_idx)
-            if full_idx >= self.next_idx:
-                self.next_idx = full_idx + 1
-            return full_idx
-        except KeyError:
-            if isinstance(keys[0], int):
-                raise
-        return self.append(value,
-            keys=keys, encode=encode, encrypt=encrypt, aes_key=aes_key,
-            cache=cache)
+        with self.lock:
+            try:
+                full_idx = self.key_to_index(keys[0])
+                pair = (c_idx, chunk) = self.get_chunk(
+                    full_idx, create=self.sparse)
+                self._set(full_idx, c_idx, chunk, value,
+                    encode=encode, encrypt=encrypt, aes_key=aes_key)
+                if encode and (cache or pair in self.cache):
+                    self.cache[pair] = value
+                for key in keys[1:]:
+                    self.set_key(key, full_idx)
+                if full_idx >= self.next_idx:
+                    self.next_idx = full_idx + 1
+                return full_idx
+            except KeyError:
+                if isinstance(keys[0], int):
+                    raise
+            return self.append(value,
+                keys=keys, encode=encode, encrypt=encrypt, aes_key=aes_key,
+                cache=cache)
 
     def append(self, value,
             keys=None, encode=True, encrypt=True, aes_key=None, cache=False):
@@ -635,44 +906,166 @@ class RecordStore(RecordStoreReadOnly):
                 if isinstance(key, int):
                     raise KeyError('Keys must not be ints')
 
-        full_idx = len(self)
-        pair = (c_idx, chunk) = self.get_chunk(full_idx, create=True)
-        chunk.set(c_idx, value, encode=encode, encrypt=encrypt, aes_key=aes_key)
-        if encode and (cache or pair in self.cache):
-            self.cache[pair] = value
-        if full_idx >= self.next_idx:
-            self.next_idx = full_idx + 1
+        with self.lock:
+            full_idx = len(self)
+            pair = (c_idx, chunk) = self.get_chunk(full_idx, create=True)
+            self._set(full_idx, c_idx, chunk, value,
+                encode=encode, encrypt=encrypt, aes_key=aes_key)
+            if encode and (cache or pair in self.cache):
+                self.cache[pair] = value
+            if full_idx >= self.next_idx:
+                self.next_idx = full_idx + 1
 
-        if keys is not None:
-            for key in (keys if isinstance(keys, list) else [keys]):
-                self.set_key(key, full_idx)
+            if keys is not None:
+                for key in (keys if isinstance(keys, list) else [keys]):
+                    self.set_key(key, full_idx)
+
+            return full_idx
+
+    def _drop_cached_chunk(self, chunk_obj):
+        for pair in [p for p in self.cache if p[1] is chunk_obj]:
+            del self.cache[pair]
 
-        return full_idx
+    def _swap_chunk(self, chunk_idx, compacted_path, aes_keys, skipped, rekey):
+        """
+        Replace a live chunk with its compacted next generation, after
+        replaying any writes which happened while the copy was being made.
+        Only this step blocks other readers and writers.
+
+        Records which could not be copied are only expected if they were
+        being written at the time; if any others are missing (corruption,
+        decryption errors, ...) the new generation is discarded and the
+        live chunk kept as-is. Returns True if the chunk was swapped.
+        """
+        with self.lock:
+            lost = set(skipped) - self.dirty.get(chunk_idx, set())
+            if lost:
+                logging.error(
+                    'compact: Keeping chunk %d, failed to copy records %s'
+                    % (chunk_idx, sorted(lost)))
+                os.remove(compacted_path)
+                return False
+
+            (_, live) = self.get_chunk(chunk_idx * self.chunk_records)
+            nextgen = RecordFile(compacted_path, live.file_id,
+                self.chunk_records,
+                compress=self.compress,
+                encoding_kwargs=self.encoding_kwargs,
+                decoding_kwargs=self.decoding_kwargs,
+                padding=len(live.padding),
+                aes_keys=aes_keys,
+                derive=False)
+            for c_idx in sorted(self.dirty.get(chunk_idx, [])):
+                if c_idx not in live:
+                    if c_idx in nextgen:
+                        del nextgen[c_idx]
+                elif rekey:
+                    nextgen[c_idx] = live[c_idx]
+                else:
+                    raw = live.get(c_idx, decode=False).lstrip(b' ')
+                    nextgen.set(c_idx, raw, encode=False, pad=True)
+            nextgen.mark_compacted()
+
+            live.close()
+            nextgen._rotate(compacted_path, live.path)
+            nextgen.path = live.path
+            self.chunks[chunk_idx] = nextgen
+            self._drop_cached_chunk(live)
+            self.dirty.pop(chunk_idx, None)
+            return True
+
+    def fragmentation(self):
+        """
+        Return a dict of per-chunk fragmentation statistics.
+        """
+        with self.lock:
+            return dict(
+                (idx // self.chunk_records,
+                 self.get_chunk(idx)[1].fragmentation())
+                for idx in range(0, self.next_idx, self.chunk_records))
+
+    def worst_chunks(self, chunk_idxs=None, min_ratio=0.25):
+        """
+        Return the indexes of chunks where at least min_ratio of the file
+        is wasted space, or failing that, the single worst chunk.
+        """
+        frag = self.fragmentation()
+        ranked = sorted(
+            ((frag[ci]['free_ratio'], ci)
+             for ci in (frag if (chunk_idxs is None) else chunk_idxs)),
+            reverse=True)
+        worst = [ci for ratio, ci in ranked if ratio >= min_ratio]
+        return sorted(worst or [ci for ratio, ci in ranked[:1]])
 
     def compact(self,
             new_aes_key=False, force=False, partial=False,
-            progress_callback=None):
+            progress_callback=None, processes=None):
+        """
+        Compact the store's chunk files, one by one; if partial is set,
+        only the most fragmented chunks are compacted. If we are not changing
+        keys, chunks are copied without re-encoding, in parallel using a
+        pool of up to `processes` worker processes (default: one per CPU).
+
+        This is safe to run in a background thread while the store is in
+        use: a new generation of each chunk is written alongside the old
+        one, and writes made in the meantime are replayed into it just
+        before it replaces the original.
+        """
         last_chunk_idx = self.next_idx // self.chunk_records
         done = []
         progress = {'compacting': None, 'done': done, 'total': last_chunk_idx+1}
-        which = None
-        if partial:
-            which = random.randint(0, last_chunk_idx)
 
-        for idx in range(0, self.next_idx, self.chunk_records):
-            if (which is None) or (which == 0) or (idx == 0):
-                chunk_idx = (idx // self.chunk_records)
-                if progress_callback is not None:
-                    progress['compacting'] = chunk_idx
-                    progress_callback(progress)
-
-                (_, chunk_obj) = self.get_chunk(idx)
-                chunk_obj = chunk_obj.compact(
-                    new_aes_key=new_aes_key, force=force)
-                self.chunks[chunk_idx] = chunk_obj
+        chunk_idxs = [idx // self.chunk_records
+            for idx in range(0, self.next_idx, self.chunk_records)]
+        if partial:
+            chunk_idxs = self.worst_chunks(chunk_idxs)
+        if not chunk_idxs:
+            return
+
+        if processes is None:
+            processes = os.cpu_count() or 1
+        processes = min(processes, len(chunk_idxs))
+        rekey = bool(new_aes_key)
+
+        jobs = []
+        with self.lock:
+            for ci in chunk_idxs:
+                (_, chunk_obj) = self.get_chunk(ci * self.chunk_records)
+                self.dirty[ci] = set()
+                jobs.append((chunk_obj.path, chunk_obj.file_id,
+                    self.chunk_records, self.compress,
+                    chunk_obj.aes_keys, new_aes_key, force))
+
+        pool = None
+        try:
+            if (processes > 1) and not rekey:
+                pool = multiprocessing.Pool(processes)
+                results = pool.imap(_compact_record_file, jobs)
+            else:
+                results = (
+                    _compact_record_file(job,
+                        self.encoding_kwargs, self.decoding_kwargs)
+                    for job in jobs)
+
+            if progress_callback is not None:
+                progress['compacting'] = chunk_idxs[0]
+                progress_callback(progress)
+
+            for i, (chunk_idx, compacted) in enumerate(
+                    zip(chunk_idxs, results)):
+                if compacted is not None:
+                    self._swap_chunk(chunk_idx, *compacted, rekey)
                 done.append(chunk_idx)
-            if which is not None:
-                which -= 1
+                if progress_callback is not None and i+1 < len(chunk_idxs):
+                    progress['compacting'] = chunk_idxs[i+1]
+                    progress_callback(progress)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            with self.lock:
+                for ci in chunk_idxs:
+                    self.dirty.pop(ci, None)
 
         if progress_callback:
             del progress['compacting']
@@ -719,6 +1112,29 @@ if __name__ == "__main__":
     rf = rf.compact(new_aes_key=None, padding=0, force=True)
     assert(time.time() - rf.compacted_time() < 1)
 
+    # Free space is found again after reopening, and reused
+    for i in range(0, 100):
+        rf[i] = 'record %d' % i
+    for i in range(0, 50):
+        del rf[i]
+    rf.close()
+    rf = RecordFile('/tmp/rs-test/testing', 'test', 128)
+    assert(rf.empties is None)
+    assert(rf.fragmentation()['free_slots'] == 1)
+    free_bytes = rf.empty_bytes
+    file_size = os.path.getsize(rf.path)
+    for i in range(50, 70):
+        rf[i] = 'record %d has grown and moved' % i
+    assert(rf.empty_bytes < free_bytes)
+    assert(os.path.getsize(rf.path) == file_size)
+    for i in range(50, 100):
+        assert(rf[i] == ('record %d has grown and moved' % i
+            if (i < 70) else 'record %d' % i))
+    del rf[50]
+    assert(rf.fragmentation()['free_slots'] > 1)
+    rf = rf.compact(new_aes_key=None, force=True)
+    assert(rf.fragmentation()['free_bytes'] == 0)
+
     assert(rs.hash_size == 32)
     assert(rs.chunk_records == (1000 * (10*1024*1024 // 1024000)))
     assert(len(rs.hash_key('hello')) == rs.hash_size)
@@ -771,6 +1187,92 @@ if __name__ == "__main__":
     except ConfigMismatch:
         pass
 
+    # Compacting a multi-chunk store, in parallel and raw
+    rs4 = RecordStore('/tmp/rs-test/multi', 'testing',
+        aes_keys=[test_key], target_file_size=1024000)
+    assert(rs4.chunk_records == 1000)
+    for i in range(0, 2500):
+        rs4.append('record %d' % i, keys='k%d' % i)
+    for i in range(0, 2500, 7):
+        rs4['k%d' % i] = 'longer record %d, which will have moved' % i
+    for i in range(1000, 2000, 3):
+        rs4['k%d' % i] = 'rewritten, to fragment the second chunk %d' % i
+    assert(rs4.worst_chunks() == [1])
+    rs4.cache[rs4.get_chunk(5)] = 'stale'
+    progress = []
+    rs4.compact(force=True, processes=2,
+        progress_callback=lambda p: progress.append(copy.deepcopy(p)))
+    assert(sorted(progress[-1]['done']) == [0, 1, 2])
+    assert(rs4[5] == 'record 5')
+    for i in range(0, 2500):
+        expected = ('longer record %d, which will have moved' % i
+            if (i % 7 == 0) else 'record %d' % i)
+        if (1000 <= i < 2000) and (i % 3 == 1):
+            expected = 'rewritten, to fragment the second chunk %d' % i
+        assert(rs4['k%d' % i] == expected)
+    rs4['k1'] = 'still writable'
+    assert(rs4['k1'] == 'still writable')
+    rs4.compact(force=True, processes=1)
+    assert(rs4['k1'] == 'still writable')
+
+    # Compacting online, while someone else keeps writing
+    expected = dict((i, rs4[i]) for i in range(0, 2500))
+    def _writer():
+        for i in range(0, 3000):
+            idx = (i * 31) % 2600
+            if i % 5 == 0 and idx in expected:
+                del rs4[idx]
+                del expected[idx]
+            elif idx < len(rs4):
+                rs4[idx] = expected[idx] = 'rewritten %d/%d' % (idx, i)
+            else:
+                expected[rs4.append('appended %d' % i)] = 'appended %d' % i
+    for procs in (1, 2):
+        writer = threading.Thread(target=_writer)
+        writer.start()
+        rs4.compact(force=True, processes=procs)
+        writer.join()
+        rs4.compact(force=True, processes=procs)
+        for i in range(0, len(rs4)):
+            assert(rs4.get(i) == expected.get(i))
+    assert(not rs4.dirty)
+    rs4.close()
+    del rs4
+
+    # Batched writes are buffered, coalesced and readable before commit
+    rs5 = RecordStore('/tmp/rs-test/batch', 'testing',
+        aes_keys=[test_key], target_file_size=1024000)
+    rs5['a'] = 'before the batch'
+    with rs5.batch():
+        with rs5.batch():
+            for i in range(0, 1500):
+                rs5.append('batched %d' % i, keys='b%d' % i)
+        rs5['a'] = 'during the batch'
+        rs5['b5'] = 'rewritten in the batch'
+        del rs5['b6']
+        assert(rs5['a'] == 'during the batch')
+        assert(rs5['b5'] == 'rewritten in the batch')
+        assert('b6' not in rs5)
+        assert(rs5.batched)
+        assert(rs5.chunks[1].offsets[0] == 0)
+    assert(rs5.batched is None)
+    assert(rs5.chunks[1].offsets[0] > 0)
+    rs5.close()
+    rs5 = RecordStore('/tmp/rs-test/batch', 'testing',
+        aes_keys=[test_key], target_file_size=1024000)
+    assert(rs5['a'] == 'during the batch')
+    assert(rs5['b5'] == 'rewritten in the batch')
+    assert(rs5.get('b6') is None)
+    for i in range(7, 1500):
+        assert(rs5['b%d' % i] == 'batched %d' % i)
+    with rs5.batch():
+        for i in range(0, 1500, 2):
+            rs5['b%d' % i] = 'batched %d, grown and moved' % i
+    for i in range(0, 1500, 2):
+        assert(rs5['b%d' % i] == 'batched %d, grown and moved' % i)
+    rs5.close()
+    del rs5
+
     print('Tests passed OK, starting load test')
     rs.close()
     rs2.close()
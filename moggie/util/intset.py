@@ -71,6 +71,21 @@ class IntSet:
 
         return iset
 
+    @classmethod
+    def FromMask(cls, mask):
+        """
+        Create an IntSet from a numpy array of booleans (or anything numpy
+        can convert to booleans), containing the positions which are set.
+        """
+        iset = cls(init=None)
+        packed = numpy.packbits(numpy.asarray(mask, dtype=bool),
+            bitorder='little')
+        words = max(1, -(-len(packed) // iset.dtype.itemsize))
+        padded = numpy.zeros(words * iset.dtype.itemsize, dtype=numpy.uint8)
+        padded[:len(packed)] = packed
+        iset.npa = padded.view(iset.dtype)
+        return iset
+
     @classmethod
     def Sub(cls, *sets, clone=False):
         if clone:
@@ -256,7 +271,7 @@ class IntSet:
         if isinstance(other, IntSet):
             if len(other.npa) > len(self.npa):
                 self.npa.resize(len(other.npa) + self.DEF_GROW)
-            self.npa[:len(other.npa)] |= other.npa
+            self.npa[:len(other.npa)] ^= other.npa
 
         elif other in (None, []):
             return self
@@ -301,6 +316,40 @@ class IntSet:
         if result:
             yield result
 
+    def intersection_count(self, other):
+        """
+        Count the members of (self & other), without creating a new set.
+        """
+        if (self.npa is None) or (other.npa is None):
+            return 0
+        maxlen = min(len(self.npa), len(other.npa))
+        return _popcount(
+            numpy.bitwise_and(self.npa[:maxlen], other.npa[:maxlen]))
+
+    def split(self, size=1024, reverse=True):
+        """
+        Split the set into smaller IntSets of (roughly) size members each,
+        yielding the highest values first unless reverse is False. Chunks
+        never split a word, so they may slightly exceed the requested size.
+        """
+        if self.npa is None:
+            return
+        words = len(self.npa)
+        popcounts = _popcounts(self.npa[::-1] if reverse else self.npa)
+        cumulative = numpy.cumsum(popcounts, dtype=numpy.int64)
+        total = int(cumulative[-1]) if words else 0
+        beg = done = 0
+        while done < total:
+            end = 1 + int(numpy.searchsorted(cumulative, done + size))
+            end = min(end, words)
+            lo, hi = (words - end, words - beg) if reverse else (beg, end)
+            chunk = IntSet(init=None, bits=self.bits, dtype=self.dtype)
+            chunk.npa = numpy.zeros(hi, dtype=self.dtype)
+            chunk.npa[lo:hi] = self.npa[lo:hi]
+            yield chunk
+            done = int(cumulative[end-1])
+            beg = end
+
     def __iter__(self):
         for i in range(0, len(self.npa)):
             u64 = int(self.npa[i])
@@ -309,6 +358,17 @@ class IntSet:
                     if (u64 & (1 << j)):
                         yield (i * self.bits) + j
 
+    def as_array(self):
+        """
+        Return the members of the set as a sorted numpy array. This is
+        much faster than iterating over the set for large sets.
+        """
+        if self.npa is None:
+            return numpy.zeros(0, dtype=numpy.int64)
+        return numpy.flatnonzero(numpy.unpackbits(
+            numpy.ascontiguousarray(self.npa).view(numpy.uint8),
+            bitorder='little'))
+
     def __bool__(self):
         for i in range(0, len(self.npa)):
             u64 = int(self.npa[i])
@@ -317,7 +377,22 @@ class IntSet:
         return False
 
     def count(self):
-        return sum(1 for hit in self)
+        if self.npa is None:
+            return 0
+        return _popcount(self.npa)
+
+
+if hasattr(numpy, 'bitwise_count'):
+    def _popcounts(npa):
+        return numpy.bitwise_count(npa)
+    def _popcount(npa):
+        return int(numpy.bitwise_count(npa).sum())
+else:
+    def _popcounts(npa):
+        bits = numpy.unpackbits(numpy.ascontiguousarray(npa).view(numpy.uint8))
+        return bits.reshape(-1, npa.dtype.itemsize * 8).sum(axis=1)
+    def _popcount(npa):
+        return int(numpy.unpackbits(npa.view(numpy.uint8)).sum())
 
 
 register_dumb_decoder(IntSet.ENC_ASC, IntSet.DumbDecode)
@@ -347,6 +422,28 @@ if __name__ == "__main__":
     assert(b3 != some)
     assert(b3 != list(reversed(few)))
 
+    assert(b1.count() == len(many))
+    assert(b3.count() == len(few))
+    assert(IntSet().count() == 0)
+    assert(b1.intersection_count(b2) == len(some))
+    assert(b3.intersection_count(b1) == IntSet.And(b3, b1).count())
+
+    chunks = list(b1.split(10000))
+    assert(sum(c.count() for c in chunks) == len(many))
+    assert(all(c.count() <= 10000 + b1.bits for c in chunks))
+    assert(list(chunks[0])[-1] == many[-1])
+    assert(sum((list(c) for c in reversed(chunks)), []) == many)
+    assert([list(c) for c in b3.split(2, reverse=False)] == [few[:2], few[2:]])
+    assert(list(IntSet().split()) == [])
+
+    mask = numpy.zeros(2000, dtype=bool)
+    mask[few[:2]] = True
+    assert(IntSet.FromMask(mask) == few[:2])
+    assert(list(IntSet.FromMask(mask).as_array()) == few[:2])
+    assert(list(b3.as_array()) == few)
+    assert(IntSet.FromMask([]).count() == 0)
+    assert(len(IntSet(init=None).as_array()) == 0)
+
     print('Tests passed OK')
 
     count = 10
@@ -1,6 +1,8 @@
 # Utilities for sending mail
+import asyncio
 import copy
 import logging
+import time
 
 from .dumbcode import to_json, from_json
 
@@ -16,6 +18,7 @@ STATUS_RCPT_REJECTED = 'rcpt_rejected'
 STATUS_MESSAGE_SEND_PROGRESS = 'sending'
 STATUS_MESSAGE_SEND_OK = 'send_ok'
 STATUS_MESSAGE_SEND_FAILED = 'send_failed'
+STATUS_RETRYING = 'retrying'
 STATUS_DONE = 'done'
 
 
@@ -81,7 +84,8 @@ def parse_partial_url(url,
 
 
 async def sendmail(message_bytes, via_from_rcpt_tuples,
-        progress_callback=None):
+        progress_callback=None,
+        pool=None):
     """
     This method will iterate through the (via, from, recipients)
     tuples and attempt to send the message to each. Progress is logged
@@ -105,6 +109,7 @@ async def sendmail(message_bytes, via_from_rcpt_tuples,
         STATUS_MESSAGE_SEND_PROGRESS
         STATUS_MESSAGE_SEND_OK
         STATUS_MESSAGE_SEND_FAILED
+        STATUS_RETRYING
         STATUS_DONE
 
     The good variable is just a boolean, False for errors and true otherwise.
@@ -112,6 +117,9 @@ async def sendmail(message_bytes, via_from_rcpt_tuples,
     The message is human readable text.
 
     Callbacks can return False to suppress logging.
+
+    If an SMTPPool is provided, SMTP connections will be reused and
+    temporary failures retried, as configured by the pool.
     """
     global SENDMAIL_HANDLERS
     happy = True
@@ -120,9 +128,10 @@ async def sendmail(message_bytes, via_from_rcpt_tuples,
         try:
             for prio, test, handler in sorted(SENDMAIL_HANDLERS):
                 if test(via):
+                    kwargs = {} if (pool is None) else {'pool': pool}
                     if not await handler(
                             message_bytes, via, frm, recipients,
-                            i, progress_callback):
+                            i, progress_callback, **kwargs):
                         happy = False
                     tried = True
                     break
@@ -149,7 +158,8 @@ def _safe_str(data):
         return 'base64:' + str(base64.b64encode(data), 'utf-8')
 
 
-async def sendmail_exec(message_bytes, via, frm, recipients, _id, progress_cb):
+async def sendmail_exec(message_bytes, via, frm, recipients, _id, progress_cb,
+        pool=None):
     if via[:1] == '|':
         via = via[1:].strip()
     args = {
@@ -215,9 +225,81 @@ async def sendmail_exec(message_bytes, via, frm, recipients, _id, progress_cb):
     return happy
 
 
+class SMTPPool:
+    """
+    A pool of open (and logged in) SMTP connections, for sending many
+    messages through the same relay without setting up a new connection
+    for each one. Connections are reused after an RSET, and dropped if
+    they sit idle for too long.
+
+    The pool also limits how many messages are sent concurrently through
+    each relay (host, port), and how often temporary (4xx) failures get
+    retried. Usage:
+
+        async with SMTPPool() as pool:
+            await asyncio.gather(*[
+                sendmail(msg, [(via, frm, rcpts)], callback, pool=pool)
+                for msg, rcpts in batch])
+    """
+    def __init__(self, max_per_relay=2, retries=3, backoff=2, idle_timeout=60):
+        self.max_per_relay = max_per_relay
+        self.retries = retries
+        self.backoff = backoff
+        self.idle_timeout = idle_timeout
+        self.idle = {}
+        self.relays = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    def relay(self, host, port):
+        """
+        Returns a semaphore limiting concurrent use of a given relay.
+        """
+        key = (host, port)
+        if key not in self.relays:
+            self.relays[key] = asyncio.Semaphore(self.max_per_relay)
+        return self.relays[key]
+
+    def get(self, key):
+        """
+        Returns an idle connection for the given key, or None.
+        """
+        idle = self.idle.get(key, [])
+        expired = time.time() - self.idle_timeout
+        while idle:
+            ts, server = idle.pop(-1)
+            if ts > expired and server.is_connected:
+                return server
+            server.close()
+        return None
+
+    def put(self, key, server):
+        if server.is_connected:
+            self.idle[key] = self.idle.get(key, []) + [(time.time(), server)]
+
+    async def close(self):
+        idle, self.idle = self.idle, {}
+        for servers in idle.values():
+            for ts, server in servers:
+                try:
+                    await server.quit()
+                except Exception:
+                    pass
+                server.close()
+
+
+def _is_temporary(code):
+    return (400 <= (code or 0) < 500)
+
+
 async def sendmail_smtp(message_bytes, via, frm, recipients, _id, progress_cb,
         partial_send=False,
-        timeout=120):
+        timeout=120,
+        pool=None):
 
     details = {
         'id': _id,
@@ -239,109 +321,176 @@ async def sendmail_smtp(message_bytes, via, frm, recipients, _id, progress_cb,
         proto = 'smtp'
 
     # FIXME: Bring back SMTorP!
-    # FIXME: Port over and use Mailpile v1's connection broker?
 
     import aiosmtplib
-    happy = True
-    server = exc_error = exc_msg = None
-    try:
-        _progress(progress_cb,
-            True, STATUS_CONNECTING,
-            _update(details,
-                 proto=proto,
-                 username=user,
-                 password='(password)' if pwd else None,
-                 host=host,
-                 port=port),
-            'Connecting to: ' + (
-            '%(proto)s://%(username)s:%(password)s@%(host)s:%(port)d'
-            if (user or pwd) else '%(proto)s://%(host)s:%(port)d'))
-
-
-        async def _server_connect():
+    from aiosmtplib.errors import SMTPResponseException
+
+    own_pool = (pool is None)
+    if own_pool:
+        pool = SMTPPool(max_per_relay=1, retries=0)
+    pool_key = (proto, user, pwd, host, port, require_starttls)
+
+    async def _server_connect():
+        server = aiosmtplib.SMTP(
+            hostname=host,
+            port=port,
+            start_tls=False,  # We handle this below
+            use_tls=(proto == 'smtps'),
+            local_hostname='mailpile.local',
+            timeout=timeout,
+            validate_certs=False,  # FIXME: Poor crypto better than none?
+            client_cert=None,      # FIXME
+            client_key=None)       # FIXME
+        await server.connect()
+        if server.is_ehlo_or_helo_needed:
+            await server.ehlo()
+        return server
+
+    async def _deliver(last_try):
+        happy = True
+        server = exc_error = exc_msg = None
+        try:
+            server = pool.get(pool_key)
+            if server is not None:
+                try:
+                    await server.rset()
+                except Exception:
+                    server.close()
+                    server = None
+
             exc_error, exc_msg = (
                 STATUS_CONNECT_FAILED,
                 'Failed to connect to server: %(error)s')
-            server = aiosmtplib.SMTP(
-                hostname=host,
-                port=port,
-                start_tls=False,  # We handle this below
-                use_tls=(proto == 'smtps'),
-                local_hostname='mailpile.local',
-                timeout=timeout,
-                validate_certs=False,  # FIXME: Poor crypto better than none?
-                client_cert=None,      # FIXME
-                client_key=None)       # FIXME
-            await server.connect()
-            if server.is_ehlo_or_helo_needed:
-                await server.ehlo()
-            return server
-
-        server = await _server_connect()
-
-        # We always try to enable TLS, even if the user only requested
-        # plain-text SMTP. But we only throw errors if the user asked
-        # for encryption.
-        try:
-            await server.starttls()
-            if server.is_ehlo_or_helo_needed:
-                await server.ehlo()
-        except Exception as e:
-            if require_starttls:
-                exc_msg = 'STARTTLS failed, could not encrypt: %(error)s'
-                raise
-            else:
+            _progress(progress_cb,
+                True, STATUS_CONNECTING,
+                _update(details,
+                     proto=proto,
+                     username=user,
+                     password='(password)' if pwd else None,
+                     host=host,
+                     port=port,
+                     reused=(server is not None)),
+                ('Reusing connection to: ' if server else 'Connecting to: ') + (
+                '%(proto)s://%(username)s:%(password)s@%(host)s:%(port)d'
+                if (user or pwd) else '%(proto)s://%(host)s:%(port)d'))
+
+            if server is None:
                 server = await _server_connect()
 
-        if user or pwd:
+                # We always try to enable TLS, even if the user only
+                # requested plain-text SMTP. But we only throw errors if the
+                # user asked for encryption.
+                if proto != 'smtps':
+                    if server.supports_extension('starttls'):
+                        try:
+                            await server.starttls()
+                            if server.is_ehlo_or_helo_needed:
+                                await server.ehlo()
+                        except Exception as e:
+                            if require_starttls:
+                                exc_msg = ('STARTTLS failed,'
+                                    ' could not encrypt: %(error)s')
+                                raise
+                            else:
+                                server.close()
+                                server = await _server_connect()
+                    elif require_starttls:
+                        exc_msg = ('STARTTLS failed,'
+                            ' could not encrypt: %(error)s')
+                        raise aiosmtplib.SMTPException(
+                            'STARTTLS is not supported by server')
+
+                if user or pwd:
+                    exc_error, exc_msg = (
+                        STATUS_LOGIN_REJECTED, 'Login failed: %(error)s')
+                    await server.login(user or '', pwd or '')
+                    _progress(progress_cb, True, STATUS_LOGIN_OK, details,
+                        'Logged in to server as %s' % user)
+
+            exc_error, exc_msg = (
+                STATUS_FROM_REJECTED,
+                'Sender (%(from)s) rejected by server: %(error)s')
+            await server.mail(frm)
+            _progress(progress_cb, True, STATUS_FROM_OK, details,
+                'Server accepted sender')
+
+            # Note: aiosmtplib does not let us pipeline these commands,
+            #       it discards responses which arrive before we ask.
             exc_error, exc_msg = (
-                STATUS_LOGIN_REJECTED, 'Login failed: %(error)s')
-            await server.login(user or '', pwd or '')
-            _progress(progress_cb, True, STATUS_LOGIN_OK, details,
-                'Logged in to server as %s' % user)
-
-        exc_error, exc_msg = (
-            STATUS_FROM_REJECTED,
-            'Sender (%(from)s) rejected by server: %(error)s')
-        await server.mail(frm)
-        _progress(progress_cb, True, STATUS_FROM_OK, details,
-            'Server accepted sender')
-
-        exc_error, exc_msg = (
-            STATUS_RCPT_REJECTED,
-            'Recipient (%(rcpt)s) rejected by server: %(error)s')
-        for rcpt in recipients:
-            try:
-                await server.rcpt(rcpt)
-            except Exception as e:
+                STATUS_RCPT_REJECTED,
+                'Recipient (%(rcpt)s) rejected by server: %(error)s')
+            rejected = []
+            for rcpt in recipients:
+                try:
+                    await server.rcpt(rcpt)
+                except SMTPResponseException as e:
+                    rejected.append((rcpt, e))
+            if rejected and not last_try:
+                if any(_is_temporary(e.code) for r, e in rejected):
+                    await server.rset()
+                    pool.put(pool_key, server)
+                    server = None
+                    return None, str(rejected[0][1])
+            for rcpt, e in rejected:
                 happy = _progress(progress_cb,
                     False, exc_error,
                     _update(details, rcpt=rcpt, error=str(e)),
                     exc_msg)
-        if happy:
-            _progress(progress_cb, True, STATUS_RCPT_OK, details,
-                'Server accepted all recipients')
-        elif not partial_send:
-            return False
-
-        exc_error, exc_msg = (
-            STATUS_MESSAGE_SEND_FAILED,
-            'Failed to upload message to server: %(error)s')
-        await server.data(message_bytes)
-        _progress(progress_cb, True, STATUS_MESSAGE_SEND_OK,
-            _update(details, sent_bytes=len(message_bytes)),
-            'Message sent (%(sent_bytes)d bytes)')
+            if happy:
+                _progress(progress_cb, True, STATUS_RCPT_OK, details,
+                    'Server accepted all recipients')
+            elif not partial_send:
+                await server.rset()
+                pool.put(pool_key, server)
+                server = None
+                return False, None
 
-    except Exception as e:
-        happy = _progress(progress_cb,
-            False, exc_error or STATUS_MESSAGE_SEND_FAILED,
-            _update(details, error=str(e)),
-            exc_msg or 'Sending failed, error=%(error)s')
-    finally:
-        if server:
-            server.close()
+            exc_error, exc_msg = (
+                STATUS_MESSAGE_SEND_FAILED,
+                'Failed to upload message to server: %(error)s')
+            await server.data(message_bytes)
+            _progress(progress_cb, True, STATUS_MESSAGE_SEND_OK,
+                _update(details, sent_bytes=len(message_bytes)),
+                'Message sent (%(sent_bytes)d bytes)')
 
-    return happy
+            pool.put(pool_key, server)
+            server = None
+
+        except Exception as e:
+            if isinstance(e, SMTPResponseException) and server:
+                # The connection is probably still usable
+                try:
+                    await server.rset()
+                    pool.put(pool_key, server)
+                    server = None
+                except Exception:
+                    pass
+            if not last_try and _is_temporary(getattr(e, 'code', None)):
+                return None, str(e)
+            happy = _progress(progress_cb,
+                False, exc_error or STATUS_MESSAGE_SEND_FAILED,
+                _update(details, error=str(e)),
+                exc_msg or 'Sending failed, error=%(error)s')
+        finally:
+            if server:
+                server.close()
+
+        return happy, None
+
+    try:
+        async with pool.relay(host, port):
+            for attempt in range(0, pool.retries + 1):
+                happy, error = await _deliver(attempt >= pool.retries)
+                if happy is not None:
+                    return happy
+                delay = pool.backoff * (2 ** attempt)
+                _progress(progress_cb, True, STATUS_RETRYING,
+                    _update(details, error=error, delay=delay),
+                    'Temporary failure (%(error)s), retrying in %(delay)ss')
+                await asyncio.sleep(delay)
+    finally:
+        if own_pool:
+            await pool.close()
 
 
 # This sets the stage for some sort of plugin adding other
@@ -17,17 +17,47 @@ The search function supports MS-DOS style asterisks, where an asterisk
 regular expression engine, it is actually possible to search for complex
 regep patterns to generate keyword candiates. Whether this will prove
 useful is unknown at this time, but it's a neat trick!)
+
+For large keyword lists, the WordBlob class adds a trigram index so most
+searches only need to examine a handful of candidate keywords, and allows
+the list to be updated incrementally.
 """
+import bisect
+import numpy
 import re
 import random
 
 
+def _blob_matches(blob, search_re, bind_beg, bind_end):
+    for m in re.finditer(search_re, blob):
+        beg, end = m.span()
+
+        # Note: Doing this here, rather than using complex regexp
+        #       magic is *much* faster when our blobs get large.
+        if bind_beg and (beg > 0) and (blob[beg-1:beg] != b'\n'):
+            continue
+        if bind_end and (end < len(blob)) and (blob[end:end+1] != b'\n'):
+            continue
+
+        # Expand our match to grab the full keyword from the blob.
+        offset = beg
+        while (beg > 0) and (blob[beg-1:beg] != b'\n'):
+            beg -= 1
+        while (end < len(blob)) and (blob[end:end+1] != b'\n'):
+            end += 1
+
+        yield blob[beg:end], (offset - beg), beg
+
+
 def wordblob_search(term, blobs, max_results, order=0):
     """
     Search for <term> in <blob>, returning up the <max_results> matches,
     ordered by how exact the match is. The term itself, stripped of
     asterisks, is always the first match, even if it is not present in
     the blob itself.
+
+    The blobs may be bytes() or WordBlob objects; the results are the
+    same either way, but WordBlobs can usually avoid scanning everything.
     """
     keyword = term if isinstance(term, bytes) else bytes(term, 'utf-8')
     matches = [(0, keyword.replace(b'*', b''))]
@@ -41,32 +71,25 @@ def wordblob_search(term, blobs, max_results, order=0):
         keyword.strip(b'*').replace(b'*', b'[^\\n]*'),
         flags=re.IGNORECASE)
 
+    # If the search term is a plain string, it can be looked up in an index.
+    pieces = [p.lower() for p in keyword.split(b'*') if p]
+    if [p for p in pieces if re.escape(p) != p]:
+        pieces = None
+
     blobs = blobs if isinstance(blobs, list) else [blobs]
     for blob in blobs:
-        for m in re.finditer(search_re, blob):
-            beg, end = m.span()
-
-            # Note: Doing this here, rather than using complex regexp
-            #       magic is *much* faster when our blobs get large.
-            if bind_beg and (beg > 0) and (blob[beg-1:beg] != b'\n'):
-                continue
-            if bind_end and (end < len(blob)) and (blob[end:end+1] != b'\n'):
-                continue
-
-            # Expand our match to grab the full keyword from the blob.
-            offset = beg
-            while (beg > 0) and (blob[beg-1:beg] != b'\n'):
-                beg -= 1
-            while (end < len(blob)) and (blob[end:end+1] != b'\n'):
-                end += 1
-
-            # Append our match, calculating a rough weight based on how
-            # close it is to being an exact match.
-            kw = blob[beg:end]
+        if isinstance(blob, WordBlob):
+            found = blob.matches(search_re, pieces, bind_beg, bind_end)
+        else:
+            found = _blob_matches(blob, search_re, bind_beg, bind_end)
+
+        # Append our matches, calculating a rough weight based on how
+        # close each is to being an exact match.
+        for kw, offset, beg in found:
             if kw not in (matches[0][1], matches[-1][1]):
                 orank = 1000000000 + len(matches) * order
                 ratio = 10 * len(kw) // len(keyword)
-                matches.append((ratio + (offset-beg) + orank, kw))
+                matches.append((ratio + offset + orank, kw))
 
     return [str(kw, 'utf-8') for s, kw in sorted(matches)[:max_results]]
 
@@ -126,6 +149,273 @@ def create_wordblob(iter_keywords, **kwargs):
     return update_wordblob(iter_keywords, b'', **kwargs)
 
 
+class _WordBlobSegment:
+    """
+    A single immutable blob of keywords, with a trigram index (a suffix
+    array sorted by the first three lowercased bytes of each suffix) and
+    a hash index of the full keywords.
+
+    Keywords can be masked (removed) and the list can be truncated, but
+    keywords are never added; new keywords go in a new segment.
+    """
+    def __init__(self, blob):
+        self.blob = blob
+        self.lblob = blob.lower()
+        self.masked = []
+
+        larr = numpy.frombuffer(self.lblob, dtype=numpy.uint8)
+        is_nl = (larr == 10)
+        self.starts = numpy.concatenate((
+            numpy.zeros(1, dtype=numpy.int64),
+            numpy.nonzero(is_nl)[0] + 1))
+        self.count = self.limit = len(self.starts) if blob else 0
+
+        if len(larr) >= 3:
+            a = larr.astype(numpy.uint32)
+            codes = (a[:-2] << 16) | (a[1:-1] << 8) | a[2:]
+            pos = numpy.nonzero(~(is_nl[:-2] | is_nl[1:-1] | is_nl[2:]))[0]
+            codes = codes[pos]
+            order = numpy.argsort(codes, kind='stable')
+            self.tri_codes = codes[order]
+            self.tri_pos = pos[order].astype(numpy.uint32)
+        else:
+            self.tri_codes = self.tri_pos = numpy.zeros(0, dtype=numpy.uint32)
+
+        hashes = numpy.array(
+            [hash(w) for w in (blob.split(b'\n') if blob else [])],
+            dtype=numpy.int64)
+        order = numpy.argsort(hashes, kind='stable')
+        self.hashes = hashes[order]
+        self.hash_ords = order
+
+    def word(self, o):
+        end = (self.starts[o+1] - 1) if (o+1 < self.count) else len(self.blob)
+        return self.blob[self.starts[o]:end]
+
+    def is_live(self, o):
+        if o >= self.limit:
+            return False
+        i = bisect.bisect_left(self.masked, o)
+        return not (i < len(self.masked) and self.masked[i] == o)
+
+    def live_count(self, limit=None):
+        limit = self.limit if (limit is None) else limit
+        return limit - bisect.bisect_left(self.masked, limit)
+
+    def __iter__(self):
+        for o in range(0, self.limit):
+            if self.is_live(o):
+                yield self.word(o)
+
+    def find(self, words):
+        """
+        Return the ordinals of whichever of the words are in the segment.
+        """
+        if not (words and self.count):
+            return []
+        hashes = numpy.array([hash(w) for w in words], dtype=numpy.int64)
+        lo = numpy.searchsorted(self.hashes, hashes, side='left')
+        hi = numpy.searchsorted(self.hashes, hashes, side='right')
+        found = []
+        for i in numpy.nonzero(hi > lo)[0]:
+            for j in range(lo[i], hi[i]):
+                o = int(self.hash_ords[j])
+                if self.word(o) == words[i]:
+                    found.append(o)
+        return found
+
+    def mask(self, ordinals):
+        for o in ordinals:
+            if self.is_live(o):
+                bisect.insort(self.masked, o)
+
+    def truncate(self, keep):
+        """
+        Truncate the segment so at most <keep> live keywords remain.
+        """
+        if self.live_count() <= keep:
+            return
+        limit = keep
+        while self.live_count(limit) < keep:
+            limit += keep - self.live_count(limit)
+        self.limit = limit
+        self.masked = self.masked[:bisect.bisect_left(self.masked, limit)]
+
+    def candidates(self, pieces, bind_beg, bind_end):
+        """
+        Return a sorted array of the ordinals of keywords which contain
+        the longest of the pieces, or None if the index cannot help.
+        """
+        li = max(range(0, len(pieces)), key=lambda i: len(pieces[i]))
+        longest = pieces[li]
+        if len(longest) < 3:
+            return None
+
+        # Note: Searching for an uint32 avoids casting the whole array
+        code = numpy.uint32(
+            (longest[0] << 16) | (longest[1] << 8) | longest[2])
+        lo = numpy.searchsorted(self.tri_codes, code, side='left')
+        hi = numpy.searchsorted(self.tri_codes, code, side='right')
+        pos = self.tri_pos[lo:hi]
+
+        if len(longest) > 3:
+            larr = numpy.frombuffer(self.lblob, dtype=numpy.uint8)
+            pos = pos[pos + len(longest) <= len(larr)]
+            for k in range(3, len(longest)):
+                pos = pos[larr[pos + k] == longest[k]]
+
+        ords = numpy.searchsorted(self.starts, pos, side='right') - 1
+        if bind_beg and (li == 0):
+            keep = (pos == self.starts[ords])
+            pos, ords = pos[keep], ords[keep]
+        if bind_end and (li == len(pieces) - 1):
+            nxt = numpy.minimum(ords + 1, self.count - 1)
+            ends = numpy.where(
+                ords + 1 < self.count, self.starts[nxt] - 1, len(self.blob))
+            ords = ords[(pos + len(longest)) == ends]
+
+        return numpy.unique(ords)
+
+    def matches(self, search_re, pieces, bind_beg, bind_end):
+        ords = self.candidates(pieces, bind_beg, bind_end) if pieces else None
+        if ords is None:
+            # Fall back to scanning the whole thing
+            partial = (self.masked or (self.limit < self.count))
+            for kw, offset, beg in _blob_matches(
+                    self.blob, search_re, bind_beg, bind_end):
+                if partial:
+                    o = numpy.searchsorted(self.starts, beg, side='right') - 1
+                    if not self.is_live(o):
+                        continue
+                yield kw, offset, beg
+        else:
+            sub_blob = b'\n'.join(
+                self.word(o) for o in ords if self.is_live(o))
+            yield from _blob_matches(sub_blob, search_re, bind_beg, bind_end)
+
+
+class WordBlob:
+    """
+    An indexed, incrementally updatable keyword blob, for use with the
+    wordblob_search() function.
+
+    The keywords are stored in segments, newest first. Updates create a
+    new small segment and mask any old copies of updated or blacklisted
+    keywords, so the logical contents and order match what repeated calls
+    to update_wordblob(..., lru=True) would have produced. Small segments
+    get merged as they accumulate.
+
+    Each update is recorded in a log, so persisting changes does not
+    require writing the entire blob; see replay() and checkpoint().
+    """
+    def __init__(self, blob=b'', shortest=4, longest=40, maxlen=102400,
+            max_log=1000):
+        self.shortest = shortest
+        self.longest = longest
+        self.maxlen = maxlen
+        self.max_log = max_log
+        self.log = []
+        self.segments = [_WordBlobSegment(blob)] if blob else []
+
+    def __len__(self):
+        return sum(seg.live_count() for seg in self.segments)
+
+    def __iter__(self):
+        for seg in self.segments:
+            yield from seg
+
+    def __contains__(self, keyword):
+        for seg in self.segments:
+            for o in seg.find([keyword]):
+                if seg.is_live(o):
+                    return True
+        return False
+
+    def tobytes(self):
+        return b'\n'.join(self)
+
+    def checkpoint(self):
+        """
+        Merge everything into a single segment and clear the log.
+        """
+        if len(self.segments) > 1:
+            blob = self.tobytes()
+            self.segments = [_WordBlobSegment(blob)] if blob else []
+        self.log = []
+
+    def matches(self, search_re, pieces, bind_beg, bind_end):
+        for seg in self.segments:
+            yield from seg.matches(search_re, pieces, bind_beg, bind_end)
+
+    def _apply(self, keywords, removing):
+        for seg in self.segments:
+            seg.mask(seg.find(removing))
+        if keywords:
+            self.segments[:0] = [_WordBlobSegment(b'\n'.join(keywords))]
+
+        keep = self.maxlen
+        for seg in self.segments:
+            seg.truncate(keep)
+            keep -= seg.live_count()
+        self.segments = [seg for seg in self.segments if seg.live_count()]
+
+        # Merge segments, so we never have too many small ones
+        while ((len(self.segments) > 1) and
+                (2 * self.segments[0].live_count()
+                   >= self.segments[1].live_count())):
+            blob = b'\n'.join(list(self.segments[0]) + list(self.segments[1]))
+            self.segments[:2] = [_WordBlobSegment(blob)]
+
+    def replay(self, log):
+        for keywords, removing in log:
+            self._apply(keywords, removing)
+            self.log.append((keywords, removing))
+        return self
+
+    def update(self, iter_kws, blacklist=None):
+        """
+        Add to the blob, applying the same criteria as update_wordblob()
+        does with lru=True. Returns True if the blob was checkpointed, in
+        which case the log is empty and the full blob should be persisted,
+        otherwise the caller should persist the last entry of the log.
+        """
+        blacklist = set(blacklist or [])
+
+        keywords = set([])
+        for kw in iter_kws:
+            if (self.shortest <= len(kw) <= self.longest) and (b'*' not in kw):
+                keywords.add(kw)
+        keywords -= blacklist
+
+        if (len(keywords) >= self.maxlen) or not len(self):
+            blob = update_wordblob(keywords, b'',
+                shortest=self.shortest,
+                longest=self.longest,
+                maxlen=self.maxlen,
+                lru=True)
+            self.segments = [_WordBlobSegment(blob)] if blob else []
+            self.log = []
+            return True
+
+        # Only record removals which actually change anything
+        ignore = list(blacklist | keywords)
+        removing = set()
+        for seg in self.segments:
+            removing |= set(seg.word(o) for o in seg.find(ignore)
+                            if seg.is_live(o))
+        removing = sorted(removing)
+        keywords = sorted(keywords)
+
+        oldest = self.segments[-1]
+        self._apply(keywords, removing)
+        self.log.append((keywords, removing))
+        if ((len(self.log) >= self.max_log)
+                or (not self.segments) or (self.segments[-1] is not oldest)):
+            self.checkpoint()
+            return True
+        return False
+
+
 if __name__ == '__main__':
     import time
 
@@ -159,4 +449,24 @@ if __name__ == '__main__':
     s3 = n / (t3-t2)
     s4 = n / (t4-t3)
 
-    print('Tests pass OK: %d/%d/%d/%d qps in %d byte blob' % (s1, s2, s3, s4, len(blob2)))
+    wb2 = WordBlob(blob2, shortest=5, maxlen=128000)
+    for q in ('10*', '*10', '1*0', '*123*', '12345'):
+        assert(wordblob_search(q, blob2, 10) == wordblob_search(q, wb2, 10))
+
+    t0 = time.time()
+    for i in range(0, n):
+        wordblob_search('%d*' % random.randint(0, 10240), wb2, 10)
+    t1 = time.time()
+    for i in range(0, n):
+        wordblob_search('%d*0' % random.randint(0, 10240), wb2, 10)
+    t2 = time.time()
+    for i in range(0, n):
+        wordblob_search('*%d' % random.randint(0, 10240), wb2, 10)
+    t3 = time.time()
+    for i in range(0, n):
+        wordblob_search('*%d*' % random.randint(0, 10240), wb2, 10)
+    t4 = time.time()
+
+    print('Tests pass OK: %d/%d/%d/%d qps in %d byte blob, %d/%d/%d/%d indexed'
+        % (s1, s2, s3, s4, len(blob2),
+           n / (t1-t0), n / (t2-t1), n / (t3-t2), n / (t4-t3)))
@@ -24,7 +24,6 @@ from upagekite.websocket import websocket, ws_broadcast
 
 from ..api.exceptions import reraise
 from ..app.cli import CLI_COMMANDS
-from ..app.core import AppCore
 from ..util.dumbcode import to_json, from_json
 from .public import PublicWorker, RequestTimer
 
@@ -311,6 +310,9 @@ class AppWorker(PublicWorker):
             raise PermissionError('Access denied')
 
     def get_app(self):
+        # Imported here, so CLI clients which only talk to a running app
+        # do not pay for loading the entire backend.
+        from ..app.core import AppCore
         return AppCore(self)
 
     def websocket_url(self):
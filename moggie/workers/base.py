@@ -721,8 +721,13 @@ class BaseWorker(Process):
                 cli_args), 'latin-1'))
 
     def start_sending_data(self, mimetype, length):
+        """
+        Send HTTP headers and return the client socket. If length is None,
+        the response is delimited by closing the connection instead.
+        """
         self.reply(self.HTTP_200
-            + (b'Content-Length: %d\r\n' % (length))
+            + (b'' if (length is None) else
+                (b'Content-Length: %d\r\n' % (length)))
             + (b'Content-Type: %s\r\n\r\n' % mimetype.encode('utf-8')),
             close=False)
         return self._client
@@ -78,6 +78,8 @@ class ImportWorker(BaseWorker):
         self.autotag_unloadable = set()
 
         self.lock = threading.Lock()
+        self.imports_running = 0
+        self.compact_wanted = False
         self.keyword_batches = []
         self.keyword_batch_no = 0
         self.keyword_thread = None
@@ -86,6 +88,7 @@ class ImportWorker(BaseWorker):
 
         self.parser_settings = CommandParse.Settings(with_keywords=True)
         self.parser_settings.with_openpgp = False
+        self.parser_settings.with_part_info = False
         self.allow_network = True  # FIXME: Make configurable?
 
         assert(self.fs and self.search)
@@ -198,10 +201,11 @@ class ImportWorker(BaseWorker):
 
     def import_search(self,
             request_obj, initial_tags,
-            tag_namespace=None, force=False, full=False, compact=False):
+            tag_namespace=None, force=False, full=False, compact=False,
+            queue=None):
         return self.call('import_search',
             request_obj, initial_tags, tag_namespace,
-            bool(force), full, compact)
+            bool(force), full, compact, queue)
 
     def api_autotag(self, tag_namespace, tags, search, **kwargs):
         if tags:
@@ -421,7 +425,13 @@ class ImportWorker(BaseWorker):
 
     def api_import_search(self,
             request, initial_tags, tag_namespace, force, full, compact,
-            **kwargs):
+            queue=None, **kwargs):
+        """
+        Import messages in the background. Imports using the same queue
+        run one after another, imports on different queues in parallel.
+        If compaction is requested, it happens once all running imports
+        have finished.
+        """
         request_obj = to_api_request(request)
         caller = self._caller
         def background_import_search():
@@ -431,9 +441,30 @@ class ImportWorker(BaseWorker):
                     compact, caller=caller)
             except:
                 logging.exception('[import] Failed to import search')
-        self.add_background_job(background_import_search)
+            finally:
+                self._import_finished()
+        with self.lock:
+            self.imports_running += 1
+        self.add_background_job(background_import_search,
+            which=(queue or 'default'))
         self.reply_json({'running': True})
 
+    def _import_finished(self):
+        with self.lock:
+            self.imports_running -= 1
+            if self.imports_running or not self.compact_wanted:
+                return
+            self.compact_wanted = False
+
+        def _compact():
+            logging.info('[import] Compacting metadata')
+            self.metadata.compact(full=True)
+            logging.info('[import] Compacting search index')
+            self.search.compact(full=True)
+
+        # This runs after any full indexing queued by the imports
+        self.add_background_job(_compact, which='full')
+
     def _notify_progress(self, progress=None):
         progress = progress or self.progress
         add = progress['emails_new']
@@ -737,11 +768,6 @@ class ImportWorker(BaseWorker):
         def _full_indexer(email_idxs):
             def _full_index():
                 self._index_full_messages(email_idxs, tag_namespace, progress)
-                if compact:
-                    logging.info('[import] Compacting metadata')
-                    self.metadata.compact(full=True)
-                    logging.info('[import] Compacting search index')
-                    self.search.compact(full=True)
             return _full_index
 
         work_queue = 'in:_mp_incoming_old'
@@ -785,6 +811,8 @@ class ImportWorker(BaseWorker):
                     progress['pending'] += 1
                     self.add_background_job(
                         _full_indexer(new_msgs), which='full')
+                    if compact:
+                        self.compact_wanted = True
 
             # 4. Repeat until all mail is processed, report progress
             self._notify_progress(progress)
@@ -23,6 +23,11 @@ class MetadataWorker(BaseWorker):
     SORT_DATE_ASC = 1
     SORT_DATE_DEC = 2
 
+    # How many messages to add to the index per change_lock acquisition.
+    # Each chunk is written as one batch, which holds the store lock and
+    # blocks metadata reads, so keep this small.
+    ADD_METADATA_CHUNK = 100
+
     @classmethod
     def Connect(cls, status_dir):
         return cls(status_dir, None, None).connect(autostart=False)
@@ -38,6 +43,7 @@ class MetadataWorker(BaseWorker):
             b'info':         (True, self.api_info),
             b'compact':      (True, self.api_compact),
             b'update_ptrs':  (True, self.api_update_ptrs),
+            b'date_range':   (True, self.api_date_range),
             b'add_metadata': (True, self.api_add_metadata),
             b'metadata':     (True, self.api_metadata)})
 
@@ -233,35 +239,40 @@ class MetadataWorker(BaseWorker):
     def info(self):
         return self.call('info')
 
+    def date_range(self, beg_ts, end_ts=None):
+        return self.call('date_range', beg_ts, end_ts)
+
     def api_info(self, **kwas):
         self.reply_json({
             'maxint': len(self._metadata)})
 
+    def api_date_range(self, beg_ts, end_ts, **kwas):
+        """
+        Return an IntSet of the messages dated beg_ts <= ts < end_ts.
+        """
+        self.reply_json(self._metadata.date_range(beg_ts, end_ts))
+
     def api_compact(self, full, callback_chain, **kwargs):
         def background_compact():
-            with self.change_lock:
-                self._metadata.compact(partial=not full)
-                self.results_to_callback_chain(callback_chain,
-                    {'compacted': True, 'full': full})
+            # Compaction happens online; see RecordStore.compact().
+            self._metadata.compact(partial=not full)
+            self.results_to_callback_chain(callback_chain,
+                {'compacted': True, 'full': full})
         self.add_background_job(background_compact)
         self.reply_json({'running': True})
 
     def api_add_metadata(self, update, metadata, **kwas):
         added, updated = [], []
-        for m in sorted(metadata):
-            if isinstance(m, list):
-                m = Metadata(*m)
+        metadata = [(Metadata(*m) if isinstance(m, list) else m)
+            for m in sorted(metadata)]
+        for beg in range(0, len(metadata), self.ADD_METADATA_CHUNK):
+            # Adding in chunks lets other requests in now and then
             with self.change_lock:
-                if update:
-                    is_new, idx = self._metadata.update_or_add(m)
-                else:
-                    is_new = False
-                    idx = self._metadata.add_if_new(m)
-            if idx:
-                if is_new:
-                    added.append(idx)
-                else:
-                    updated.append(idx)
+                a, u = self._metadata.add_many(
+                    metadata[beg:beg + self.ADD_METADATA_CHUNK],
+                    update=update)
+            added.extend(a)
+            updated.extend(u)
         self.reply_json({'added': added, 'updated': updated})
 
     def api_annotate(self, msgids, annotations, **kwas):
@@ -4,7 +4,7 @@ import time
 import traceback
 import threading
 
-from ..util.dumbcode import dumb_encode_asc, dumb_decode
+from ..util.dumbcode import dumb_encode_asc, dumb_decode, to_json, from_json
 from ..util.intset import IntSet
 from .base import BaseWorker
 
@@ -27,6 +27,8 @@ class SearchWorker(BaseWorker):
     SORT_DATE_ASC = 1
     SORT_DATE_DEC = 2
 
+    STREAM_CHUNK_SIZE = 25000
+
     _OP_STR_MAP = {
         IntSet.Or: 'OR',
         IntSet.And: 'AND',
@@ -54,6 +56,9 @@ class SearchWorker(BaseWorker):
             b'update_terms': (True, self.api_update_terms),
             b'term_search':  (True, self.api_term_search),
             b'explain':      (True, self.api_explain),
+            b'counts':       (True, self.api_counts),
+            b'tags':         (True, self.api_tags),
+            b'search_stream': (True, self.api_search_stream),
             b'search':       (True, self.api_search)})
 
         self.change_lock = threading.Lock()
@@ -79,6 +84,8 @@ class SearchWorker(BaseWorker):
             maxint=self.maxint)
 
         self._engine.magic_term_map.update({
+            'date': self._magic_dates,
+            'dates': self._magic_dates,
             'tid': self._magic_thread,
             'thread': self._magic_thread})
 
@@ -94,6 +101,24 @@ class SearchWorker(BaseWorker):
 
         return super()._main_httpd_loop()
 
+    def _magic_dates(self, term):
+        """
+        Search for date ranges using the metadata index's timestamp column,
+        which is much faster than OR-ing together large numbers of per-day
+        keywords. Falls back to keywords if anything goes wrong.
+        """
+        from ..search.dates import date_term_timestamps, date_term_magic
+        try:
+            rng = date_term_timestamps(term)
+            if rng == IntSet.All:
+                return rng
+            return (IntSet.Or, self.metadata.date_range(*rng))
+        except (ValueError, KeyError, IndexError):
+            return date_term_magic(term)
+        except:
+            logging.exception('Failed to load date range for %s' % term)
+            return date_term_magic(term)
+
     def _magic_thread(self, thread_id):
         tid = None
         try:
@@ -141,6 +166,59 @@ class SearchWorker(BaseWorker):
         return self.call('search', terms,
             mask_deleted, mask_tags, more_terms, tag_namespace, with_tags)
 
+    async def async_search_stream(self, loop, terms, chunk_cb,
+            tag_namespace=None,
+            mask_deleted=True, mask_tags=None, more_terms=None,
+            chunk_size=None):
+        """
+        Search, passing results to chunk_cb as they arrive: first a summary
+        of the search (including the total hit count and which hits are
+        urgent), then one {'count': N, 'hits': ...} dict per chunk of hits,
+        highest IDs first.
+        """
+        state = {'hdr': b'', 'buffer': b''}
+        def data_cb(hdr, data):
+            if hdr is not None:
+                state['hdr'] = hdr
+            if b'application/json' in state['hdr']:
+                # This is an error, not a stream
+                state['buffer'] += data
+                return
+            lines = (state['buffer'] + data).split(b'\n')
+            state['buffer'] = lines.pop(-1)
+            for line in lines:
+                if line:
+                    chunk_cb(from_json(line))
+
+        await self.async_call(loop, 'search_stream', terms,
+            mask_deleted, mask_tags, more_terms, tag_namespace, chunk_size,
+            data_cb=data_cb)
+        if b'application/json' in state['hdr']:
+            self._call_return(state['hdr'], state['buffer'])
+            raise IOError('Search stream failed')
+
+    async def async_tags(self, loop, hits, tag_namespace=None):
+        if isinstance(hits, (list, set)):
+            hits = IntSet(hits)
+        return await self.async_call(loop, 'tags', hits, tag_namespace)
+
+    def tags(self, hits, tag_namespace=None):
+        if isinstance(hits, (list, set)):
+            hits = IntSet(hits)
+        return self.call('tags', hits, tag_namespace)
+
+    async def async_counts(self, loop, terms_list,
+            tag_namespace=None,
+            mask_deleted=True, mask_tags=None, more_terms=None):
+        return await self.async_call(loop, 'counts', terms_list,
+            mask_deleted, mask_tags, more_terms, tag_namespace)
+
+    def counts(self, terms_list,
+            tag_namespace=None,
+            mask_deleted=True, mask_tags=None, more_terms=None):
+        return self.call('counts', terms_list,
+            mask_deleted, mask_tags, more_terms, tag_namespace)
+
     async def async_intersect(self, loop, terms, hits,
             tag_namespace=None,
             mask_deleted=True, mask_tags=None, more_terms=None):
@@ -255,10 +333,11 @@ class SearchWorker(BaseWorker):
             self.notify('[search] Compacting: %s' % (progress,), data=progress)
             self.results_to_callback_chain(callback_chain, progress)
         def background_compact():
-            with self.change_lock:
-                self._engine.records.compact(
-                    partial=not full,
-                    progress_callback=report_progress)
+            # The RecordStore compacts online, so we do not hold the
+            # change_lock; other requests only block during chunk swaps.
+            self._engine.records.compact(
+                partial=not full,
+                progress_callback=report_progress)
         self.add_background_job(background_compact)
         self.reply_json({'running': True})
 
@@ -295,6 +374,98 @@ class SearchWorker(BaseWorker):
     def api_explain(self, terms, **kwargs):
         self.reply_json(self._engine.explain(terms))
 
+    def _default_mask_tags(self, terms):
+        exact = [
+            term for term in terms.replace('+', '').split(' ')
+            if term.split(':', 1)[0] in self.EXACT_SEARCHES]
+        return None if exact else self.MASK_TAGS
+
+    def api_counts(self,
+            terms_list, mask_deleted, mask_tags, more_terms, tag_namespace,
+            **kwa):
+        if tag_namespace:
+            tag_namespace = tag_namespace.lower()
+
+        # Group the searches by which tags get masked, so each group can
+        # share one scope calculation within the engine.
+        groups = {}
+        for terms in terms_list:
+            mt = mask_tags
+            if mt is None:
+                mt = self._default_mask_tags(terms)
+            mt = tuple(mt) if mt else None
+            groups[mt] = groups.get(mt, []) + [terms]
+
+        counts = {}
+        for mt, group in groups.items():
+            counts.update(self._engine.search_counts(group,
+                tag_namespace=tag_namespace,
+                mask_deleted=mask_deleted,
+                mask_tags=mt,
+                more_terms=more_terms))
+
+        self.reply_json({
+            'counts': counts,
+            'more_terms': more_terms,
+            'mask_deleted': mask_deleted,
+            'tag_namespace': tag_namespace,
+            'version': self._engine.get_version()})
+
+    def _dec_comment(self, comment):
+        try:
+            comment = str(comment, 'utf-8')
+            comment = from_json(comment) if comment else {}
+        except (ValueError, TypeError):
+            pass
+        return comment
+
+    def _encoded_tags(self, hits, tag_namespace):
+        tag_info = self._engine.search_tags(hits, tag_namespace=tag_namespace)
+        return dict(
+            (tag, (self._dec_comment(com), dumb_encode_asc(iset, compress=128)))
+            for tag, (com, iset) in tag_info.items())
+
+    def _tag_counts(self, hits, tag_namespace):
+        tag_info = self._engine.search_tag_counts(hits,
+            tag_namespace=tag_namespace)
+        return dict(
+            (tag, (self._dec_comment(com), count))
+            for tag, (com, count) in tag_info.items())
+
+    def api_tags(self, hits, tag_namespace, **kwa):
+        if tag_namespace:
+            tag_namespace = tag_namespace.lower()
+        self.reply_json(self._encoded_tags(hits, tag_namespace))
+
+    def api_search_stream(self,
+            terms, mask_deleted, mask_tags, more_terms,
+            tag_namespace, chunk_size,
+            **kwa):
+        result = self.api_search(terms,
+            mask_deleted, mask_tags, more_terms, tag_namespace, False,
+            _internal=True)
+        hits = result.pop('hits')
+        result['total'] = hits.count()
+
+        # Tags are not calculated here, with the exception of in:urgent
+        # which is needed to sort the results. The caller can use the
+        # tags API to fetch the rest for whichever results it displays.
+        urgent = IntSet.And(hits, self._engine.search('in:urgent',
+            tag_namespace=result['tag_namespace'], mask_deleted=False))
+        result['tags'] = {}
+        if urgent.count():
+            result['tags']['in:urgent'] = (
+                {}, dumb_encode_asc(urgent, compress=128))
+
+        conn = self.start_sending_data('application/x-ndjson', None)
+        conn.sendall(to_json(result).encode('utf-8') + b'\n')
+        for chunk in hits.split(chunk_size or self.STREAM_CHUNK_SIZE):
+            conn.sendall(to_json({
+                    'count': chunk.count(),
+                    'hits': dumb_encode_asc(chunk, compress=256)
+                }).encode('utf-8') + b'\n')
+        self._client.close()
+
     def api_search(self,
             terms, mask_deleted, mask_tags, more_terms,
             tag_namespace, with_tags,
@@ -303,11 +474,7 @@ class SearchWorker(BaseWorker):
             tag_namespace = tag_namespace.lower()
 
         if mask_tags is None:
-            exact = [
-                term for term in terms.replace('+', '').split(' ')
-                if term.split(':', 1)[0] in self.EXACT_SEARCHES]
-            if not exact:
-                mask_tags = self.MASK_TAGS
+            mask_tags = self._default_mask_tags(terms)
 
         tns, ops, hits = self._engine.search(terms,
             tag_namespace=tag_namespace,
@@ -330,19 +497,11 @@ class SearchWorker(BaseWorker):
         else:
             result['hits'] = dumb_encode_asc(hits, compress=256)
 
-        if with_tags:
-            tag_info = self._engine.search_tags(
-                hits, tag_namespace=tag_namespace)
-            def _dec_comment(comment):
-                try:
-                    comment = str(comment, 'utf-8')
-                    comment = from_json(comment) if comment else {}
-                except (ValueError, TypeError):
-                    pass
-                return comment
-            result['tags'] = dict(
-                (tag, (_dec_comment(com), dumb_encode_asc(iset, compress=128)))
-                for tag, (com, iset) in tag_info.items())
+        if with_tags == 'counts':
+            # Listing tags only needs counts, not the intersections
+            result['tags'] = self._tag_counts(hits, tag_namespace)
+        elif with_tags:
+            result['tags'] = self._encoded_tags(hits, tag_namespace)
 
         if _internal:
             return result
@@ -381,6 +540,10 @@ if __name__ == '__main__':
             assert(s2['query'] == 'spooky')
             assert(list(dumb_decode(s2['hits'])) == [1])
 
+            c1 = sw.counts(['hello', 'spooky', 'hello + world', 'nothing'])
+            assert(c1['counts'] == {
+                'hello': 2, 'spooky': 1, 'hello + world': 2, 'nothing': 0})
+
             if 'wait' not in sys.argv[1:]:
                 sw.quit()
                 print('** Tests passed, exiting... **')
@@ -13,6 +13,7 @@
 # To keep the layering overhead to a minimum, choosing backends and
 # launching new ones as needed, should happen at the caller.
 #
+import itertools
 import logging
 import os
 import re
@@ -74,6 +75,82 @@ class StorageWorkerApi:
             metadata[:Metadata.OFS_HEADERS], text, data, full_raw, parts,
             username, password)
 
+    async def async_emails_raw(self, loop, metadata_list, email_cb,
+            username=None, password=None):
+        """
+        Fetch the raw bytes of many e-mails at once, passing each one to
+        email_cb(idx, data) as it arrives; data is None if the message could
+        not be loaded. E-mails arrive grouped by mailbox, not in the order
+        requested.
+        """
+        state = {'hdr': b'', 'buffer': bytearray(), 'want': None}
+        def data_cb(hdr, data):
+            if hdr is not None:
+                state['hdr'] = hdr
+            buf = state['buffer']
+            buf.extend(data)
+            if b'application/json' in state['hdr']:
+                # This is an error, not a stream
+                return
+            while True:
+                if state['want'] is None:
+                    eol = buf.find(b'\n')
+                    if eol < 0:
+                        break
+                    idx, length = (int(i) for i in buf[:eol].split())
+                    del buf[:eol+1]
+                    if length < 0:
+                        email_cb(idx, None)
+                        continue
+                    state['want'] = (idx, length)
+                idx, length = state['want']
+                if len(buf) < length:
+                    break
+                email_cb(idx, bytes(buf[:length]))
+                del buf[:length]
+                state['want'] = None
+
+        await self.async_call(loop, 'emails_raw',
+            [md[:Metadata.OFS_HEADERS] for md in metadata_list],
+            username, password,
+            data_cb=data_cb)
+        if b'application/json' in state['hdr']:
+            self._call_return(state['hdr'], bytes(state['buffer']))
+            raise IOError('Fetching e-mails failed')
+
+    async def async_email_part(self, loop, metadata, part, chunk_cb,
+            offset=0, length=None, username=None, password=None):
+        """
+        Fetch the decoded body of a single part of an e-mail, or a range
+        of it, passing the data to chunk_cb as it arrives. Returns the
+        size of the entire decoded part.
+        """
+        state = {'hdr': b'', 'buffer': bytearray(), 'size': None}
+        def data_cb(hdr, data):
+            if hdr is not None:
+                state['hdr'] = hdr
+            if state['size'] is None:
+                buf = state['buffer']
+                buf.extend(data)
+                eol = buf.find(b'\n')
+                if (eol < 0) or (b'application/json' in state['hdr']):
+                    return
+                state['size'] = int(buf[:eol])
+                data = bytes(buf[eol+1:])
+                del buf[:]
+            if data:
+                chunk_cb(data)
+
+        await self.async_call(loop, 'email_part',
+            metadata[:Metadata.OFS_HEADERS], part, offset, length,
+            username, password,
+            data_cb=data_cb)
+        if b'application/json' in state['hdr']:
+            self._call_return(state['hdr'], bytes(state['buffer']))
+            raise IOError('Fetching e-mail part failed')
+
+        return state['size']
+
     async def async_delete_emails(self, loop, mailbox, metadata_list,
             username=None, password=None):
         return await self.async_call(loop, 'delete_emails',
@@ -108,6 +185,11 @@ class StorageWorker(BaseWorker, StorageWorkerApi):
     PARSE_CACHE_MIN = 1000
     PARSE_CACHE_TTL = 180
 
+    # Messages parsed for email_part requests are kept for a little while,
+    # so a large attachment fetched range by range only gets parsed once.
+    PART_CACHE_MAX = 4
+    PART_CACHE_TTL = 60
+
     def __init__(self, unique_app_id, status_dir, backend,
             name=KIND, notify=None, log_level=logging.ERROR,
             shutdown_idle=None):
@@ -119,6 +201,8 @@ class StorageWorker(BaseWorker, StorageWorkerApi):
             b'info':          (True,  self.api_info),
             b'mailbox':       (True,  self.api_mailbox),
             b'email':         (True,  self.api_email),
+            b'emails_raw':    (True,  self.api_emails_raw),
+            b'email_part':    (True,  self.api_email_part),
             b'get':           (False, self.api_get),
             b'json':          (False, self.api_json),
             b'set':           (False, self.api_set),
@@ -127,6 +211,7 @@ class StorageWorker(BaseWorker, StorageWorkerApi):
             b'delete_emails': (True,  self.api_delete_emails)})
 
         self.parsed_mailboxes = {}
+        self.parsed_emails = {}
         self.background_thread = None
 
     def _expire_parse_cache(self):
@@ -135,6 +220,24 @@ class StorageWorker(BaseWorker, StorageWorkerApi):
         for key in expired:
             del self.parsed_mailboxes[key]
 
+    def _parse_for_parts(self, metadata, username, password):
+        now = time.time()
+        for key, (ts, parsed) in list(self.parsed_emails.items()):
+            if ts < now - self.PART_CACHE_TTL:
+                self.parsed_emails.pop(key, None)
+
+        cache_key = (metadata.idx, tuple(tuple(p) for p in metadata.pointers))
+        if cache_key in self.parsed_emails:
+            parsed = self.parsed_emails[cache_key][1]
+        else:
+            parsed = self.backend.parse_message(metadata,
+                username=username, password=password)
+            while len(self.parsed_emails) >= self.PART_CACHE_MAX:
+                oldest = min(self.parsed_emails.items(), key=lambda i: i[1][0])
+                self.parsed_emails.pop(oldest[0], None)
+        self.parsed_emails[cache_key] = (now, parsed)
+        return parsed
+
     def _background(self, task):
         if self.background_thread is not None:
             self.background_thread.join()
@@ -307,6 +410,63 @@ class StorageWorker(BaseWorker, StorageWorkerApi):
             parsed.with_full_raw()
         self.reply_json(parsed)
 
+    def api_emails_raw(self,
+            metadata_list, username, password, method=None):
+        """
+        Stream the raw bytes of many e-mails, each preceded by a line
+        containing its index and length (-1 if it could not be loaded).
+        """
+        metadata_list = [
+            Metadata(*(m[:Metadata.OFS_HEADERS] + [b'']))
+            for m in metadata_list]
+        emails = self.backend.messages(metadata_list,
+            username=username, password=password)
+        try:
+            # Fetch the first one before replying, so unlock requests
+            # get reported the same way as for a single e-mail.
+            first = next(emails, None)
+        except PleaseUnlockError as pue:
+            raise self.pue_to_needinfo(pue)
+
+        conn = self.start_sending_data('application/x-moggie-emails', None)
+        try:
+            if first is not None:
+                emails = itertools.chain([first], emails)
+            for md, data in emails:
+                if data is None:
+                    conn.sendall(b'%d -1\n' % md.idx)
+                else:
+                    conn.sendall(b'%d %d\n' % (md.idx, len(data)))
+                    conn.sendall(data)
+        except PleaseUnlockError as pue:
+            logging.info('emails_raw: Stopped early, %s' % pue)
+        finally:
+            self._client.close()
+
+    def api_email_part(self,
+            metadata, part, offset, length, username, password,
+            method=None):
+        """
+        Stream the decoded body of a single message part (or a range of
+        it), preceded by a line containing the size of the whole part.
+        """
+        metadata = Metadata(*(metadata[:Metadata.OFS_HEADERS] + [b'']))
+        try:
+            parsed = self._parse_for_parts(metadata, username, password)
+            size, chunks = parsed.part_size_and_body(part, offset, length)
+        except (KeyError, IndexError) as e:
+            raise APIException('%s' % e)
+        except PleaseUnlockError as pue:
+            raise self.pue_to_needinfo(pue)
+
+        conn = self.start_sending_data('application/octet-stream', None)
+        try:
+            conn.sendall(b'%d\n' % size)
+            for chunk in chunks:
+                conn.sendall(chunk)
+        finally:
+            self._client.close()
+
     def api_delete_emails(self,
             mailbox, metadata_list, username, password, method=None):
 
@@ -495,8 +655,13 @@ class StorageWorkers(WorkerPool, StorageWorkerApi):
         if args and isinstance(args[0], (str, bytes)):
             caps = self._imap_caps_from_arg(args[0], caps)
 
-        if fn == 'email' and isinstance(args[0], list):
-            md = Metadata(*(args[0][:Metadata.OFS_HEADERS] + [b'']))
+        md = None
+        if fn in ('email', 'email_part') and isinstance(args[0], list):
+            md = args[0]
+        elif fn == 'emails_raw' and args[0]:
+            md = args[0][0]
+        if md is not None:
+            md = Metadata(*(md[:Metadata.OFS_HEADERS] + [b'']))
             ptr = md.pointers[0]
             if ptr.ptr_type == Metadata.PTR.IS_IMAP:
                 caps = self._imap_caps_from_arg(dumb_decode(ptr.ptr_path))
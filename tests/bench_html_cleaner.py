@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+#
+# Benchmark the HTML and CSS cleaners against a corpus of HTML e-mail.
+#
+# Usage: python3 -m tests.bench_html_cleaner [--runs=N] [files ...]
+#
+# By default this uses the HTML files in tests/html-corpus/ (synthetic
+# marketing newsletters, heavy on inline CSS) and test-data/html/. For
+# each file it reports the median time taken to generate cleaned HTML
+# (as done when displaying a message) and Markdown (as done for display
+# in the TUI and for keyword extraction).
+#
+import os
+import statistics
+import sys
+import time
+
+from moggie.security.css import CSSCleaner
+from moggie.security.html import HTMLCleaner, html_to_markdown
+
+
+CORPUS_DIRS = [
+    os.path.join(os.path.dirname(__file__), 'html-corpus'),
+    os.path.join(os.path.dirname(__file__), '..', 'test-data', 'html')]
+
+
+def corpus_files(dirs=CORPUS_DIRS):
+    for d in dirs:
+        for fn in sorted(os.listdir(d)):
+            if fn.endswith('.html'):
+                yield os.path.join(d, fn)
+
+
+def clean_html(html):
+    return HTMLCleaner(html, css_cleaner=CSSCleaner()).clean()
+
+
+def timed(func, html, runs):
+    times = []
+    for i in range(0, runs):
+        t0 = time.time()
+        func(html)
+        times.append(time.time() - t0)
+    return statistics.median(times)
+
+
+def main(args):
+    runs = 5
+    while args and args[0].startswith('--runs='):
+        runs = int(args.pop(0)[7:])
+
+    total_html = total_md = 0
+    print('%9s %9s %9s  %s' % ('bytes', 'html(ms)', 'md(ms)', 'file'))
+    for fn in (args or corpus_files()):
+        with open(fn, 'r') as fd:
+            html = fd.read()
+        t_html = timed(clean_html, html, runs)
+        t_md = timed(html_to_markdown, html, runs)
+        total_html += t_html
+        total_md += t_md
+        print('%9d %9.1f %9.1f  %s' % (
+            len(html), 1000 * t_html, 1000 * t_md, os.path.basename(fn)))
+    print('%9s %9.1f %9.1f  (total)' % ('', 1000 * total_html, 1000 * total_md))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+#
+# Benchmark tagging large result sets in the search engine.
+#
+# Usage: python3 -m tests.bench_tag_mutations [--messages=N] [--runs=N]
+#
+# This creates a throw-away search index with N messages (default 400K),
+# and then tags and untags all of them, recording history as the `tag`
+# command does. For each run it reports how long the mutation took, the
+# throughput, the longest time the engine lock was held in one go, and the
+# slowest search made by a concurrent reader. Long lock holds and slow
+# searches are what users notice as the app "freezing" while a big tag
+# operation is in progress.
+#
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import numpy
+
+from moggie.search.engine import SearchEngine
+from moggie.util.intset import IntSet
+
+
+def make_engine(workdir, messages):
+    se = SearchEngine(workdir,
+        name='bench', encryption_keys=[b'1234123412349999'])
+    mask = numpy.ones(messages + 1, dtype=bool)
+    mask[0] = False
+    everything = IntSet.FromMask(mask)
+    mask[1::2] = False
+    evens = IntSet.FromMask(mask)
+    se.add_results([
+        (everything, ['in:inbox', 'from:list@example.org']),
+        (evens, ['in:read'])])
+    return se, everything
+
+
+class TimedLock:
+    """
+    A stand-in for the engine's RLock, which records how long the lock
+    was held (outermost acquire to release) by a given thread.
+    """
+    def __init__(self, thread):
+        self.lock = threading.RLock()
+        self.thread = thread
+        self.depth = 0
+        self.holds = [0]
+
+    def acquire(self, *args):
+        rv = self.lock.acquire(*args)
+        if rv:
+            self.depth += 1
+            if self.depth == 1:
+                self.t0 = time.time()
+        return rv
+
+    def release(self):
+        self.depth -= 1
+        if self.depth == 0 and threading.current_thread() is self.thread:
+            self.holds.append(time.time() - self.t0)
+        self.lock.release()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class Reader(threading.Thread):
+    def __init__(self, se):
+        super().__init__(daemon=True)
+        self.se = se
+        self.keep_running = True
+        self.max_search = 0
+        self.searches = 0
+
+    def run(self):
+        while self.keep_running:
+            t0 = time.time()
+            self.se.search('in:read')
+            self.max_search = max(self.max_search, time.time() - t0)
+            self.searches += 1
+            time.sleep(0.001)
+
+
+def timed_mutation(se, mset, ops, comment):
+    se.lock = TimedLock(threading.current_thread())
+    reader = Reader(se)
+    reader.start()
+    t0 = time.time()
+    result = se.mutate([(mset, ops)], record_history=comment)
+    elapsed = time.time() - t0
+    reader.keep_running = False
+    reader.join()
+    return elapsed, result, max(se.lock.holds), reader
+
+
+def main(args):
+    messages, runs = 400000, 3
+    for arg in args:
+        if arg.startswith('--messages='):
+            messages = int(arg[11:])
+        elif arg.startswith('--runs='):
+            runs = int(arg[7:])
+
+    workdir = tempfile.mkdtemp()
+    try:
+        se, everything = make_engine(workdir, messages)
+        mset = se.search('from:list@example.org')
+
+        # Warm up: the first write to each record file after startup scans
+        # its offsets to find free space, which takes ~100ms per file. A
+        # long-running app has long since paid that price, so we do too.
+        records = se.records
+        for idx in range(0, len(records), records.chunk_records):
+            records.get_chunk(idx, create=True)[1].get_empties()
+        for ops in ([('+', 'in:list')], [('-', 'in:list')]):
+            se.mutate([(mset, ops)], record_history='Warm-up')
+
+        print('%10s %9s %10s %10s %10s %8s  %s' % (
+            'messages', 'time(ms)', 'msgs/s', 'lock(ms)', 'search(ms)',
+            'reads', 'operation'))
+        for i in range(0, runs):
+            for ops, comment in (
+                    ([('+', 'in:list'), ('-', 'in:inbox')], 'Tag list'),
+                    ([('-', 'in:list'), ('+', 'in:inbox')], 'Untag list')):
+                elapsed, result, held, reader = timed_mutation(
+                    se, mset, ops, comment)
+                changed = result['changed'].count()
+                print('%10d %9.1f %10d %10.1f %10.1f %8d  %s' % (
+                    changed, 1000 * elapsed, changed / elapsed,
+                    1000 * held, 1000 * reader.max_search,
+                    reader.searches, comment))
+        se.close()
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
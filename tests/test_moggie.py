@@ -63,6 +63,42 @@ class OfflineMoggieTest(unittest.TestCase):
         self.assertEqual(parse1['_PARTS'][0]['_TEXT'].strip(), hello)
         self.assertEqual(parse1['subject'], hello)
 
+    def test_moggie_export_raw_emails(self):
+        from moggie.app.cli.notmuch import CommandSearch
+        from moggie.email.metadata import Metadata
+
+        idxs = [17, 3, 250, 42, 8]
+        results = [
+            Metadata(0, idx, [Metadata.PTR(0, b'/tmp/mbox/%d' % idx, 0)],
+                b'Subject: Message %d\r\n' % idx)
+            for idx in idxs]
+
+        requests = []
+        async def fake_request(access, query):
+            # Like the app, reply with [idx, data] pairs, skipping one
+            requests.append(query)
+            return {'emails': [
+                [md[Metadata.OFS_IDX], b'Raw %d' % md[Metadata.OFS_IDX]]
+                for md in query['metadata_list']
+                if md[Metadata.OFS_IDX] != 250]}
+
+        cmd = CommandSearch.__new__(CommandSearch)
+        cmd.fake_tid = 1
+        cmd.context = 'Context 0'
+        cmd.access = None
+        cmd.options = {'--username=': [None], '--password=': [None]}
+        cmd.EXPORT_BATCH = 2
+        cmd.repeatable_async_api_request = fake_request
+
+        async def export():
+            return [r async for r in cmd.as_raw_emails(results)]
+        exported = asyncio.get_event_loop().run_until_complete(export())
+
+        self.assertEqual(len(requests), 3)
+        self.assertEqual(
+            [(r[1]['_metadata'].idx, r[1]['_raw']) for r in exported],
+            [(idx, b'Raw %d' % idx) for idx in idxs if idx != 250])
+
 
 class OnlineMoggieTest(unittest.TestCase):
     """
@@ -146,3 +182,89 @@ class OnlineMoggieTest(unittest.TestCase):
         # running without callbacks would have.
         self.assertEquals(results[0], moggie.help())
 
+
+    def test_moggie_006_api_requests(self):
+        from moggie.email.metadata import Metadata
+
+        counts = self.moggie.api_counts(terms_list=['all:mail'])
+        self.assertEquals(counts['req_type'], 'counts')
+        total = counts['counts']['all:mail']
+
+        results = self.moggie.api_search(terms='all:mail', limit=5)
+        self.assertEquals(len(results['emails']), min(5, total))
+        for md in results['emails']:
+            self.assertTrue(isinstance(md, Metadata))
+
+        # The async variant should give the same results
+        results2 = asyncio.get_event_loop().run_until_complete(
+            self.moggie.async_api_search(terms='all:mail', limit=5))
+        self.assertEquals(
+            [md.idx for md in results['emails']],
+            [md.idx for md in results2['emails']])
+
+        # Raw e-mails come back as [idx, bytes] pairs, not Metadata
+        raw = self.moggie.api_emails(metadata_list=results['emails'])
+        self.assertEquals(raw['req_type'], 'emails')
+        self.assertEquals(
+            [idx for idx, data in raw['emails']],
+            [md.idx for md in results['emails']])
+        for idx, data in raw['emails']:
+            self.assertTrue(isinstance(data, bytes))
+            self.assertIn(b'Message-', data)
+
+    def test_moggie_007_tag_counts(self):
+        from moggie.util.dumbcode import dumb_decode
+        from moggie.util.intset import IntSet
+
+        def tags(**kwargs):
+            return self.moggie.api_search(
+                terms='all:mail', uncooked=True, mask_tags=[], **kwargs
+                )['results']['tags']
+
+        # Counting tags gives the same answers as the full intersections
+        full = tags()
+        counts = tags(tag_counts=True)
+        self.assertTrue(counts)
+        self.assertEqual(sorted(counts), sorted(full))
+        for tag, (comment, count) in counts.items():
+            iset = full[tag][1]
+            if not isinstance(iset, IntSet):
+                iset = dumb_decode(iset)
+            self.assertEqual(count, iset.count())
+
+        # The tag listing is built from the counts
+        listed = self.moggie.search('all:mail', output='tags')
+        self.assertEqual(
+            sorted(str(tag, 'utf-8') for tag in listed), sorted(counts))
+
+    def test_moggie_008_email_part(self):
+        import base64
+        from moggie.api.requests import RequestEmailPart
+        from moggie.email.parsemime import parse_message
+
+        # Find an e-mail with a base64 encoded part
+        found = None
+        results = self.moggie.api_search(terms='all:mail', limit=20)
+        for md in results['emails']:
+            email = self.moggie.api_email(metadata=md, full_raw=True)
+            parsed = parse_message(base64.b64decode(email['email']['_RAW']))
+            for i, part in enumerate(parsed.with_structure()['_PARTS']):
+                if part.get('content-transfer-encoding') == 'base64':
+                    found = (md, i, parsed.part_body(i))
+        self.assertTrue(found)
+
+        # Fetching the part in ranges gives us the decoded body
+        md, part, body = found
+        received, size = b'', None
+        while size is None or len(received) < size:
+            chunk = self.moggie.request(RequestEmailPart(
+                context='Context 0', metadata=md, part=part,
+                offset=len(received), length=100))
+            self.assertEqual(chunk['req_type'], 'email_part')
+            self.assertLessEqual(len(chunk['data']), 100)
+            if not chunk['data']:
+                break
+            size = chunk['size']
+            received += chunk['data']
+        self.assertEqual(size, len(body))
+        self.assertEqual(received, body)
@@ -0,0 +1,87 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from moggie.config import AppConfig, PENDING_SAVES, flush_pending_saves
+
+
+class AppConfigTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def config_file(self):
+        with open(os.path.join(self.tmpdir, 'config.rc'), 'r') as fd:
+            return fd.read()
+
+    def test_decoded_cache(self):
+        ac = AppConfig(self.tmpdir)
+        ac.provide_passphrase('This is a test passphrase', fast=True)
+        ac.set_private(AppConfig.GENERAL, 'secret', 'hello')
+        ac.set(AppConfig.GENERAL, 'unicode', 'blåber')
+        self.assertEqual(ac.get(AppConfig.GENERAL, 'secret'), 'hello')
+        self.assertEqual(ac.get(AppConfig.GENERAL, 'secret'), 'hello')
+        self.assertEqual(ac.get(AppConfig.GENERAL, 'unicode'), 'blåber')
+
+        # Setting a value invalidates the cache
+        ac.set_private(AppConfig.GENERAL, 'secret', 'world')
+        self.assertEqual(ac.get(AppConfig.GENERAL, 'secret'), 'world')
+        ac.set(AppConfig.GENERAL, 'unicode', 'jarðarber')
+        self.assertEqual(ac.get(AppConfig.GENERAL, 'unicode'), 'jarðarber')
+
+        # So does changing the raw value behind our back
+        ac[AppConfig.GENERAL]['unicode'] = ac[AppConfig.GENERAL]['secret']
+        self.assertEqual(ac.get(AppConfig.GENERAL, 'unicode'), 'world')
+
+    def test_write_behind(self):
+        ac = AppConfig(self.tmpdir, save_delay=0.2)
+        ac.save()
+        ac.flush()
+        ac.set(AppConfig.GENERAL, 'test_a', 'one')
+        ac.set(AppConfig.GENERAL, 'test_b', 'two')
+        self.assertNotIn('test_a', self.config_file())
+
+        # Saves get coalesced and written after a short delay
+        time.sleep(0.5)
+        self.assertIn('test_b', self.config_file())
+        self.assertFalse(ac.flush())
+
+        # Explicit flushes write right away
+        ac.set(AppConfig.GENERAL, 'test_c', 'three')
+        self.assertNotIn('test_c', self.config_file())
+        self.assertTrue(ac.flush())
+        self.assertIn('test_c', self.config_file())
+        self.assertFalse(os.path.exists(ac.filepath + '.tmp'))
+
+        # The config can be read back
+        ac2 = AppConfig(self.tmpdir)
+        self.assertEqual(ac2.get(AppConfig.GENERAL, 'test_a'), 'one')
+        self.assertEqual(ac2.get(AppConfig.GENERAL, 'test_c'), 'three')
+
+    def test_failed_flush_stays_pending(self):
+        ac = AppConfig(self.tmpdir, save_delay=10)
+        ac.set(AppConfig.GENERAL, 'test_a', 'one')
+
+        # If the write fails, the changes must not be forgotten
+        write_config = ac._write_config
+        def failing_write():
+            raise OSError('Disk full')
+        ac._write_config = failing_write
+        self.assertRaises(OSError, ac.flush)
+        self.assertTrue(ac.save_pending)
+        self.assertIn(id(ac), PENDING_SAVES)
+
+        # ... so a later flush (or the atexit hook) can retry
+        ac._write_config = write_config
+        flush_pending_saves()
+        self.assertFalse(ac.save_pending)
+        self.assertNotIn(id(ac), PENDING_SAVES)
+        self.assertIn('test_a', self.config_file())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,6 @@
+import datetime
 import doctest
+import itertools
 import os
 import shlex
 import sys
@@ -11,7 +13,73 @@ from moggie import Moggie
 from moggie.app.cron import Cron
 
 
+def brute_force_next(
+        minutes=None, hours=None, month_days=None, months=None,
+        weekdays=None,
+        now=None):
+    # The original minute-by-minute implementation of Cron.calculate_next
+    from datetime import timedelta
+    allowed_minutes = Cron.cronspec(minutes, 60)
+    allowed_hours = Cron.cronspec(hours, 24)
+    allowed_month_days = Cron.cronspec(month_days, 31, add=1)
+    allowed_months = Cron.cronspec(months, 12, add=1, trans=Cron.MONTHS)
+    allowed_weekdays = Cron.cronspec(weekdays, 7, trans=Cron.DOW)
+
+    nxt = now.replace(second=0)
+    loop_end = nxt + timedelta(days=366)
+    while nxt < loop_end:
+        nxt += timedelta(minutes=1)
+        if (nxt.minute in allowed_minutes
+                and nxt.hour in allowed_hours
+                and nxt.day in allowed_month_days
+                and nxt.month in allowed_months
+                and nxt.weekday() in allowed_weekdays):
+            return nxt
+    raise ValueError('No matching dates found, is spec valid?')
+
+
 class MoggieCronTests(unittest.TestCase):
+    def test_calculate_next(self):
+        specs = [
+            ('*', '*', '*', '*', '*'),
+            ('*/5', '*', '*', '*', '*'),
+            ('59', '23', '*', '*', '*'),
+            ('0', '0', '1', '*', '*'),
+            ('7,19', '3,4,5', '*', '*', 'sat,sun'),
+            ('30', '12', '31', '*', '*'),
+            ('0', '12', '30', 'feb,mar', '*'),
+            ('15', '2/3', '29', 'feb', '*'),
+            ('0', '0', '31', 'feb', '*'),
+            ('0', '0', '13', '*', 'fri'),
+            ('45', '6,18', '*', 'dec,jan', 'mon'),
+            ('1', '*', '28,29,30,31', '*', '*')]
+        starts = [
+            datetime.datetime(2023, 9, 29, 15, 0, 1),
+            datetime.datetime(2023, 12, 31, 23, 59, 30, 123456),
+            datetime.datetime(2024, 2, 28, 23, 59),
+            datetime.datetime(2024, 2, 29, 12, 30, 59),
+            datetime.datetime(2025, 1, 31, 23, 0),
+            datetime.datetime(2025, 3, 1, 0, 0)]
+
+        for spec, now in itertools.product(specs, starts):
+            try:
+                expected = brute_force_next(*spec, now=now)
+            except ValueError:
+                expected = ValueError
+            try:
+                result = Cron.calculate_next(*spec, now=now)
+            except ValueError:
+                result = ValueError
+            self.assertEqual(expected, result, '%s from %s' % (spec, now))
+
+        # Walk forward through a few schedules, one match at a time
+        for spec in specs[:5]:
+            now = expected = result = starts[0]
+            for i in range(0, 20):
+                expected = brute_force_next(*spec, now=expected)
+                result = Cron.calculate_next(*spec, now=result)
+                self.assertEqual(expected, result, '%s #%d' % (spec, i))
+
     def test_cron(self):
         tmpdir = os.path.join(os.path.dirname(__file__), '..', 'tmp')
         testfile = os.path.join(tmpdir, 'moggie.cron.test')
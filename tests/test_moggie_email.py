@@ -1,5 +1,6 @@
 import unittest
 import doctest
+import re
 
 import moggie.email.addresses
 import moggie.email.headers
@@ -42,3 +43,280 @@ To: "Somebody" <somebody@example.org>
             'to': [{'address': 'somebody@example.org', 'fn': 'Somebody'}],
             'subject': 'Hello world'}))
 
+
+
+class HeaderScanningTests(unittest.TestCase):
+    MESSAGES = [
+        b'From: a@example.org\nTo: b@example.org\nSubject: Hi\n\nBody\n',
+        b'From foo@bar  Tue Aug  2 19:03:42 2022\nFROM: a\nSubject:\n'
+        b' Folded\n\tTwice\nJunk: x\ncc:c\nX-To: d\n\nBody\n',
+        b'Subject:\nJunk: quirk\nDate:\n\nBody\n',
+        b'To: a\n  \nReceived: from x\n  by y\nMessage-Id: <m>\n\nBody\n',
+        b'Subject: x\r\n\r\nBody\r\n',
+        b'From: a\r\nSubject:\r\n Folded\r\n  \r\nIn-Reply-To: <i>\r\n\r\n',
+        b'No headers here\n\nBody\n',
+        b'To: truncated']
+
+    # The original, slower, header scanning regexp
+    HEADER_RE = re.compile(b'(?:^|\n)(' +
+            b'(?:Date|Message-ID|In-Reply-To|From|To|Cc|Subject):\n?' +
+            b'(?:[^\n]+\n\\s+)*[^\n]+' +
+        b')',
+        flags=(re.IGNORECASE + re.DOTALL))
+
+    def reference(self, obj, beg):
+        sep = b'\r\n\r\n' if (b'\r\n' in obj[beg:beg+256]) else b'\n\n'
+        hend = obj.find(sep, beg, beg+102400)
+        if hend < 0:
+            return None
+        hend += len(sep)
+        return hend, (b'\n'.join(
+                h.strip()
+                for h in re.findall(self.HEADER_RE, obj[beg:hend]))
+            ).replace(b'\r', b'')
+
+    def test_quick_msgparse(self):
+        import glob, os, random
+        from moggie.email.util import quick_msgparse
+        tdir = os.path.join(os.path.dirname(__file__), '..', 'test-data')
+        messages = list(self.MESSAGES)
+        for fn in glob.glob(os.path.join(tdir, 'emails', 'cur', '*')):
+            with open(fn, 'rb') as fd:
+                messages.append(fd.read())
+
+        rnd = random.Random(1)
+        chunks = [b'\n', b'\r\n', b' ', b'\t', b':', b'x', b'To', b'date:']
+        for i in range(0, 500):
+            messages.append(b''.join(rnd.choice(chunks) for j in range(40)))
+
+        for msg in messages:
+            for prefix in (b'', b'From x@y\n', b'...\r\n'):
+                obj = prefix + msg
+                self.assertEqual(
+                    quick_msgparse(obj, len(prefix)),
+                    self.reference(obj, len(prefix)))
+
+    def test_parse_date(self):
+        import email.utils, os, time
+        from moggie.email.headers import parse_date, _MKTIME_HOUR_CACHE
+
+        def reference(value):
+            tt = email.utils.parsedate_tz(value)
+            return (int(time.mktime(tt[:9])) - tt[9], tt[9])
+
+        dates = [
+            'Tue, 02 Aug 2022 19:03:42 +0000',
+            'Tue, 20 Jun 2023 19:03:47 -0000',
+            'Tue,20 Jun 2023 19:03:47 -0130 (XYZ)',
+            '  2 Feb 1999 09:03 +0530',
+            'Mon, 31 Feb 2021 23:59:59 -1200',
+            'Tue, 02 Aug 2022 19:03:42 GMT',
+            'Tue, 02 Aug 22 19:03:42 +0000',
+            'Tue, 02 Aug 2022 19:03:60 +0000']
+        for date in dates:
+            self.assertEqual(parse_date(date), reference(date))
+        for bad in ('', 'garbage', 'Tue, 02 Aug 2022', None):
+            self.assertRaises((ValueError, TypeError), parse_date, bad)
+
+        # Make sure our hourly mktime() cache is correct across DST changes
+        old_tz = os.environ.get('TZ')
+        try:
+            os.environ['TZ'] = 'America/New_York'
+            time.tzset()
+            _MKTIME_HOUR_CACHE.clear()
+            for month, day in ((3, 12), (11, 5)):
+                for hour in range(0, 5):
+                    for minute in range(0, 60, 7):
+                        date = 'Sun, %d %s 2023 %2.2d:%2.2d:%2.2d -0400' % (
+                            day, 'Mar' if (month == 3) else 'Nov',
+                            hour, minute, minute)
+                        self.assertEqual(parse_date(date), reference(date))
+        finally:
+            if old_tz is None:
+                del os.environ['TZ']
+            else:
+                os.environ['TZ'] = old_tz
+            time.tzset()
+            _MKTIME_HOUR_CACHE.clear()
+
+
+class ParseCacheTests(unittest.TestCase):
+    def test_parse_cache(self):
+        from moggie.app.cli.email import ParseCache
+        from moggie.email.parsemime import parse_message
+
+        msg = HeaderScanningTests.MESSAGES[0]
+        result = {'parsed': parse_message(msg).with_structure().with_text()}
+        size = ParseCache.ApproxSize(result)
+        self.assertTrue(size > len(msg))
+
+        pc = ParseCache(max_bytes=size * 20, max_entries=10)
+        self.assertTrue(pc.put((1, 'settings'), result))
+        self.assertEqual(pc.get((2, 'settings')), None)
+        self.assertEqual(pc.get(None), None)
+
+        # Results are copies, mutating them does not change the cache
+        cached = pc.get((1, 'settings'))
+        self.assertEqual(cached['parsed']['subject'], 'Hi')
+        cached['parsed']['subject'] = 'Changed'
+        self.assertEqual(pc.get((1, 'settings'))['parsed']['subject'], 'Hi')
+
+        # Least recently used entries are evicted first
+        for i in range(2, 12):
+            pc.put((i, 'settings'), result)
+            pc.get((1, 'settings'))
+        self.assertEqual(len(pc), 10)
+        self.assertTrue(pc.get((1, 'settings')))
+        self.assertFalse(pc.get((2, 'settings')))
+
+        # The memory budget is respected
+        pc.max_bytes = size * 4
+        pc.put((12, 'settings'), result)
+        self.assertEqual(len(pc), 4)
+        self.assertTrue(pc.bytes <= pc.max_bytes)
+        self.assertFalse(pc.put((13, 'huge'), {'data': b'x' * size * 2}))
+
+        # Expired entries are dropped
+        pc.put((14, 'settings'), result, max_age=-1)
+        self.assertFalse(pc.get((14, 'settings')))
+        self.assertEqual(pc.bytes, sum(e[1] for e in pc.entries.values()))
+
+    def test_parse_cache_untrusted_metadata(self):
+        import asyncio, base64
+        from moggie.app.cli.email import CommandParse, ParseCache
+        from moggie.email.metadata import Metadata
+
+        md = Metadata(0, 5, [Metadata.PTR(0, b'/tmp/mbox/5', 0)],
+            b'Subject: Message 5\r\n')
+        searches = []
+        async def fake_search(access, request):
+            searches.append(request)
+            return {'emails': [list(md)]}
+        async def fake_email(access, request):
+            return {'email': {'_RAW': str(base64.b64encode(b'Raw'), 'utf-8')}}
+
+        cmd = CommandParse.__new__(CommandParse)
+        cmd.context = 'Context 0'
+        cmd.access = None
+        cmd.options = {'--username=': [None], '--password=': [None]}
+        cmd.connect = lambda: None
+        cmd.worker = type('FakeWorker', (), {})()
+        cmd.worker.async_api_request = fake_email
+        cmd.repeatable_async_api_request = fake_search
+        cmd.get_cache_key = lambda md: ('test', md.idx)
+        cmd.parse_cache = ParseCache()
+        cmd.parse_cache.put(('test', 5), {'parsed': 'Cached'})
+
+        async def _gather(search):
+            cmd.searches = [(None, search)]
+            return [r async for r in cmd.gather_emails()]
+        def gather(search):
+            loop = asyncio.new_event_loop()
+            try:
+                return loop.run_until_complete(_gather(search))
+            finally:
+                loop.close()
+
+        # Metadata supplied by the caller must neither hit nor fill the cache
+        json_md = {'ts': 0, 'idx': 5, 'ptrs': [list(Metadata.PTR(0, b'/tmp/elsewhere', 0))],
+            'raw_headers': ''}
+        result = gather(json_md)
+        self.assertEqual(result[0]['data'], b'Raw')
+        self.assertIsNone(result[0]['cache_key'])
+        self.assertEqual(searches, [])
+
+        # Results from the index do use the cache
+        result = gather('id:5')
+        self.assertEqual(result[0]['cached']['parsed'], 'Cached')
+        self.assertEqual(len(searches), 1)
+
+
+class PartDescriptorTests(unittest.TestCase):
+    def message(self, blob):
+        import base64
+        b64 = base64.encodebytes(blob).replace(b'\n', b'\r\n')
+        return (b'Content-Type: multipart/mixed; boundary="b"\r\n\r\n'
+            b'--b\r\nContent-Type: text/plain\r\n'
+            b'Content-Transfer-Encoding: quoted-printable\r\n\r\n'
+            b'Hello=20world\r\n'
+            b'--b\r\nContent-Type: application/octet-stream\r\n'
+            b'Content-Transfer-Encoding: base64\r\n\r\n' + b64 +
+            b'--b--\r\n')
+
+    def test_iter_part_body(self):
+        import hashlib, os
+        from moggie.email.parsemime import parse_message
+
+        blob = os.urandom(100000)
+        p = parse_message(self.message(blob)).with_descriptors()
+        self.assertNotIn('_DATA', p['_PARTS'][2])
+        self.assertEqual(p['_PARTS'][2]['_SIZE'], len(blob))
+        self.assertEqual(p['_PARTS'][2]['_SHA256'],
+            hashlib.sha256(p.part_raw(2, header=False)).hexdigest())
+
+        self.assertEqual(p.part_body(1).strip(), b'Hello world')
+        for idx, body in ((1, p.part_body(1)), (2, blob)):
+            self.assertEqual(p['_PARTS'][idx]['_SIZE'], len(body))
+            self.assertEqual(b''.join(p.iter_part_body(idx)), body)
+            for offset, length, chunk_size in (
+                    (0, None, 4096), (1, 10, 3), (12345, 54321, 1000)):
+                chunks = list(p.iter_part_body(idx,
+                    offset, length, chunk_size=chunk_size))
+                self.assertEqual(b''.join(chunks),
+                    body[offset:(offset + length) if length else None])
+                self.assertTrue(all(len(c) <= chunk_size for c in chunks))
+                size, chunks = p.part_size_and_body(idx,
+                    offset, length, chunk_size=chunk_size)
+                self.assertEqual(size, len(body))
+                self.assertEqual(b''.join(chunks),
+                    body[offset:(offset + length) if length else None])
+
+    def test_email_part_ranges(self):
+        import os
+        from moggie.email.metadata import Metadata
+        from moggie.email.parsemime import parse_message
+        from moggie.workers.storage import StorageWorker
+
+        blob = os.urandom(100000)
+        parses = []
+        class FakeBackend:
+            def parse_message(backend, metadata, **kwargs):
+                parses.append(metadata.idx)
+                return parse_message(self.message(blob))
+        class FakeConn:
+            def sendall(conn, data):
+                sent.append(bytes(data))
+            def close(conn):
+                pass
+
+        sw = StorageWorker.__new__(StorageWorker)
+        sw.backend = FakeBackend()
+        sw.parsed_emails = {}
+        sw._client = FakeConn()
+        sw.start_sending_data = lambda mimetype, length: sw._client
+
+        # Fetching a part range by range only parses the message once
+        md = list(Metadata(0, 7, Metadata.PTR(0, b'/tmp/mbox', 0), b'', 0, 0))
+        received = b''
+        while True:
+            sent = []
+            sw.api_email_part(md, 2, len(received), 30000, None, None)
+            size, data = b''.join(sent).split(b'\n', 1)
+            self.assertEqual(int(size), len(blob))
+            if not data:
+                break
+            self.assertLessEqual(len(data), 30000)
+            received += data
+        self.assertEqual(received, blob)
+        self.assertEqual(parses, [7])
+        self.assertEqual(list(sw.parsed_emails.values())[0][1]
+            .cleaned_base64.keys(), {(2, True)})
+
+        # Other messages get parsed too, but the cache stays small
+        text = parse_message(self.message(blob)).part_body(1)
+        for idx in range(10, 10 + 2 * sw.PART_CACHE_MAX):
+            md[1] = idx
+            sent = []
+            sw.api_email_part(md, 1, 0, None, None, None)
+            self.assertEqual(b''.join(sent), b'%d\n%s' % (len(text), text))
+        self.assertEqual(len(sw.parsed_emails), sw.PART_CACHE_MAX)
@@ -1,7 +1,10 @@
+import os
 import unittest
 import doctest
 
 import moggie.security.filenames
+from moggie.security.css import CSSCleaner
+from moggie.security.html import HTMLCleaner
 
 
 class DoctestTests(unittest.TestCase):
@@ -13,3 +16,22 @@ class DoctestTests(unittest.TestCase):
 
     def test_doctests_filenames(self):
         self.run_doctests(moggie.security.filenames)
+
+
+class HTMLCleanerTests(unittest.TestCase):
+    CORPUS = os.path.join(os.path.dirname(__file__), 'html-corpus')
+
+    def clean(self, html):
+        return HTMLCleaner(html, css_cleaner=CSSCleaner()).clean()
+
+    def test_corpus(self):
+        for fn in sorted(os.listdir(self.CORPUS)):
+            with open(os.path.join(self.CORPUS, fn), 'r') as fd:
+                html = fd.read()
+
+            # Memoized style/selector results must not change the output
+            cleaned = self.clean(html)
+            self.assertEqual(cleaned, self.clean(html))
+            self.assertNotIn('<style', cleaned)
+            self.assertNotIn('<script', cleaned)
+            self.assertIn('style="', cleaned)
@@ -0,0 +1,110 @@
+import os
+import random
+import shutil
+import struct
+import tempfile
+import unittest
+
+from moggie.email.metadata import Metadata
+from moggie.storage.metadata import MetadataStore
+from moggie.storage.records import RecordStore
+
+
+class MetadataStoreTests(unittest.TestCase):
+    KEYS = [b'123456789abcdef0']
+
+    def setUp(self):
+        self.tmpdirs = []
+
+    def tearDown(self):
+        for d in self.tmpdirs:
+            shutil.rmtree(d)
+
+    def store(self):
+        self.tmpdirs.append(tempfile.mkdtemp())
+        return MetadataStore(self.tmpdirs[-1], 'metadata-test', self.KEYS)
+
+    def messages(self, count):
+        rnd = random.Random(count)
+        msgs = []
+        for i in range(0, count):
+            hdrs = 'Message-Id: <test-%8.8d@example.org>\n' % i
+            if i and rnd.random() < 0.6:
+                # Replies to messages earlier or later in the batch,
+                # or to messages we never see.
+                hdrs += 'In-Reply-To: <test-%8.8d@example.org>\n' % (
+                    rnd.randint(0, count + 10))
+            msgs.append(Metadata(
+                1600000000 + rnd.randint(0, 10**8), 0,
+                Metadata.PTR(0, b'/tmp/test/%d' % i, 0),
+                bytes(hdrs, 'utf-8'), 0, 0, {}))
+        return sorted(msgs)
+
+    def state(self, ms):
+        return [
+            (i, ms[i].thread_id, ms[i].parent_id, ms.rank_by_date[i],
+                ms.get_thread_idxs(ms[i].thread_id))
+            for i in range(1, len(ms))]
+
+    def test_add_many(self):
+        one_by_one, bulk = self.store(), self.store()
+        expected, results = [], []
+        for update in (True, False, True):
+            added, updated = [], []
+            for m in self.messages(150):
+                if update:
+                    is_new, idx = one_by_one.update_or_add(m)
+                else:
+                    is_new, idx = False, one_by_one.add_if_new(m)
+                if idx:
+                    (added if is_new else updated).append(idx)
+            expected.append((added, updated))
+            results.append(bulk.add_many(self.messages(150), update=update))
+
+        # Replies to later messages create ghosts, which then get updated
+        self.assertEqual(len(set(results[0][0] + results[0][1])), 150)
+        self.assertTrue(results[0][1])
+        self.assertEqual(results[1], ([], []))
+        self.assertEqual(results, expected)
+        self.assertEqual(self.state(bulk), self.state(one_by_one))
+        self.assertIsNone(bulk.pending_ranks)
+
+
+class RecordStoreTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_compact_keeps_unreadable_records(self):
+        rs = RecordStore(self.tmpdir, 'testing',
+            aes_keys=[b'1234123412341234'], target_file_size=1024000)
+        for i in range(0, 50):
+            rs.append('record %d' % i)
+        for i in range(0, 50, 3):
+            rs[i] = 'rewritten record %d, to fragment the file' % i
+        rs.flush()
+
+        # Damage the record marker of idx 7 on disk, so it cannot be read
+        chunk = rs.get_chunk(7)[1]
+        path, ofs = chunk.path, chunk.offsets[7]
+        with open(path, 'rb') as fd:
+            before = fd.read()
+        with open(path, 'rb+') as fd:
+            fd.seek(ofs)
+            fd.write(struct.pack('I', ofs + 1))
+        rs.flush()
+
+        # Compaction must not silently drop the record: the chunk is kept
+        rs.compact(force=True, processes=1)
+        with open(path, 'rb') as fd:
+            after = fd.read()
+        self.assertEqual(len(after), len(before))
+        self.assertFalse(os.path.exists(path + '.next'))
+        self.assertEqual(rs[8], 'record 8')
+        self.assertEqual(rs[9], 'rewritten record 9, to fragment the file')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -168,6 +168,175 @@ class SendmailTests(unittest.TestCase):
             parse_partial_url('user:secret@localhost:125'),
             ('smtp', 'user', 'secret', 'localhost', 125, None))
 
+    class SMTPStub:
+        """A minimal in-process SMTP server, counting what clients do."""
+        def __init__(self, temp_failures=0):
+            self.temp_failures = temp_failures
+            self.connections = self.active = self.max_active = 0
+            self.commands = []
+            self.messages = []
+
+        async def handle(self, reader, writer):
+            self.connections += 1
+            self.active += 1
+            self.max_active = max(self.active, self.max_active)
+            writer.write(b'220 stub ESMTP\r\n')
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                cmd = line.split()[0].upper()
+                self.commands.append(cmd)
+                if cmd == b'EHLO':
+                    writer.write(b'250-stub\r\n250-PIPELINING\r\n'
+                                 b'250 AUTH PLAIN LOGIN\r\n')
+                elif cmd == b'AUTH':
+                    writer.write(b'235 OK\r\n')
+                elif cmd == b'MAIL' and self.temp_failures:
+                    self.temp_failures -= 1
+                    writer.write(b'451 Try again later\r\n')
+                elif cmd == b'RCPT' and b'bad' in line:
+                    writer.write(b'550 No such user\r\n')
+                elif cmd == b'DATA':
+                    writer.write(b'354 Go ahead\r\n')
+                    data = b''
+                    while not data.endswith(b'\r\n.\r\n'):
+                        data += await reader.readline()
+                    self.messages.append(data)
+                    writer.write(b'250 Queued\r\n')
+                elif cmd == b'QUIT':
+                    writer.write(b'221 Bye\r\n')
+                    break
+                elif cmd in (b'MAIL', b'RCPT', b'RSET', b'NOOP'):
+                    writer.write(b'250 OK\r\n')
+                else:
+                    writer.write(b'502 Unsupported\r\n')
+                await writer.drain()
+            self.active -= 1
+            writer.close()
+
+    def run_with_stub(self, stub, coro_func):
+        import asyncio
+        async def runner():
+            server = await asyncio.start_server(stub.handle, '127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            try:
+                return await coro_func('smtp://user:pw@127.0.0.1:%d' % port)
+            finally:
+                server.close()
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(runner())
+        finally:
+            loop.close()
+
+    def test_sendmail_smtp(self):
+        import asyncio
+        from moggie.util.sendmail import sendmail, SMTPPool
+        transcript = []
+        def progress(good, status, details, message):
+            transcript.append((good, status))
+            return False
+
+        msg = b'Subject: Hello\r\n\r\nHello world\r\n'
+        frm = 'a@example.org'
+
+        # Without a pool, each message gets a connection of its own
+        stub = self.SMTPStub()
+        async def send_two(via):
+            for i in range(0, 2):
+                await sendmail(msg, [(via, frm, ['b@example.org'])], progress)
+        self.run_with_stub(stub, send_two)
+        self.assertEqual(stub.connections, 2)
+        self.assertEqual(len(stub.messages), 2)
+
+        # With a pool, a single connection is logged in once and reused
+        stub = self.SMTPStub()
+        async def send_five(via):
+            async with SMTPPool(max_per_relay=1) as pool:
+                return [await sendmail(msg, [(via, frm, ['b@example.org'])],
+                                       progress, pool=pool)
+                    for i in range(0, 5)]
+        self.assertEqual(self.run_with_stub(stub, send_five), [True] * 5)
+        self.assertEqual(stub.connections, 1)
+        self.assertEqual(stub.commands.count(b'AUTH'), 1)
+        self.assertEqual(stub.commands.count(b'RSET'), 4)
+        self.assertEqual(len(stub.messages), 5)
+
+        # Concurrent sends are limited per relay
+        stub = self.SMTPStub()
+        async def send_many(via):
+            async with SMTPPool(max_per_relay=2) as pool:
+                return await asyncio.gather(*[
+                    sendmail(msg, [(via, frm, ['b@example.org'])],
+                             progress, pool=pool)
+                    for i in range(0, 8)])
+        self.assertEqual(self.run_with_stub(stub, send_many), [True] * 8)
+        self.assertEqual(stub.max_active, 2)
+        self.assertEqual(len(stub.messages), 8)
+
+        # Temporary failures are retried, permanent ones are not
+        stub = self.SMTPStub(temp_failures=2)
+        transcript[:] = []
+        async def send_retry(via):
+            async with SMTPPool(backoff=0.01) as pool:
+                return (
+                    await sendmail(msg, [(via, frm, ['b@example.org'])],
+                                   progress, pool=pool),
+                    await sendmail(msg, [(via, frm, ['bad@example.org'])],
+                                   progress, pool=pool))
+        self.assertEqual(self.run_with_stub(stub, send_retry), (True, False))
+        self.assertEqual(len(stub.messages), 1)
+        self.assertEqual(stub.connections, 1)
+        statuses = [s for g, s in transcript]
+        self.assertEqual(statuses.count('retrying'), 2)
+        self.assertEqual(statuses.count('rcpt_rejected'), 1)
+
+    def test_email_send_pool(self):
+        from moggie.app.cli.email import CommandEmail
+        from moggie.app.core import AppCore
+
+        class Addr:
+            def __init__(self, address):
+                self.address = address
+
+        def email_command(worker, via):
+            cmd = CommandEmail.__new__(CommandEmail)
+            cmd.worker = worker
+            cmd.options = {
+                '--send-via=': [via],
+                '--from=': [Addr('a@example.org')]}
+            cmd.print_json = lambda data: None
+            return cmd
+
+        msg = b'Subject: Hello\r\n\r\nHello world\r\n'
+        rcpts = [Addr('b@example.org')]
+
+        # Within the app, sends share the app's pool and its connections
+        app = AppCore.__new__(AppCore)
+        app.smtp_pool = None
+        worker = type('FakeAppWorker', (), {'_sock': True, 'app': app})()
+        stub = self.SMTPStub()
+        async def send_in_app(via):
+            for i in range(0, 3):
+                await email_command(worker, via).do_send(
+                    render=msg, recipients=rcpts)
+            await app.smtp_pool.close()
+        self.run_with_stub(stub, send_in_app)
+        self.assertEqual(len(stub.messages), 3)
+        self.assertEqual(stub.connections, 1)
+        self.assertEqual(stub.commands.count(b'AUTH'), 1)
+
+        # Stand-alone sends use a pool of their own, closed when done
+        worker = type('FakeCLIWorker', (), {'_sock': None})()
+        stub = self.SMTPStub()
+        async def send_alone(via):
+            await email_command(worker, via).do_send(
+                render=msg, recipients=rcpts)
+        self.run_with_stub(stub, send_alone)
+        self.assertEqual(len(stub.messages), 1)
+        self.assertEqual(stub.commands.count(b'QUIT'), 1)
+
 
 class IntsetTest(unittest.TestCase):
     def test_intset(self):
@@ -199,6 +368,10 @@ class IntsetTest(unittest.TestCase):
         is1 ^= [9, 11]
         self.assertTrue(9 not in is1)
         self.assertTrue(11 in is1)
+        is1 ^= IntSet([11, 12])
+        self.assertTrue(11 not in is1)
+        self.assertTrue(12 in is1)
+        self.assertTrue(46 in is1)
 
         a100 = IntSet.All(100)
         self.assertTrue(bool(a100))
@@ -257,3 +430,36 @@ class WordblobTest(unittest.TestCase):
         self.assertEqual(wordblob_search('f*', b1, 10, order=-1), ['f', 'Five', 'Four'])
         self.assertEqual(wordblob_search('f*', b1, 10, order=+1), ['f', 'Four', 'Five'])
 
+    def test_wordblob_indexed(self):
+        words = [bytes(w, 'utf-8') for w in [
+            'hello', 'world', 'this', 'is', 'great', 'oh', 'yeah',
+            'worldly', 'underworld', 'Worlds', 'w.rld']]
+        blob = create_wordblob(words, shortest=2, longest=10, maxlen=20)
+        wb = WordBlob(blob, shortest=2, longest=10, maxlen=20)
+        self.assertEqual(wb.tobytes(), blob)
+        self.assertTrue(b'world' in wb)
+        self.assertFalse(b'orld' in wb)
+        for term in ('*', 'worl*', '*orld', '*at', 'w*d', '*w*r*d*',
+                     '*world*', 'world', 'WORLD*', 'w.rld', 'wor*ldly'):
+            self.assertEqual(
+                wordblob_search(term, blob, 10),
+                wordblob_search(term, wb, 10))
+
+        # Incremental updates should give the same results as rebuilding
+        # the blob, and replaying the log should give the same results
+        # as the live updates.
+        b1 = create_wordblob(b'five four three two one'.split(), shortest=1)
+        wb = WordBlob(b1, shortest=1, maxlen=4)
+        for update, blacklist in (
+                ([b'five'], []),
+                ([b'four'], []),
+                ([b'three'], []),
+                ([b'two'], []),
+                ([b'one'], [b'three'])):
+            if wb.update(update, blacklist=blacklist):
+                b1 = wb.tobytes()  # Checkpointed, log was reset
+        self.assertEqual(wb.tobytes(), b'one\ntwo\nfour\nfive')
+        wb2 = WordBlob(b1, shortest=1, maxlen=4).replay(wb.log)
+        self.assertEqual(wb2.tobytes(), b'one\ntwo\nfour\nfive')
+        self.assertEqual(
+            wordblob_search('f*', wb2, 10, order=-1), ['f', 'five', 'four'])
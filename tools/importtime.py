@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+#
+# Measure how much time moggie CLI commands spend importing modules.
+#
+# Usage: tools/importtime.py [--runs=N] [--top=N] [command args ...]
+#
+# This runs `python3 -X importtime -m moggie <command args>` a few times
+# (default: `moggie help`) and reports the median wall-clock time of the
+# whole process, the median time spent on imports and the modules which
+# took the longest to load (cumulative, including their own imports).
+#
+# Note: If PYTHONDONTWRITEBYTECODE is set, modules are compiled from
+# source every time, which skews the results. Run `python3 -m compileall
+# moggie` first, to measure what users actually see.
+#
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+def importtime(args):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.path.join(os.path.dirname(__file__), '..')
+    t0 = time.time()
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-m', 'moggie'] + args,
+        env=env,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE)
+    elapsed = time.time() - t0
+
+    modules = {}
+    total = 0
+    for line in str(proc.stderr, 'utf-8', 'replace').splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[12:].split('|')
+        cumulative = int(cumulative) / 1000000.0
+        if not name.startswith('  '):
+            total += cumulative
+        name = name.strip()
+        modules[name] = modules.get(name, 0) + cumulative
+    return elapsed, total, modules
+
+
+def main(args):
+    runs, top = 5, 25
+    while args and args[0].startswith('--'):
+        arg = args.pop(0)
+        if arg.startswith('--runs='):
+            runs = int(arg[7:])
+        elif arg.startswith('--top='):
+            top = int(arg[6:])
+        else:
+            args.insert(0, arg)
+            break
+    args = args or ['help']
+
+    results = [importtime(args) for i in range(0, runs)]
+    names = set()
+    for elapsed, total, modules in results:
+        names |= set(modules.keys())
+    medians = dict(
+        (n, statistics.median(r[2].get(n, 0) for r in results))
+        for n in names)
+
+    print('# moggie %s (%d runs)' % (' '.join(args), runs))
+    print('wall-clock: %.3fs' % statistics.median(r[0] for r in results))
+    print('imports:    %.3fs' % statistics.median(r[1] for r in results))
+    print()
+    for name in sorted(names, key=lambda n: -medians[n])[:top]:
+        print('%8.1fms  %s' % (1000 * medians[name], name))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])